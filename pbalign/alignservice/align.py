@@ -167,13 +167,51 @@ class AlignService (Service):
         raise NotImplementedError(
             "_preProcess() method for AlignService must be overridden")
 
+    def prepareReference(self):
+        """Build reference index files which are required by the aligner
+        under self._fileNames.referenceIndexDir, so that all runs sharing
+        this directory can reuse them. Do nothing by default."""
+        logging.debug(self.name + ": No reference index files to build.")
+
+    def plannedQueryFileName(self):
+        """Return the file which _preProcess() would pass to the aligner,
+        without converting or building anything. The input file is passed
+        to the aligner directly by default."""
+        return self._fileNames.inputFileName
+
+    def plannedCmd(self, queryFileName, alignerSamOut, nproc=None,
+                   targetFileName=None, hitPolicy=None):
+        """Return the command line which run() would execute to align
+        queryFileName and output alignerSamOut (with nproc threads, against
+        targetFileName, e.g., a chunk of the reference, and with hitPolicy
+        if they are not None), without running anything."""
+        options = copy(self._options)
+        if nproc is not None:
+            options.nproc = nproc
+        if hitPolicy is not None:
+            options.hitPolicy = hitPolicy
+        fileNames = copy(self._fileNames)
+        if targetFileName is not None:
+            fileNames.targetFileName = targetFileName
+            fileNames.sawriterFileName = None
+            fileNames.stagedFileNames = {}
+        fileNames.queryFileName = queryFileName
+        fileNames.alignerSamOut = alignerSamOut
+        return self._toCmd(options, fileNames, self._tempFileManager)
+
     def _postProcess(self):
         """A virtual method to post process the generated output file. """
         raise NotImplementedError(
             "_postProcess() method for AlignService must be overridden")
 
-    def run(self):
-        """AlignService starts to run. """
+    def run(self, alignerSamOut=None, sizeHint=None):
+        """AlignService starts to run.
+            Input:
+                alignerSamOut: a registered file (e.g. a named pipe) to
+                               which the aligner writes. If None, register
+                               a new temporary SAM/BAM file.
+                sizeHint     : expected bytes of the new temporary file.
+        """
         logging.info(self.name + ": Align reads to references using " +
                      "{prog}.".format(prog=self.progName))
         # Prepare inputs for the aligner.
@@ -185,11 +223,13 @@ class AlignService (Service):
             self._tempFileManager,
             self._fileNames.isWithinRepository)
 
-        outFormat = getFileFormat(self._fileNames.outputFileName)
-        suffix = ".bam" if (outFormat == FILE_FORMATS.BAM or
-                            outFormat == FILE_FORMATS.XML) else ".sam"
-        self._fileNames.alignerSamOut = self._tempFileManager.\
-            RegisterNewTmpFile(suffix=suffix)
+        if alignerSamOut is None:
+            outFormat = getFileFormat(self._fileNames.outputFileName)
+            suffix = ".bam" if (outFormat == FILE_FORMATS.BAM or
+                                outFormat == FILE_FORMATS.XML) else ".sam"
+            alignerSamOut = self._tempFileManager.\
+                RegisterNewTmpFile(suffix=suffix, sizeHint=sizeHint)
+        self._fileNames.alignerSamOut = alignerSamOut
 
         # Generate and execute cmd.
         try:
@@ -36,8 +36,13 @@
 from __future__ import absolute_import
 from pbalign.alignservice.align import AlignService
 from pbalign.utils.fileutil import FILE_FORMATS, real_upath, getFileFormat
+from pbalign.utils.sacache import SuffixArrayCache, SA_LOOKUP_TABLE_SIZE
 import logging
 
+# Number of hits of each read blasr outputs if --maxHits (blasr --bestn) is
+# not given.
+BLASR_DEFAULT_BESTN = 10
+
 
 class BlasrService(AlignService):
     """Class BlasrService calls blasr to align reads."""
@@ -57,6 +62,45 @@ class BlasrService(AlignService):
         """score sign for blasr is -1, the lower the better."""
         return -1
 
+    def __init__(self, options, fileNames, tempFileManager=None):
+        """Initialize a BlasrService object, and use a cached suffix array
+        if the reference has none."""
+        super(BlasrService, self).__init__(options, fileNames,
+                                           tempFileManager)
+        self.cacheSuffixArray(build=False)
+
+    def _lookupTableSize(self):
+        """Return the lookup table size of a suffix array which works with
+        blasr -minMatch."""
+        minMatch = self._options.minAnchorSize
+        if minMatch is None or minMatch == "":
+            return SA_LOOKUP_TABLE_SIZE
+        return min(SA_LOOKUP_TABLE_SIZE, int(minMatch))
+
+    def cacheSuffixArray(self, build=True):
+        """If the reference has no suffix array, use its suffix array in
+        --suffixArrayCacheDir. If build is True and it is not cached, build
+        it with sawriter first. Run without a cached suffix array if the
+        cache dir can not be used."""
+        cacheDir = self._options.suffixArrayCacheDir
+        if cacheDir is None or \
+           self._fileNames.sawriterFileName not in (None, ""):
+            return
+        fastaFile = self._fileNames.targetFileName
+        try:
+            cache = SuffixArrayCache(cacheDir)
+            saFile = cache.build(fastaFile, self._lookupTableSize()) \
+                if build else cache.get(fastaFile, self._lookupTableSize())
+        except (IOError, OSError) as e:
+            logging.warning(self.name + ": Could not use suffix array " +
+                            "cache dir {d}, run without a suffix array: {e}".
+                            format(d=cacheDir, e=str(e)))
+            return
+        if saFile is not None:
+            logging.info(self.name + ": Use cached suffix array {s}".format(
+                s=saFile))
+            self._fileNames.sawriterFileName = saFile
+
     def __parseAlgorithmOptionItems(self, optionstr):
         """Given a string of algorithm options, reconstruct option items.
         First, split the string by white space, then reconstruct path with
@@ -231,7 +275,7 @@ class BlasrService(AlignService):
         """
         cmdStr = "blasr {queryFile} {targetFile} --out {outFile} ".format(
             queryFile=fileNames.queryFileName,
-            targetFile=fileNames.targetFileName,
+            targetFile=fileNames.StagedFileName(fileNames.targetFileName),
             outFile=fileNames.alignerSamOut)
 
         if getFileFormat(fileNames.alignerSamOut) == FILE_FORMATS.BAM:
@@ -242,7 +286,7 @@ class BlasrService(AlignService):
         if ((fileNames.sawriterFileName is not None) and
                 (fileNames.sawriterFileName != "")):
             cmdStr += " --sa {sawriter} ".format(
-                sawriter=fileNames.sawriterFileName)
+                sawriter=fileNames.StagedFileName(fileNames.sawriterFileName))
 
         if ((fileNames.regionTable != "") and
                 (fileNames.regionTable is not None)):
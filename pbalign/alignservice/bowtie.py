@@ -36,7 +36,8 @@
 from __future__ import absolute_import
 from pbalign.alignservice.fastabasedalign import FastaBasedAlignService
 from os import path
-from pbcore.util.Process import backticks
+from pbalign.utils.progutil import Execute
+from pbalign.utils.fileutil import isExist
 import logging
 
 
@@ -183,16 +184,21 @@ class BowtieService(FastaBasedAlignService):
             format(referenceFile, refBaseName)
 
         logging.info(self.name + ": Build bowtie2 index files.")
-        logging.debug(self.name + ": Call {0}".format(cmdStr))
 
-        _output, errCode, errMsg = backticks(cmdStr)
-        if (errCode != 0):
+        try:
+            Execute(self.name, cmdStr)
+        except RuntimeError as e:
             logging.error(self.name + ": Failed to build bowtie2 " +
-                          "index files.\n" + errMsg)
-            raise RuntimeError(errMsg)
+                          "index files.\n" + str(e))
+            raise
 
         return bt2IndexFiles(refBaseName)
 
+    def prepareReference(self):
+        """Build bt2 index files under self._fileNames.referenceIndexDir."""
+        self._bt2BuildIndex(self._fileNames.referenceIndexDir,
+                            self._fileNames.targetFileName)
+
     def _preProcess(self, inputFileName, referenceFile, regionTable,
                     noSplitSubreads, tempFileManager, isWithinRepository):
         """Preprocess inputs and pre-build reference index files for bowtie2.
@@ -212,13 +218,17 @@ class BowtieService(FastaBasedAlignService):
                 String, a FASTA file which can be used by bowtie2.
 
         """
-        # Build bt2 index files and return files that have been built.
-        indexFiles = self._bt2BuildIndex(tempFileManager.defaultRootDir,
-                                         referenceFile)
-
-        # Register bt2 index files in the temporary file manager.
-        for indexFile in indexFiles:
-            tempFileManager.RegisterExistingTmpFile(indexFile, own=True)
+        # Reuse bt2 index files built by prepareReference() if any.
+        # Otherwise, build bt2 index files in the temporary directory, and
+        # register them in the temporary file manager.
+        indexDir = self._fileNames.referenceIndexDir
+        if indexDir is None or not all(isExist(indexFile) for indexFile in
+                bt2IndexFiles(bt2BaseName(indexDir, referenceFile))):
+            self._fileNames.referenceIndexDir = None
+            indexFiles = self._bt2BuildIndex(tempFileManager.defaultRootDir,
+                                             referenceFile)
+            for indexFile in indexFiles:
+                tempFileManager.RegisterExistingTmpFile(indexFile, own=True)
 
         # Return a FASTA file that can be used by bowtie2 directly.
         return self._pls2fasta(inputFileName, regionTable, noSplitSubreads)
@@ -250,8 +260,10 @@ class BowtieService(FastaBasedAlignService):
         if options.seed is not None and options.seed != "":
             cmdStr += " --seed {seed} ".format(seed=options.seed)
 
-        refBaseName = bt2BaseName(tempFileManager.defaultRootDir,
-                                  fileNames.targetFileName)
+        indexDir = fileNames.referenceIndexDir
+        if indexDir is None:
+            indexDir = tempFileManager.defaultRootDir
+        refBaseName = bt2BaseName(indexDir, fileNames.targetFileName)
         cmdStr += "-x {refBase} -f {queryFile} -S {outFile} ".\
             format(refBase=refBaseName,
                    queryFile=fileNames.queryFileName,
@@ -35,9 +35,10 @@ align."""
 
 # Author: Yuan Li
 from __future__ import absolute_import
+from os import path
 from pbalign.alignservice.align import AlignService
 from pbalign.utils.fileutil import getFileFormat, FILE_FORMATS
-from pbcore.util.Process import backticks
+from pbalign.utils.progutil import Execute
 import logging
 
 
@@ -74,14 +75,22 @@ class FastaBasedAlignService(AlignService):
 
         logging.info(self.name + ": Convert {inFile} to FASTA format.".
                      format(inFile=inputFileName))
-        logging.debug(self.name + ": Call \"{cmd}\"".format(cmd=cmdStr))
 
-        _output, errCode, errMsg = backticks(cmdStr)
-        if errCode != 0:
-            errMsg += "Failed to convert {i} to {o}.".format(
+        try:
+            Execute(self.name, cmdStr)
+        except RuntimeError as e:
+            errMsg = str(e) + "Failed to convert {i} to {o}.".format(
                       i=inputFileName, o=outFastaFile)
             logging.error(errMsg)
             raise RuntimeError(errMsg)
 
         # Return the converted FASTA file which can be used by an aligner.
         return outFastaFile
+
+    def plannedQueryFileName(self):
+        """Return the FASTA file which _pls2fasta() would create, without
+        converting anything."""
+        if getFileFormat(self._fileNames.inputFileName) == \
+                FILE_FORMATS.FASTA:
+            return self._fileNames.inputFileName
+        return path.join(self._tempFileManager.defaultRootDir, "query.fasta")
@@ -37,8 +37,10 @@ from __future__ import absolute_import
 from os import path
 from pbalign.alignservice.fastabasedalign import FastaBasedAlignService
 from pbalign.utils.fileutil import isExist
-from pbcore.util.Process import backticks
+from pbalign.utils.progutil import Execute
 from time import sleep
+import errno
+import os
 from random import randint
 import logging
 
@@ -197,19 +199,19 @@ class GMAPService(FastaBasedAlignService):
 
     def _releaseLock(self, dbLock):
         """Release dbLock."""
-        _o, errCode, _m = backticks("rm -f {dbLock}".format(dbLock=dbLock))
-        if errCode == 0:
-            logging.debug(self.name + ": Release the lock for DB creation.")
-        else:
-            raise RuntimeError(self.name + ": Failed to release lock " +
-                               dbLock + ". Please delete the lock manually.")
-
-    def _gmapCreateDB(self, referenceFile, isWithinRepository, tempRootDir):
-        """
-        Create gmap database for reference sequences if no DB exists.
-        Wait for gmap DB to be created if gmap_db.lock exists.
-        return (gmap_DB_root_path, gmap_DB_name).
-        """
+        try:
+            os.remove(dbLock)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise RuntimeError(self.name + ": Failed to release lock " +
+                                   dbLock + ". Please delete the lock " +
+                                   "manually.")
+        logging.debug(self.name + ": Release the lock for DB creation.")
+
+    def _gmapDBLocation(self, referenceFile, isWithinRepository,
+                        tempRootDir, indexDir=None):
+        """Return (gmap_DB_root_path, gmap_DB_name) of the gmap database
+        of referenceFile."""
         # Determine dbRoot according to whether the reference file is wihtin
         # a reference repository.
         if isWithinRepository:
@@ -222,10 +224,28 @@ class GMAPService(FastaBasedAlignService):
             # --------reference.info.xml
             dbRoot = path.split(path.dirname(referenceFile))[0]
             dbName = "gmap_db"
+        elif indexDir is not None:
+            # If the reference index dir is shared, so is the gmap_db.
+            dbRoot = indexDir
+            dbName = "gmap_db"
         else: # Otherwise, create gmap_db under the tempRootDir, and give the
             # gmap DB a random name
             dbRoot = tempRootDir
             dbName = "gmap_db_{sfx}".format(sfx=randint(100000, 1000000))
+        return (dbRoot, dbName)
+
+    def _gmapCreateDB(self, referenceFile, isWithinRepository, tempRootDir,
+                      indexDir=None):
+        """
+        Create gmap database for reference sequences if no DB exists.
+        Wait for gmap DB to be created if gmap_db.lock exists.
+        If indexDir is not None, create (or reuse) a DB shared by all runs
+        against this reference under indexDir instead of tempRootDir.
+        return (gmap_DB_root_path, gmap_DB_name).
+        """
+        (dbRoot, dbName) = self._gmapDBLocation(referenceFile,
+                                                isWithinRepository,
+                                                tempRootDir, indexDir)
 
         dbPath = path.join(dbRoot, dbName)
         dbLock = dbPath + ".lock"
@@ -245,13 +265,14 @@ class GMAPService(FastaBasedAlignService):
         # Create DB if it does not exist
         if not isExist(dbPath):
             # Touch the lock file
-            _output, errCode, errMsg = backticks("touch {dbLock}".format(
-                dbLock=dbLock))
             logging.debug(self.name + ": Create a lock when GMAP DB is " +
                           "being built.")
-            if (errCode != 0):
-                logging.error(self.name + ": Failed to create {dbLock}.\n" +
-                              errMsg)
+            try:
+                open(dbLock, 'a').close()
+            except (IOError, OSError) as e:
+                errMsg = str(e)
+                logging.error(self.name + ": Failed to create {dbLock}.\n".
+                              format(dbLock=dbLock) + errMsg)
                 self._releaseLock(dbLock)
                 raise RuntimeError(errMsg)
 
@@ -259,13 +280,13 @@ class GMAPService(FastaBasedAlignService):
                 inFa=referenceFile))
             cmdStr = "gmap_build -k 12 --db={dbName} --dir={dbRoot} {inFa}".\
                 format(dbName=dbName, dbRoot=dbRoot, inFa=referenceFile)
-            _output, errCode, errMsg = backticks(cmdStr)
-            logging.debug(self.name + ": Call {cmdStr}".format(cmdStr=cmdStr))
-            if (errCode != 0):
+            try:
+                Execute(self.name, cmdStr)
+            except RuntimeError as e:
                 logging.error(self.name + ": Failed to build GMAP db.\n" +
-                              errMsg)
+                              str(e))
                 self._releaseLock(dbLock)
-                raise RuntimeError(errMsg)
+                raise
 
             # Delete the lock file to notify others pbalign who are waiting
             # for this DB to be created.
@@ -273,6 +294,12 @@ class GMAPService(FastaBasedAlignService):
 
         return (dbRoot, dbName)
 
+    def prepareReference(self):
+        """Create gmap DB under self._fileNames.referenceIndexDir."""
+        self._gmapCreateDB(self._fileNames.targetFileName,
+                           self._fileNames.isWithinRepository, None,
+                           indexDir=self._fileNames.referenceIndexDir)
+
     def _preProcess(self, inputFileName, referenceFile, regionTable,
                     noSplitSubreads, tempFileManager, isWithinRepository):
         """Preprocess inputs and pre-build reference index files for gmap.
@@ -290,12 +317,14 @@ class GMAPService(FastaBasedAlignService):
                 String, a FASTA read file which can be used by gmap.
         """
         # Create a gmap database, update gmap DB root path and db name.
+        indexDir = self._fileNames.referenceIndexDir
         (self.dbRoot, self.dbName) = self._gmapCreateDB(referenceFile,
-                isWithinRepository, tempFileManager.defaultRootDir)
+                isWithinRepository, tempFileManager.defaultRootDir,
+                indexDir=indexDir)
 
-        # DO NOT delete gmap_db if it is within a reference repository;
-        # otherwise, delete it.
-        if not isWithinRepository:
+        # DO NOT delete gmap_db if it is within a reference repository or
+        # a shared reference index dir; otherwise, delete it.
+        if not isWithinRepository and indexDir is None:
             tempFileManager.RegisterExistingTmpFile(path.join(self.dbRoot,
                 self.dbName), own=True, isDir=True)
 
@@ -305,3 +334,15 @@ class GMAPService(FastaBasedAlignService):
     def _postProcess(self):
         """ Postprocess after alignment is done. """
         logging.debug(self.name + ": Postprocess after alignment is done. ")
+
+    def plannedCmd(self, queryFileName, alignerSamOut, nproc=None):
+        """Return the gmap command line which run() would execute, using the
+        gmap database which _preProcess() would create."""
+        if self.dbRoot is None:
+            (self.dbRoot, self.dbName) = self._gmapDBLocation(
+                self._fileNames.targetFileName,
+                self._fileNames.isWithinRepository,
+                self._tempFileManager.defaultRootDir,
+                indexDir=self._fileNames.referenceIndexDir)
+        return super(GMAPService, self).plannedCmd(queryFileName,
+                                                   alignerSamOut, nproc)
@@ -30,9 +30,10 @@
 ###############################################################################
 
 """This script defines BamPostService, which
-   * calls 'samtools sort' to sort out.bam, and
+   * calls 'samtools sort' to sort out.bam, or
+   * calls 'samtools merge' to merge sorted bam files of shards, and
    * calls 'samtools index' to make out.bai index, and
-   * calls 'makePbi.py' to make out.pbi index file.
+   * calls 'pbindex' to make out.pbi index file, concurrently.
 """
 
 # Author: Yuan Li
@@ -40,7 +41,10 @@
 from __future__ import absolute_import
 import logging
 from pbalign.service import Service
-from pbalign.utils.progutil import Execute
+from pbalign.utils.progutil import Execute, ExecuteInBackground
+from pbalign.utils.checkpoint import Checkpoint
+from pbalign.utils.resourceutil import MAX_SORT_MEMORY
+from pbalign.utils.toolregistry import Tools
 
 
 class BamPostService(Service):
@@ -59,10 +63,16 @@ class BamPostService(Service):
     def cmd(self):
         return ""
 
-    def __init__(self, filenames, nproc=1):
+    def __init__(self, filenames, nproc=1, sortMemory=MAX_SORT_MEMORY,
+                 indexConcurrency=2, compressionLevel=None):
         """Initialize a BamPostService object.
             Input - unsortedBamFile: a filtered, unsorted bam file
                     refFasta : a reference fasta file
+                    nproc : number of 'samtools sort/merge' threads
+                    sortMemory : bytes of memory per 'samtools sort' thread
+                    indexConcurrency : number of indexes to build at a time
+                    compressionLevel : compression level (0-9) of the
+                                       sorted bam file, None for default
             Output - sortedBamFile: sorted BAM file
                      outBaiFile: index BAI file
         """
@@ -74,66 +84,191 @@ class BamPostService(Service):
         self.outBaiFile = filenames.outBaiFileName
         self.outPbiFile = filenames.outPbiFileName
         self.nproc = int(nproc)
+        self.sortMemory = int(sortMemory)
+        self.indexConcurrency = int(indexConcurrency)
+        self.compressionLevel = compressionLevel
 
-    def _sortbam(self, unsortedBamFile, sortedBamFile, nproc):
-        """Sort unsortedBamFile and output sortedBamFile."""
+    def _samtoolsCapability(self, flag):
+        """Return a capability flag of samtools, e.g., sortOutputOption,
+        from the tool registry, which asks samtools for its version once
+        per process (or once ever with a tool manifest)."""
+        return Tools().capability("samtools", flag)
+
+    def _compressionOption(self, flag):
+        """Return the option which sets the compression level of output of
+        samtools if both a level and samtools support it, otherwise ''."""
+        if self.compressionLevel is None or \
+           not self._samtoolsCapability(flag):
+            return ""
+        return " -l {n}".format(n=self.compressionLevel)
+
+    def _sortcmd(self, unsortedBamFile, sortedBamFile, nproc, byName=False):
+        """Return a command line which sorts unsortedBamFile (by read name
+        if byName) and outputs sortedBamFile."""
         if not sortedBamFile.endswith(".bam"):
             raise ValueError("sorted bam file name %s must end with .bam" %
                              sortedBamFile)
         sortedPrefix = sortedBamFile[0:-4]
-        cmd = 'samtools --version||true'
-        _samtoolsversion = ["0","1","19"]
-        try:
-            _out, _code, _msg = Execute(self.name, cmd)
-            if "samtools" in _out[0]:
-                _samtoolsversion = str(_out[0][8:]).strip().split('.')
-            else:
-                pass
-        except Exception:
-            pass
-        _stvmajor = int(_samtoolsversion[0])
-        if _stvmajor >= 1:
-            cmd = 'samtools sort --threads {t} -m 4G -o {sortedBamFile} {unsortedBamFile}'.format(
-                t=nproc, sortedBamFile=sortedBamFile, unsortedBamFile=unsortedBamFile)
+        mem = "{m}M".format(m=self.sortMemory >> 20)
+        level = self._compressionOption("sortCompressionLevel")
+        if byName:
+            level += " -n"
+        if self._samtoolsCapability("sortOutputOption"):
+            cmd = 'samtools sort --threads {t} -m {m}{l} -o {sortedBamFile} {unsortedBamFile}'.format(
+                t=nproc, m=mem, l=level, sortedBamFile=sortedBamFile, unsortedBamFile=unsortedBamFile)
         else:
-            cmd = 'samtools sort --threads {t} -m 4G {unsortedBamFile} {prefix}'.format(
-                t=nproc, unsortedBamFile=unsortedBamFile, prefix=sortedPrefix)
-        Execute(self.name, cmd)
-
-    def _makebai(self, sortedBamFile, outBaiFile):
-        """Build *.bai index file."""
-        cmd = 'samtools --version'
-        _samtoolsversion = ["0","1","19"]
-        try:
-            _out, _code, _msg = Execute(self.name, cmd)
-            if "samtools" in _out[0]:
-                _samtoolsversion = str(_out[0][8:]).strip().split('.')
-            else:
-                pass
-        except Exception:
-            pass
-        _stvmajor = int(_samtoolsversion[0])
-        _stvminor = int(_samtoolsversion[1])
-        if _stvmajor == 1 and _stvminor == 2:
-            # only for 1.2
-            cmd = "samtools index {sortedBamFile}".format(
-                sortedBamFile=sortedBamFile)
+            cmd = 'samtools sort --threads {t} -m {m}{l} {unsortedBamFile} {prefix}'.format(
+                t=nproc, m=mem, l=level, unsortedBamFile=unsortedBamFile, prefix=sortedPrefix)
+        return cmd
+
+    def _sortbam(self, unsortedBamFile, sortedBamFile, nproc, byName=False):
+        """Sort unsortedBamFile and output sortedBamFile."""
+        Execute(self.name, self._sortcmd(unsortedBamFile, sortedBamFile,
+                                         nproc, byName))
+
+    def _mergecmd(self, sortedBamFiles, outBamFile, nproc, byName=False):
+        """Return a command line which merges sorted bam files (sorted by
+        read name if byName) into one sorted bam file."""
+        level = self._compressionOption("mergeCompressionLevel")
+        if byName:
+            level += " -n"
+        if self._samtoolsCapability("mergeThreads"):
+            cmd = 'samtools merge -f -@ {t}{l} {outBamFile} {inBamFiles}'.format(
+                t=nproc, l=level, outBamFile=outBamFile,
+                inBamFiles=" ".join(sortedBamFiles))
         else:
+            cmd = 'samtools merge -f{l} {outBamFile} {inBamFiles}'.format(
+                l=level, outBamFile=outBamFile,
+                inBamFiles=" ".join(sortedBamFiles))
+        return cmd
+
+    def _mergebam(self, sortedBamFiles, outBamFile, nproc, byName=False):
+        """Merge sorted bam files into one sorted bam file."""
+        Execute(self.name, self._mergecmd(sortedBamFiles, outBamFile, nproc,
+                                          byName))
+
+    def _baicmd(self, sortedBamFile, outBaiFile):
+        """Return a command line which builds *.bai index file."""
+        if self._samtoolsCapability("indexOutputArgument"):
             cmd = "samtools index {sortedBamFile} {outBaiFile}".format(
                 sortedBamFile=sortedBamFile, outBaiFile=outBaiFile)
-        Execute(self.name, cmd)
+        else:
+            # only for 1.2
+            cmd = "samtools index {sortedBamFile}".format(
+                sortedBamFile=sortedBamFile)
+        return cmd
 
-    def _makepbi(self, sortedBamFile):
-        """Generate *.pbi PacBio BAM index."""
-        cmd = "pbindex %s" % sortedBamFile
-        Execute(self.name, cmd)
+    def _pbicmd(self, sortedBamFile):
+        """Return a command line which generates *.pbi PacBio BAM index."""
+        return "pbindex %s" % sortedBamFile
 
-    def run(self):
-        """ Run the BAM post-processing service. """
-        logging.info(self.name + ": Sort and build index for a bam file.")
+    def _makeindexes(self, checkpoint):
+        """Build *.bai and *.pbi index files concurrently, since both only
+        read the sorted bam file, at most self.indexConcurrency at a time.
+        Skip indexes which have been done, mark each index done as soon as
+        it is built, and report their times."""
+        indexers = []
+        if not checkpoint.isDone("bai"):
+            indexers.append(("bai", self.outBaiFile, ExecuteInBackground(
+                self.name, self._baicmd(sortedBamFile=self.outBamFile,
+                                        outBaiFile=self.outBaiFile))))
+        if not checkpoint.isDone("pbi"):
+            indexers.append(("pbi", self.outPbiFile, ExecuteInBackground(
+                self.name, self._pbicmd(sortedBamFile=self.outBamFile))))
+        for _stage, _outFile, indexer in indexers[0:self.indexConcurrency]:
+            indexer.start()
+
+        errors = []
+        for i, (stage, outFile, indexer) in enumerate(indexers):
+            if i >= self.indexConcurrency:
+                indexer.start()
+            try:
+                indexer.wait()
+            except RuntimeError as e:
+                errors.append(str(e))
+                continue
+            logging.info(self.name + ": Built {s} index in {t:.2f} s.".format(
+                s=stage, t=indexer.elapsedTime))
+            checkpoint.markDone(stage, [outFile])
+        if len(errors) > 0:
+            raise RuntimeError("\n".join(errors))
+
+    def plannedCmds(self, isSorted=False, sortedBamFiles=None):
+        """Return a list of (stage, command line) which would be executed
+        to merge sortedBamFiles (if it is not None) or sort the unsorted
+        bam file (unless isSorted), and to build indexes."""
+        cmds = []
+        if sortedBamFiles is not None:
+            cmds.append(("merge", self._mergecmd(sortedBamFiles,
+                                                 self.outBamFile,
+                                                 self.nproc)))
+        elif not isSorted:
+            cmds.append(("sort", self._sortcmd(self.unsortedBamFile,
+                                               self.outBamFile,
+                                               self.nproc)))
+        cmds.append(("bai", self._baicmd(self.outBamFile, self.outBaiFile)))
+        cmds.append(("pbi", self._pbicmd(self.outBamFile)))
+        return cmds
+
+    def plannedMergeByNameCmds(self, bamFiles, sortedBamFiles, outBamFile):
+        """Return a list of (stage, command line) which mergeByName() would
+        execute."""
+        cmds = [("sort", self._sortcmd(bamFile, sortedBamFile, self.nproc,
+                                       byName=True))
+                for bamFile, sortedBamFile in zip(bamFiles, sortedBamFiles)]
+        cmds.append(("merge", self._mergecmd(sortedBamFiles, outBamFile,
+                                             self.nproc, byName=True)))
+        return cmds
+
+    def startSort(self):
+        """Start sorting the unsorted bam file on a background thread, and
+        return an ExecuteInBackground object. This allows the unsorted bam
+        file to be a named pipe which is being written by an aligner."""
+        logging.info(self.name + ": Sort a bam file in background.")
+        sorter = ExecuteInBackground(self.name, self._sortcmd(
+            unsortedBamFile=self.unsortedBamFile,
+            sortedBamFile=self.outBamFile,
+            nproc=self.nproc))
+        sorter.start()
+        return sorter
+
+    def sort(self):
+        """Sort the unsorted bam file without building any index."""
         self._sortbam(unsortedBamFile=self.unsortedBamFile,
                       sortedBamFile=self.outBamFile,
                       nproc=self.nproc)
-        self._makebai(sortedBamFile=self.outBamFile,
-                      outBaiFile=self.outBaiFile)
-        self._makepbi(sortedBamFile=self.outBamFile)
+
+    def merge(self, sortedBamFiles):
+        """Merge sorted bam files (e.g., sorted alignments of shards) into
+        the output bam file, which can then be indexed by
+        run(isSorted=True)."""
+        logging.info(self.name + ": Merge {n} sorted bam files.".format(
+            n=len(sortedBamFiles)))
+        self._mergebam(sortedBamFiles=sortedBamFiles,
+                       outBamFile=self.outBamFile,
+                       nproc=self.nproc)
+
+    def mergeByName(self, bamFiles, sortedBamFiles, outBamFile):
+        """Sort each of bamFiles (e.g., alignments against chunks of a
+        reference) by read name into sortedBamFiles, then merge them into
+        outBamFile, in which all alignments of a read are adjacent."""
+        logging.info(self.name + ": Merge {n} bam files by read name.".format(
+            n=len(bamFiles)))
+        for bamFile, sortedBamFile in zip(bamFiles, sortedBamFiles):
+            self._sortbam(bamFile, sortedBamFile, self.nproc, byName=True)
+        self._mergebam(sortedBamFiles, outBamFile, self.nproc, byName=True)
+
+    def run(self, isSorted=False, checkpoint=None):
+        """ Run the BAM post-processing service.
+            Input - isSorted: True if the output bam has already been
+                              sorted, e.g. by startSort() or merge().
+                    checkpoint: a Checkpoint object, skip stages (sort, bai
+                                and pbi) which have been done.
+        """
+        logging.info(self.name + ": Sort and build index for a bam file.")
+        if checkpoint is None:
+            checkpoint = Checkpoint(None, None, enabled=False)
+        if not isSorted and not checkpoint.isDone("sort"):
+            self.sort()
+            checkpoint.markDone("sort", [self.outBamFile])
+        self._makeindexes(checkpoint)
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+###############################################################################
+# Copyright (c) 2011-2013, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+###############################################################################
+
+"""Align many read sets against one reference in a single invocation.
+
+Usage: pbalign_batch [--jobs N] [--nproc N] manifest referencePath
+                     [pbalign options]
+
+Each line of the manifest is an input read file and an output file,
+separated by tabs or white spaces. Lines starting with '#' are ignored.
+The reference is resolved, aligner availability is checked and reference
+index files (e.g., bowtie2 index files or a GMAP DB) are built only once,
+then jobs are run simultaneously, with nproc/jobs threads each.
+
+Each job runs in its own child process, so that process-wide settings
+(e.g., --stageTimeout, --outputLogDir and --toolManifest) and resource
+usages recorded for --resourceReport are not shared by concurrent jobs.
+"""
+
+from __future__ import absolute_import
+import argparse
+import logging
+import multiprocessing
+import os.path as op
+import Queue
+import sys
+import threading
+from copy import copy
+
+from pbcommand.utils import setup_log
+from pbcore.io import AlignmentSet
+
+from pbalign.__init__ import get_version
+from pbalign.options import get_contract_parser
+from pbalign.pbalignfiles import PBAlignFiles
+from pbalign.pbalignrunner import PBAlignRunner
+from pbalign.utils.tempfileutil import TempFileManager
+from pbalign.utils.referencecache import ConfigureReferenceCache
+from pbalign.utils.fileutil import real_ppath
+from pbalign.utils.progutil import ResetResourceUsages
+
+# The number of threads with which an aligner scales well.
+THREADS_PER_JOB = 16
+
+# Seconds between checks whether job processes have died.
+JOB_POLL_INTERVAL = 1
+
+
+class SharedReference(object):
+    """A reference which is resolved once and shared by many pbalign runs.
+    Reference index files of each aligner are built only once, under an
+    index directory shared by all runs."""
+    def __init__(self, referencePath, indexDir):
+        self.referencePath = referencePath
+        self.fileNames = PBAlignFiles(referencePath=referencePath)
+        self.fileNames.referenceIndexDir = indexDir
+        self._preparedAlgorithms = set()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "SharedReference({r}, index dir = {d})".format(
+            r=self.referencePath, d=self.fileNames.referenceIndexDir)
+
+    def newRunner(self, args, output_dataset_type=AlignmentSet):
+        """Return a PBAlignRunner for args, which starts with a copy of the
+        resolved reference. Build reference index files of args.algorithm
+        if they have not been built."""
+        runner = PBAlignRunner(args, output_dataset_type=output_dataset_type,
+                               fileNames=copy(self.fileNames))
+        with self._lock:
+            if args.algorithm not in self._preparedAlgorithms:
+                runner.prepareReference()
+                self._preparedAlgorithms.add(args.algorithm)
+        return runner
+
+    def files(self):
+        """Return reference files and index files used by aligners."""
+        fileNames = self.fileNames
+        files = [real_ppath(f) for f in (fileNames.targetFileName,
+                                         fileNames.sawriterFileName,
+                                         fileNames.adapterGffFileName)
+                 if f is not None]
+        if fileNames.isWithinRepository:
+            repoDir = op.split(op.dirname(real_ppath(
+                fileNames.targetFileName)))[0]
+            files.append(op.join(repoDir, "gmap_db"))
+        files.append(fileNames.referenceIndexDir)
+        return files
+
+
+def readManifest(manifestFile):
+    """Read a manifest and return a list of (input, output) pairs."""
+    pairs = []
+    with open(manifestFile, 'r') as f:
+        for lineNo, line in enumerate(f, 1):
+            line = line.strip()
+            if line == "" or line.startswith("#"):
+                continue
+            items = line.split("\t") if "\t" in line else line.split()
+            items = [item.strip() for item in items if item.strip() != ""]
+            if len(items) != 2:
+                errMsg = "Line {n} of manifest {f} must contain an input " \
+                         "and an output file.".format(n=lineNo, f=manifestFile)
+                logging.error(errMsg)
+                raise ValueError(errMsg)
+            pairs.append((items[0], items[1]))
+    if len(pairs) == 0:
+        errMsg = "Manifest {f} is empty.".format(f=manifestFile)
+        logging.error(errMsg)
+        raise ValueError(errMsg)
+    return pairs
+
+
+def get_parser():
+    """Return the argument parser of batch options. All unknown options
+    are passed to pbalign for every job."""
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--version", action="version", version=get_version())
+    parser.add_argument("manifest", type=str,
+                        help="A manifest of (input, output) pairs.")
+    parser.add_argument("referencePath", type=str,
+                        help="Reference DataSet, FASTA file or repository.")
+    parser.add_argument("--nproc", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="Total number of threads of all jobs.")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="Number of jobs to run simultaneously. " +
+                        "Default is nproc/{n}.".format(n=THREADS_PER_JOB))
+    return parser
+
+
+def _runJob(runner):
+    """Run a PBAlignRunner and return (output file, error message)."""
+    try:
+        runner.run()
+        return runner.args.outputFileName, None
+    except Exception as e:
+        logging.error("Failed to align {i}: {e}".format(
+            i=runner.args.inputFileName, e=str(e)))
+        return runner.args.outputFileName, str(e)
+
+
+def _runJobInChild(index, runner, resultQueue):
+    """Run a PBAlignRunner in a child process, wait for its temporary files
+    to be deleted, and put (index, error message) to resultQueue."""
+    ResetResourceUsages()
+    _outFile, errMsg = _runJob(runner)
+    cleanUpErrors = runner.waitForCleanUp()
+    if len(cleanUpErrors) > 0:
+        logging.warning("{n} temporary files of {i} were not deleted.".format(
+            n=len(cleanUpErrors), i=runner.args.inputFileName))
+    resultQueue.put((index, errMsg))
+
+
+def _queuedResults(resultQueue):
+    """Return all results in resultQueue without waiting."""
+    results = []
+    while True:
+        try:
+            results.append(resultQueue.get_nowait())
+        except Queue.Empty:
+            return results
+
+
+def runJobs(runners, jobs):
+    """Run PBAlignRunners, each in its own child process and at most jobs
+    at a time. Return a list of error messages, None for jobs which
+    succeeded, in the order of runners."""
+    resultQueue = multiprocessing.Queue()
+    errors = [None] * len(runners)
+    pending = list(enumerate(runners))
+    running = {}
+    while len(pending) > 0 or len(running) > 0:
+        while len(pending) > 0 and len(running) < jobs:
+            index, runner = pending.pop(0)
+            process = multiprocessing.Process(
+                target=_runJobInChild, args=(index, runner, resultQueue))
+            process.start()
+            running[index] = process
+        try:
+            results = [resultQueue.get(timeout=JOB_POLL_INTERVAL)]
+        except Queue.Empty:
+            results = []
+        dead = [index for index, process in running.items()
+                if not process.is_alive()]
+        if len(dead) > 0:
+            # Results of job processes which have exited are queued before
+            # they exit.
+            results.extend(_queuedResults(resultQueue))
+        for index, errMsg in results:
+            errors[index] = errMsg
+            running.pop(index).join()
+        for index in dead:
+            if index not in running:
+                continue
+            # A job process which died without a result, e.g., killed.
+            process = running.pop(index)
+            process.join()
+            errors[index] = "pbalign job {i} exited with code {c} " \
+                "without a result.".format(
+                    i=runners[index].args.inputFileName, c=process.exitcode)
+            logging.error(errors[index])
+    return errors
+
+
+def run_batch(pairs, referencePath, pbalignArgs, nproc, jobs=None):
+    """Align (input, output) pairs against referencePath, and return the
+    number of failed jobs.
+        Input:
+            pairs       : a list of (input, output) pairs
+            referencePath: the reference shared by all jobs
+            pbalignArgs : a list of pbalign options for every job
+            nproc       : total number of threads of all jobs
+            jobs        : number of jobs to run simultaneously
+    """
+    if jobs is None:
+        jobs = max(1, nproc // THREADS_PER_JOB)
+    jobs = max(1, min(jobs, len(pairs)))
+    jobNproc = max(1, nproc // jobs)
+    logging.info("Align {n} read sets against {r} by {j} simultaneous jobs "
+                 "with {t} threads each.".format(n=len(pairs), r=referencePath,
+                                                 j=jobs, t=jobNproc))
+
+    # Parse options of all jobs first, so that bad options fail early.
+    parser = get_contract_parser().arg_parser.parser
+    argsList = [parser.parse_args([inFile, referencePath, outFile] +
+                                  list(pbalignArgs) +
+                                  ["--nproc", str(jobNproc)])
+                for inFile, outFile in pairs]
+
+    # Resolve the reference once, and build reference index files in a
+    # directory shared by all jobs.
+    ConfigureReferenceCache(cacheDir=argsList[0].referenceCacheDir)
+    tempFileManager = TempFileManager(argsList[0].tmpDir)
+    try:
+        reference = SharedReference(referencePath,
+                                    tempFileManager.RegisterNewTmpFile(
+                                        isDir=True, prefix="reference_index_"))
+        runners = [reference.newRunner(args) for args in argsList]
+        errors = runJobs(runners, jobs)
+    finally:
+        tempFileManager.CleanUp()
+
+    failures = [args.outputFileName for args, errMsg in
+                zip(argsList, errors) if errMsg is not None]
+    for outFile in failures:
+        logging.error("Failed to generate {o}.".format(o=outFile))
+    logging.info("{n} of {m} jobs succeeded.".format(
+        n=len(pairs) - len(failures), m=len(pairs)))
+    return len(failures)
+
+
+def main(argv=sys.argv):
+    """Main function of pbalign_batch."""
+    args, pbalignArgs = get_parser().parse_known_args(argv[1:])
+    setup_log(logging.getLogger(), level=logging.INFO)
+    pairs = readManifest(args.manifest)
+    failures = run_batch(pairs, args.referencePath, pbalignArgs,
+                         nproc=args.nproc, jobs=args.jobs)
+    return 0 if failures == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -29,8 +29,8 @@
 # ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 ###############################################################################
 
-"""This script defines FilterService, which calls samFilter to remove aligments
-in an input SAM file according to filtering criteria."""
+"""This script defines FilterService, which removes aligments in an input SAM
+file according to filtering criteria, in process or by calling samFilter."""
 
 # Author: Yuan Li
 
@@ -38,9 +38,12 @@ from __future__ import absolute_import
 import logging
 from pbalign.service import Service
 from pbalign.utils.fileutil import getFileFormat, FILE_FORMATS, isExist
+from pbalign.utils.alignmentfilter import criteriaFromOptions, \
+    filterAlignments, FilterStats
+from pbalign.utils.adapterindex import LoadAdapterIndex
 
 class FilterService(Service):
-    """ Call samFilter to filter low quality hits and apply multiple hits
+    """ Filter low quality hits and apply multiple hits
     policy. """
     @property
     def name(self):
@@ -54,7 +57,7 @@ class FilterService(Service):
 
     def __init__(self, inSamFile, refFile, outSamFile,
                  alignerName, scoreSign, options,
-                 adapterGffFile=None):
+                 adapterGffFile=None, statsFileName=None):
         """Initialize a FilterService object.
             Input:
                 inSamFile: an input SAM/BAM file
@@ -64,6 +67,9 @@ class FilterService(Service):
                 scoreSign: score sign of the aligner, can be -1 or 1
                 options  : pbalign options
                 adapterGffFile: a GFF file storing all the adapters
+                statsFileName: a JSON file to write filter statistics to
+                               if alignments are filtered in process,
+                               None if not needed
         """
         self.inSamFile = inSamFile # sam|bam
         self.refFile = refFile
@@ -72,6 +78,7 @@ class FilterService(Service):
         self.scoreSign = scoreSign
         self.options = options
         self.adapterGffFile = adapterGffFile
+        self.statsFileName = statsFileName
 
     @property
     def cmd(self):
@@ -144,8 +151,41 @@ class FilterService(Service):
 
         return cmdStr
 
+    @property
+    def inProcess(self):
+        """Whether alignments are filtered in process instead of by
+        samFilter. blasr filters its alignments itself, unless adapter-only
+        hits are to be filtered. Options without filterEngine, which
+        predate the native engine, keep calling samFilter."""
+        return getattr(self.options, "filterEngine", "samFilter") == \
+            "native" and \
+            (self.alignerName != "blasr" or
+             self.options.filterAdapterOnly is True)
+
     def run(self):
         """ Run the filter service. """
+        if self.inProcess:
+            logging.info(self.name + ": Filter alignments in process.")
+            adapterIndex = None
+            if self.options.filterAdapterOnly is True and \
+                isExist(self.adapterGffFile):
+                adapterIndex = LoadAdapterIndex(self.adapterGffFile)
+            stats = FilterStats() if self.statsFileName is not None else None
+            # A filtered bam file is sorted right after.
+            compressionLevel = getattr(self.options,
+                                       "intermediateCompressionLevel", None)
+            filterAlignments(self.inSamFile, self.outSamFile,
+                             criteriaFromOptions(self.options,
+                                                 self.scoreSign),
+                             hitPolicy=self.options.hitPolicy,
+                             seed=self.options.seed,
+                             adapterIndex=adapterIndex, stats=stats,
+                             compressionLevel=compressionLevel)
+            if stats is not None:
+                logging.info(self.name + ": Write filter statistics to " +
+                             "{f}.".format(f=self.statsFileName))
+                stats.write(self.statsFileName)
+            return "", 0, ""
         logging.info(self.name + ": Filter alignments using {0}.".
                      format(self.progName))
         return self._execute()
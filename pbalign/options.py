@@ -74,6 +74,9 @@ ALGORITHM_CANDIDATES = ('blasr', 'bowtie', 'gmap')
 # The first candidate 'randombest' is the default.
 HITPOLICY_CANDIDATES = ('randombest', 'allbest', 'random', 'all', 'leftmost')
 
+# The first candidate 'samFilter' is the default.
+FILTERENGINE_CANDIDATES = ('samFilter', 'native')
+
 # The first candidate 'aligner' is the default.
 SCOREFUNCTION_CANDIDATES = ('alignerscore', 'editdist',
                             #'blasrscore', 'userscore')
@@ -103,6 +106,7 @@ DEFAULT_OPTIONS = {"regionTable": None,
                    "scoreCutoff": None,
                    "hitPolicy": HITPOLICY_CANDIDATES[0],
                    "filterAdapterOnly": False,
+                   "filterEngine": FILTERENGINE_CANDIDATES[0],
                    # Cmp.h5 writer options
                    "readType": "standard",
                    "forQuiver": False,
@@ -110,9 +114,11 @@ DEFAULT_OPTIONS = {"regionTable": None,
                    "byread": False,
                    "metrics": str(",".join(DEFAULT_METRICS)),
                    # Miscellaneous options
-                   "nproc": 8,
+                   "nproc": None,
                    "seed": 1,
-                   "tmpDir": "/tmp"}
+                   "tmpDir": "/tmp",
+                   "stagingCacheSize": 100,
+                   "memoryTmpBudget": 4}
 
 def constructOptionParser(parser, C=Constants, ccs_mode=False):
     """
@@ -227,7 +233,8 @@ def constructOptionParser(parser, C=Constants, ccs_mode=False):
             name="Concordant alignment",
             description="Map subreads of a ZMW to the same genomic location")
 
-    helpstr = "Number of threads."
+    helpstr = "Number of threads. Default is the number of CPUs\n" + \
+              "available to this job, according to its cgroup quota."
     align_group.add_argument("--nproc",
                         type=int,
                         dest="nproc",
@@ -236,6 +243,30 @@ def constructOptionParser(parser, C=Constants, ccs_mode=False):
                         action="store",
                         help=helpstr)
 
+    helpstr = "Split the input dataset into this many shards by ZMW\n" + \
+              "using its .pbi index, align shards simultaneously with\n" + \
+              "nproc/shards threads each, and merge sorted alignments.\n" + \
+              "Only works when blasr outputs a BAM or XML file."
+    align_group.add_argument("--shards",
+                        type=int,
+                        dest="shards",
+                        default=1,
+                        action="store",
+                        help=helpstr)
+
+    helpstr = "Split a reference larger than this many MB into chunks\n" + \
+              "of contigs of at most this size, align reads against\n" + \
+              "one chunk at a time, and apply --hitPolicy and --maxHits\n" + \
+              "to alignments against all chunks. Bounds memory of blasr\n" + \
+              "for large references. Only works when blasr outputs a\n" + \
+              "BAM or XML file."
+    align_group.add_argument("--maxReferenceChunkSize",
+                        type=int,
+                        dest="maxReferenceChunkSize",
+                        default=None,
+                        action="store",
+                        help=helpstr)
+
     align_group.add_argument("--algorithmOptions",
                         type=str,
                         dest="algorithmOptions",
@@ -357,6 +388,35 @@ def constructOptionParser(parser, C=Constants, ccs_mode=False):
                         action="store_true",
                         help=helpstr)
 
+    helpstr = "Specify how alignments are filtered, if the aligner\n" + \
+              "is not blasr or --filterAdapterOnly is specified.\n" + \
+              "  samFilter: call samFilter.\n" + \
+              "  native   : filter in a single thread with pysam,\n" + \
+              "             computing metrics of batches of\n" + \
+              "             alignments with NumPy. It uses one\n" + \
+              "             core whatever --nproc is.\n" + \
+              "Default value is {0}.".format(DEFAULT_OPTIONS["filterEngine"])
+    filter_group.add_argument("--filterEngine",
+                        dest="filterEngine",
+                        type=str,
+                        choices=FILTERENGINE_CANDIDATES,
+                        default=DEFAULT_OPTIONS["filterEngine"],
+                        action="store",
+                        help=helpstr)
+
+    helpstr = "Write numbers of alignments and reads rejected by each\n" + \
+              "filter criterion and histograms of aligned lengths and\n" + \
+              "accuracies to a JSON file next to the output file,\n" + \
+              "named {output prefix}.filter_stats.json. Only works when\n" + \
+              "alignments are filtered by the native filter engine, or\n" + \
+              "hits against reference chunks are merged (see\n" + \
+              "--maxReferenceChunkSize)."
+    filter_group.add_argument("--filterStats",
+                        dest="filterStats",
+                        action="store_true",
+                        default=False,
+                        help=helpstr)
+
     # Output.
     # CMP H5 output has been deprecated, let's hide associated options.
     cmph5_group = parser.add_argument_group("Options for cmp.h5")
@@ -426,7 +486,9 @@ def constructOptionParser(parser, C=Constants, ccs_mode=False):
                         action="store",
                         help=helpstr)
 
-    helpstr = "Specify a directory for saving temporary files.\n"
+    helpstr = "Specify a directory for saving temporary files, or a\n" + \
+              "comma-separated list of directories, of which the first\n" + \
+              "one with enough free space for this run is used.\n"
     misc_group.add_argument("--tmpDir",
                         dest="tmpDir",
                         type=str,
@@ -434,6 +496,155 @@ def constructOptionParser(parser, C=Constants, ccs_mode=False):
                         default=DEFAULT_OPTIONS["tmpDir"],
                         help=helpstr)
 
+    helpstr = "Compression level (0-9) of the output BAM file written\n" + \
+              "by 'samtools sort/merge'. Default is samtools' default."
+    misc_group.add_argument("--compressionLevel",
+                        dest="compressionLevel",
+                        type=int,
+                        choices=range(10),
+                        action="store",
+                        default=None,
+                        help=helpstr)
+
+    helpstr = "Compression level (0-9) of intermediate BAM files\n" + \
+              "which pbalign sorts or merges, i.e., filtered\n" + \
+              "alignments, sorted shards and chunk alignments. Low\n" + \
+              "levels save CPU time spent compressing files which are\n" + \
+              "decompressed right after. Default is samtools' default."
+    misc_group.add_argument("--intermediateCompressionLevel",
+                        dest="intermediateCompressionLevel",
+                        type=int,
+                        choices=range(10),
+                        action="store",
+                        default=None,
+                        help=helpstr)
+
+    helpstr = "If the reference has no suffix array, build one with\n" + \
+              "sawriter in this directory, which is keyed by content of\n" + \
+              "references and shared by pbalign runs, and pass it to\n" + \
+              "blasr."
+    misc_group.add_argument("--suffixArrayCacheDir",
+                        dest="suffixArrayCacheDir",
+                        type=str,
+                        action="store",
+                        default=None,
+                        help=helpstr)
+
+    helpstr = "Write intermediate alignment files to this RAM-backed\n" + \
+              "directory (e.g., /dev/shm) while they fit in\n" + \
+              "--memoryTmpBudget, otherwise to --tmpDir."
+    misc_group.add_argument("--memoryTmpDir",
+                        dest="memoryTmpDir",
+                        type=str,
+                        action="store",
+                        default=None,
+                        help=helpstr)
+
+    helpstr = "Maximum size in GB of intermediate files written to\n" + \
+              "--memoryTmpDir. Twice the estimated size of a file is\n" + \
+              "reserved for it until it is deleted. Default value is {0}.".\
+              format(DEFAULT_OPTIONS["memoryTmpBudget"])
+    misc_group.add_argument("--memoryTmpBudget",
+                        dest="memoryTmpBudget",
+                        type=float,
+                        action="store",
+                        default=DEFAULT_OPTIONS["memoryTmpBudget"],
+                        help=helpstr)
+
+    helpstr = "Copy reference FASTA and suffix array files used by\n" + \
+              "the aligner to this node-local directory, which is\n" + \
+              "shared by pbalign runs on this node, before alignment."
+    misc_group.add_argument("--stagingDir",
+                        dest="stagingDir",
+                        type=str,
+                        action="store",
+                        default=None,
+                        help=helpstr)
+
+    helpstr = "Maximum size in GB of --stagingDir. Least recently\n" + \
+              "used files are evicted first. Default value is {0}.".\
+              format(DEFAULT_OPTIONS["stagingCacheSize"])
+    misc_group.add_argument("--stagingCacheSize",
+                        dest="stagingCacheSize",
+                        type=float,
+                        action="store",
+                        default=DEFAULT_OPTIONS["stagingCacheSize"],
+                        help=helpstr)
+
+    helpstr = "Stream the aligner's output through a named pipe into\n" + \
+              "'samtools sort' instead of writing an intermediate BAM\n" + \
+              "file. Only works when blasr outputs a BAM or XML file."
+    misc_group.add_argument("--streaming",
+                        dest="streaming",
+                        action="store_true",
+                        default=False,
+                        help=helpstr)
+
+    helpstr = "Record completed stages in a checkpoint manifest under\n" + \
+              "--tmpDir, and skip stages which have been done when the\n" + \
+              "same command is run again after a failure."
+    misc_group.add_argument("--resume",
+                        dest="resume",
+                        action="store_true",
+                        default=False,
+                        help=helpstr)
+
+    helpstr = "Write wall time, CPU time, peak RSS and I/O bytes of\n" + \
+              "every executed stage to a JSON report next to the\n" + \
+              "output file, named {output prefix}.resources.json."
+    misc_group.add_argument("--resourceReport",
+                        dest="resourceReport",
+                        action="store_true",
+                        default=False,
+                        help=helpstr)
+
+    helpstr = "Write stdout and stderr of every called program to\n" + \
+              "rotating log files under this directory."
+    misc_group.add_argument("--outputLogDir",
+                        dest="outputLogDir",
+                        type=str,
+                        action="store",
+                        default=None,
+                        help=helpstr)
+
+    helpstr = "Record paths and versions of called programs in this\n" + \
+              "JSON manifest, and reuse them in later runs instead of\n" + \
+              "asking programs for their versions again."
+    misc_group.add_argument("--toolManifest",
+                        dest="toolManifest",
+                        type=str,
+                        action="store",
+                        default=None,
+                        help=helpstr)
+
+    helpstr = "Cache resolved references (FASTA, suffix array and\n" + \
+              "adapter GFF files) under this directory, and reuse them\n" + \
+              "in later runs until any of these files changes."
+    misc_group.add_argument("--referenceCacheDir",
+                        dest="referenceCacheDir",
+                        type=str,
+                        action="store",
+                        default=None,
+                        help=helpstr)
+
+    helpstr = "Kill any called program which runs longer than this\n" + \
+              "many seconds, and fail."
+    misc_group.add_argument("--stageTimeout",
+                        dest="stageTimeout",
+                        type=int,
+                        action="store",
+                        default=None,
+                        help=helpstr)
+
+    helpstr = "Do not align anything, print the stage DAG of this run\n" + \
+              "in JSON, with the command line of every stage and its\n" + \
+              "estimated input bytes, temporary space and memory."
+    misc_group.add_argument("--plan",
+                        dest="plan",
+                        action="store_true",
+                        default=False,
+                        help=helpstr)
+
     # Keep all temporary & intermediate files.
     misc_group.add_argument("--keepTmpFiles",
                         dest="keepTmpFiles",
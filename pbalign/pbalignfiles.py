@@ -33,9 +33,12 @@
 """This script defines class PBALignFiles."""
 
 from __future__ import absolute_import
+import logging
 from pbalign.utils.fileutil import checkInputFile, getRealFileFormat, \
-    checkOutputFile, checkReferencePath, checkRegionTableFile, \
-    getFileFormat, FILE_FORMATS
+    checkOutputFile, checkRegionTableFile, \
+    getFileFormat, FILE_FORMATS, getFilesFromFOFN, getDataSetResources, \
+    validateReadFiles, real_ppath, real_upath
+from pbalign.utils.referencecache import ResolveReference
 
 
 class PBAlignFiles:
@@ -94,6 +97,25 @@ class PBAlignFiles:
         # only map to adapter regions.
         self.adapterGffFileName = None
 
+        # Directory of reference index files built by an aligner (e.g.,
+        # bowtie2 index files or a GMAP DB), which can be shared by runs
+        # against the same reference. If it is None, index files are built
+        # in the temporary directory of each run.
+        self.referenceIndexDir = None
+
+        # Node-local copies of reference files, which aligners read
+        # instead of the original files, {original: staged}.
+        self.stagedFileNames = {}
+
+        # The user-specified reference path which has been resolved, so
+        # that copies of this object do not resolve it again.
+        self._resolvedReferencePath = None
+
+        # Read files of input files (FOFN or XML), which have been parsed
+        # and validated, keyed by input file names. Copies of this object
+        # share it.
+        self._inputResources = {}
+
         # Verify and assign the input & output files.
         self.SetInOutFiles(inputFileName, referencePath,
                            outputFileName, regionTable, pulseFileName)
@@ -103,8 +125,58 @@ class PBAlignFiles:
         # Validate the user-specified input PacBio read file and get
         # the absolute and expanded path. Validate file format.
         if inputFileName is not None and inputFileName != "":
-            self.inputFileName = checkInputFile(inputFileName)
-            self.inputFileFormat = getRealFileFormat(self.inputFileName)
+            self.inputFileName = checkInputFile(inputFileName,
+                                                checkFofnFiles=False)
+            self.inputFileFormat = getFileFormat(self.inputFileName)
+            if self.inputFileFormat == FILE_FORMATS.FOFN:
+                self.inputFileFormat = getFileFormat(
+                    self.GetInputResources()[0])
+            else:
+                self.GetInputResources()
+
+    def GetInputResources(self, inputFileName=None):
+        """Return read files of an input file (default: self.inputFileName),
+        i.e., files in a FOFN, external resources of a dataset XML, or the
+        input file itself. Each FOFN or XML is parsed, and its read files
+        are validated in parallel, only once: every read file must exist,
+        every BAM file must be a BAM file, and BAM files without .pbi are
+        warned about."""
+        if inputFileName is None:
+            inputFileName = self.inputFileName
+        key = real_ppath(inputFileName)
+        if key in self._inputResources:
+            return self._inputResources[key]
+
+        inputFormat = getFileFormat(inputFileName)
+        if inputFormat == FILE_FORMATS.FOFN:
+            readFiles = [(f, None) for f in getFilesFromFOFN(inputFileName)]
+            if len(readFiles) == 0:
+                errMsg = "FOFN file {fn} is empty.".format(fn=inputFileName)
+                logging.error(errMsg)
+                raise ValueError(errMsg)
+        elif inputFormat == FILE_FORMATS.XML:
+            readFiles = getDataSetResources(inputFileName)
+        else:
+            readFiles = [(real_upath(inputFileName), None)]
+
+        results = validateReadFiles(readFiles)
+        errors = [errMsg for errMsg, _hasPbi in results if errMsg is not None]
+        if len(errors) > 0:
+            errMsg = "{n} read files of {i} are invalid: {e}".format(
+                n=len(errors), i=inputFileName, e=" ".join(errors[0:10]))
+            logging.error(errMsg)
+            raise IOError(errMsg)
+        noPbi = [f for (f, _pbi), (_errMsg, hasPbi) in
+                 zip(readFiles, results) if getFileFormat(f) ==
+                 FILE_FORMATS.BAM and not hasPbi]
+        if len(noPbi) > 0:
+            logging.warning("{n} BAM files of {i} have no .pbi index, " \
+                            "e.g., {f}".format(n=len(noPbi), i=inputFileName,
+                                               f=noPbi[0]))
+
+        resources = [f for f, _pbi in readFiles]
+        self._inputResources[key] = resources
+        return resources
 
     def SetPulseFileName(self, inputFileName, pulseFileName):
         """Verify and assign the pulse file from which pulses can be
@@ -113,10 +185,18 @@ class PBAlignFiles:
         pulse file is pulseFileName."""
         self.pulseFileName = None
         if inputFileName is not None and inputFileName != "":
-            inputFormat = getRealFileFormat(inputFileName)
+            if self.inputFileName is not None and \
+               real_ppath(inputFileName) == real_ppath(self.inputFileName):
+                # The input file has been checked and parsed.
+                inputFormat = self.inputFileFormat
+                checkedFileName = self.inputFileName
+            else:
+                inputFormat = getRealFileFormat(inputFileName)
+                checkedFileName = None
             if inputFormat in [FILE_FORMATS.BAS, FILE_FORMATS.BAX,
                     FILE_FORMATS.PLS, FILE_FORMATS.PLX, FILE_FORMATS.CCS]:
-                self.pulseFileName = checkInputFile(inputFileName)
+                self.pulseFileName = checkedFileName or \
+                    checkInputFile(inputFileName)
 
         if self.pulseFileName is None:
             if pulseFileName is not None and pulseFileName != "":
@@ -128,13 +208,21 @@ class PBAlignFiles:
         sawriterFileName. targetFileName is the target reference FASTA
         file to be used by an aligner. sawriterFileName is the reference
         sawriter file that can be used by an aligner (e.g. blasr), its
-        value can be None if absent.
+        value can be None if absent. Do nothing if referencePath has
+        already been resolved.
         """
-        if referencePath is not None and referencePath != "":
+        if referencePath is not None and referencePath != "" and \
+           referencePath != self._resolvedReferencePath:
             (self.referencePath, self.targetFileName,
              self.sawriterFileName, self.isWithinRepository,
              self.adapterGffFileName) = \
-            checkReferencePath(referencePath)
+            ResolveReference(referencePath)
+            self._resolvedReferencePath = referencePath
+
+    def StagedFileName(self, fileName):
+        """Return the node-local copy of fileName if it has been staged,
+        otherwise fileName itself."""
+        return self.stagedFileNames.get(fileName, fileName)
 
     def SetOutputFileName(self, outputFileName):
         """Validate the user-specified output file and get the absolute and
@@ -41,7 +41,11 @@ or BAM file.
 # Author: Yuan Li
 
 import functools
+import json
 import logging
+from copy import copy
+from os import path
+import threading
 import time
 import sys
 import shutil
@@ -49,16 +53,27 @@ import shutil
 from pbcommand.cli import pbparser_runner
 from pbcommand.utils import setup_log
 from pbcore.util.ToolRunner import PBToolRunner
-from pbcore.io import (AlignmentSet, ConsensusAlignmentSet)
+from pbcore.io import (AlignmentSet, ConsensusAlignmentSet, openDataSet)
 
 from pbalign.__init__ import get_version
 from pbalign.options import (ALGORITHM_CANDIDATES, get_contract_parser,
                              resolved_tool_contract_to_args)
-from pbalign.alignservice.blasr import BlasrService
+from pbalign.alignservice.blasr import BlasrService, BLASR_DEFAULT_BESTN
 from pbalign.alignservice.bowtie import BowtieService
 from pbalign.alignservice.gmap import GMAPService
-from pbalign.utils.fileutil import getFileFormat, FILE_FORMATS, real_ppath
-from pbalign.utils.tempfileutil import TempFileManager
+from pbalign.utils.fileutil import getFileFormat, FILE_FORMATS, real_ppath, \
+    releaseFifoReader, drainFifo
+from pbalign.utils.tempfileutil import TempFileManager, splitRootDirs
+from pbalign.utils.checkpoint import Checkpoint, runHash
+from pbalign.utils.progutil import WriteResourceReport, ConfigureExecute
+from pbalign.utils.toolregistry import ConfigureTools, Tools
+from pbalign.utils.referencecache import ConfigureReferenceCache
+from pbalign.utils.stagingcache import StagingCache
+from pbalign.utils.referencechunks import splitReference, mergeHits
+from pbalign.utils.alignmentfilter import FilterStats
+from pbalign.utils.resourceutil import ResourcePlan
+from pbalign.utils.planutil import planStages, fileSize, peakMemory, \
+    peakTempBytes, routeLoggingToStderr, ALIGNED_BAM_RATIO, SAM_RATIO
 from pbalign.pbalignfiles import PBAlignFiles
 from pbalign.filterservice import FilterService
 from pbalign.bampostservice import BamPostService
@@ -68,10 +83,13 @@ class PBAlignRunner(PBToolRunner):
     """Tool runner."""
 
     def __init__(self, args=None, argumentList=(),
-                 output_dataset_type=AlignmentSet):
+                 output_dataset_type=AlignmentSet, fileNames=None):
         """Initialize a PBAlignRunner object.
            argumentList is a list of arguments, such as:
            ['--debug', '--maxHits', '10', 'in.fasta', 'ref.fasta', 'out.sam']
+           fileNames is a PBAlignFiles object to start with, e.g., a copy of
+           PBAlignFiles shared by runs against the same reference, of which
+           the reference has been resolved.
         """
         desc = "Utilities for aligning PacBio reads to reference sequences."
         if args is None: # FIXME unit testing hack
@@ -87,8 +105,11 @@ class PBAlignRunner(PBToolRunner):
         self._output_dataset_type = output_dataset_type
         self._alnService = None
         self._filterService = None
-        self.fileNames = PBAlignFiles()
+        self.fileNames = PBAlignFiles() if fileNames is None else fileNames
         self._tempFileManager = TempFileManager()
+        self._checkpoint = None
+        self._resources = None
+        self._stagingCache = None
 
     def _setupParsers(self, description):
         pass
@@ -132,6 +153,76 @@ class PBAlignRunner(PBToolRunner):
         service.checkAvailability()
         return service
 
+    def prepareReference(self):
+        """Create the AlignService of this run, and build reference index
+        files under self.fileNames.referenceIndexDir, so that other runs
+        which start with a copy of self.fileNames can reuse them."""
+        if self._resources is None:
+            self._planResources()
+        self._alnService = self._createAlignService(self.args.algorithm,
+                                                    self.args,
+                                                    self.fileNames,
+                                                    self._tempFileManager)
+        if self.fileNames.referenceIndexDir is not None:
+            self._alnService.prepareReference()
+
+    def _planResources(self):
+        """Size threads and memory of stages of this run according to CPUs
+        and memory available to it, and use all available CPUs for the
+        aligner if --nproc is not specified."""
+        self._resources = ResourcePlan(nproc=self.args.nproc,
+                                       streaming=self.args.streaming)
+        logging.info("Resource plan: {r}".format(r=self._resources))
+        if self.args.nproc is None:
+            self.args.nproc = self._resources.alignThreads
+
+    def _createPostService(self, fileNames, shares=1, intermediate=False):
+        """Create a BamPostService sized by the resource plan of this run,
+        which shares sort threads with (shares - 1) other BamPostServices
+        running at the same time, e.g., sorting shards. If intermediate,
+        its sorted bam file is temporary, e.g., a sorted shard, and is
+        compressed at --intermediateCompressionLevel."""
+        if self._resources is None:
+            self._planResources()
+        resources = self._resources
+        compressionLevel = self.args.intermediateCompressionLevel \
+            if intermediate else self.args.compressionLevel
+        return BamPostService(filenames=fileNames,
+                              nproc=max(1, resources.sortThreads // shares),
+                              sortMemory=resources.sortMemory,
+                              indexConcurrency=resources.indexConcurrency,
+                              compressionLevel=compressionLevel)
+
+    def _stageReference(self, args, fileNames):
+        """Copy reference files used by the aligner to the node-local
+        staging dir, and let the aligner read the copies."""
+        self._stagingCache = StagingCache(args.stagingDir,
+            int(args.stagingCacheSize * (1 << 30)))
+        stagedFileNames = {}
+        for fileName in (fileNames.targetFileName, fileNames.sawriterFileName):
+            if fileName is not None and fileName != "":
+                stagedFileNames[fileName] = self._stagingCache.stage(fileName)
+        # Copies of fileNames (e.g., of other batch jobs) keep their own.
+        fileNames.stagedFileNames = stagedFileNames
+
+    def _selectTmpDir(self, mode):
+        """Estimate peak temporary space of this run in mode, and use a
+        --tmpDir candidate which has enough free space for it. Fail if none
+        has."""
+        tempBytes = peakTempBytes(self._plan(mode))
+        logging.info("Estimated peak temporary space: {n} bytes.".format(
+            n=tempBytes))
+        self._tempFileManager.SelectRootDir(self.args.tmpDir, tempBytes)
+
+    def _alignedBytes(self, outFormat):
+        """Return estimated bytes of alignments of this run in outFormat,
+        which are written to temporary files."""
+        readsBytes = sum(fileSize(f) for f in
+                         self.fileNames.GetInputResources())
+        isBam = outFormat in [FILE_FORMATS.BAM, FILE_FORMATS.XML]
+        return int(readsBytes * ALIGNED_BAM_RATIO *
+                   (1 if isBam else SAM_RATIO))
+
     def _makeSane(self, args, fileNames):
         """
         Check whether the input arguments make sense or not.
@@ -160,6 +251,290 @@ class PBAlignRunner(PBToolRunner):
                 errMsg = "-filterAdapter does not work when out format is BAM."
                 raise ValueError(errMsg)
 
+    def _createCheckpoint(self, args):
+        """Create a checkpoint manifest for this run. If --resume, pin
+        temporary files to a directory named after the hash of options and
+        input files under --tmpDir, so that rerunning the same command can
+        find the manifest and skip stages which have been done."""
+        if not args.resume:
+            return Checkpoint(None, None, enabled=False)
+        thisRunHash = runHash(args, [args.inputFileName, args.referencePath])
+        runDir = path.join(splitRootDirs(args.tmpDir)[0], "pbalign_{h}".format(
+            h=thisRunHash[0:16]))
+        self._tempFileManager.PinRootDir(runDir)
+        logging.info("Checkpoint: save temporary files to {d}.".format(
+            d=runDir))
+        return Checkpoint(path.join(runDir, "checkpoint.json"), thisRunHash)
+
+    def _canStream(self, args, outFormat):
+        """Return True if the aligner's output can be streamed into
+        'samtools sort' directly, which requires that the aligner outputs
+        BAM and that no samFilter pass is needed in between."""
+        if not args.streaming:
+            return False
+        if args.algorithm == "blasr" and not args.filterAdapterOnly and \
+           outFormat in [FILE_FORMATS.BAM, FILE_FORMATS.XML]:
+            return True
+        logging.warning("--streaming only works when blasr outputs a BAM " +
+                        "or XML file, write intermediate files instead.")
+        return False
+
+    def _alignAndSortStreaming(self):
+        """Align reads and sort the aligner's output at the same time.
+        The aligner writes to a named pipe, from which 'samtools sort'
+        reads, so that no intermediate BAM is written to disk."""
+        fifo = self._tempFileManager.RegisterNewTmpFifo(suffix=".bam")
+        # blasr filters alignments in-line, the filtered bam is the pipe.
+        self.fileNames.filteredSam = fifo
+        postService = self._createPostService(self.fileNames)
+        sorter = postService.startSort()
+        alignDone = threading.Event()
+
+        def drainIfSortFailed():
+            """If sort fails, keep draining the pipe so that the aligner
+            will not block forever."""
+            sorter.join()
+            if sorter.error is not None:
+                drainFifo(fifo, alignDone)
+        drainer = threading.Thread(target=drainIfSortFailed)
+        drainer.daemon = True
+        drainer.start()
+
+        try:
+            self._alnService.run(alignerSamOut=fifo)
+        finally:
+            alignDone.set()
+            # If the aligner exits without ever opening the pipe, the
+            # sorter is still waiting for a writer, send it an EOF.
+            while sorter.is_alive():
+                releaseFifoReader(fifo)
+                sorter.join(1)
+            drainer.join()
+        sorter.wait()
+        return postService
+
+    def _canChunkReference(self, args, fileNames, outFormat):
+        """Return True if the reference should be split into chunks, which
+        requires that it is larger than --maxReferenceChunkSize and that
+        blasr outputs BAM."""
+        if args.maxReferenceChunkSize is None:
+            return False
+        maxChunkBytes = int(args.maxReferenceChunkSize) << 20
+        if fileSize(fileNames.targetFileName) <= maxChunkBytes:
+            return False
+        if args.algorithm == "blasr" and \
+           outFormat in [FILE_FORMATS.BAM, FILE_FORMATS.XML] and \
+           args.unaligned is None and \
+           Tools().capability("samtools", "mergeTargets"):
+            return True
+        logging.warning("--maxReferenceChunkSize only works when blasr " +
+                        "outputs a BAM or XML file without --unaligned, " +
+                        "and samtools >= 1.0 is available, do not split " +
+                        "the reference.")
+        return False
+
+    def _alignReferenceChunks(self):
+        """Split the reference into chunks of contigs, align reads against
+        one chunk at a time, keeping all of at most maxHits alignments of
+        each read, then apply the hit policy to alignments of each read
+        against all chunks, and write them to self.fileNames.filteredSam.
+        """
+        args = self.args
+        chunkFiles = splitReference(
+            self.fileNames.targetFileName,
+            int(args.maxReferenceChunkSize) << 20,
+            lambda i: self._tempFileManager.RegisterNewTmpFile(
+                suffix=".chunk{i}.fasta".format(i=i)))
+
+        # Keep all alignments against each chunk, the hit policy can only
+        # be applied to alignments against all chunks.
+        chunkArgs = copy(args)
+        chunkArgs.hitPolicy = "all"
+        chunkBamFiles = []
+        for chunkFile in chunkFiles:
+            chunkFileNames = copy(self.fileNames)
+            chunkFileNames.targetFileName = chunkFile
+            chunkFileNames.sawriterFileName = None
+            chunkFileNames.stagedFileNames = {}
+            service = self._createAlignService(chunkArgs.algorithm,
+                                               chunkArgs, chunkFileNames,
+                                               self._tempFileManager)
+            if args.suffixArrayCacheDir is not None:
+                service.cacheSuffixArray()
+            logging.info("Align reads against {f}.".format(f=chunkFile))
+            service.run(sizeHint=self._alignedBytes(FILE_FORMATS.BAM))
+            chunkBamFiles.append(chunkFileNames.alignerSamOut)
+
+        nameSortedBamFiles = [self._tempFileManager.RegisterNewTmpFile(
+            suffix=".byname.bam") for _f in chunkBamFiles]
+        mergedBamFile = self._tempFileManager.RegisterNewTmpFile(
+            suffix=".byname.bam")
+        self._createPostService(self.fileNames, intermediate=True).\
+            mergeByName(chunkBamFiles, nameSortedBamFiles, mergedBamFile)
+        for fileName in chunkFiles + chunkBamFiles + nameSortedBamFiles:
+            self._deleteConsumed(fileName)
+
+        # blasr keeps at most its default --bestn hits of each read against
+        # each chunk, so keep as many against all chunks, like a run
+        # against the whole reference.
+        maxHits = args.maxHits if args.maxHits not in (None, "") else \
+            BLASR_DEFAULT_BESTN
+        self.fileNames.filteredSam = self._tempFileManager.\
+            RegisterNewTmpFile(suffix=".bam")
+        statsFileName = self._filterStatsFileName(
+            self.fileNames.outputFileName)
+        stats = FilterStats() if statsFileName is not None else None
+        mergeHits(mergedBamFile, self.fileNames.filteredSam,
+                  hitPolicy=args.hitPolicy, maxHits=int(maxHits),
+                  scoreSign=self._alnService.scoreSign, seed=args.seed,
+                  compressionLevel=args.intermediateCompressionLevel,
+                  stats=stats)
+        self._deleteConsumed(mergedBamFile)
+        if stats is not None:
+            logging.info("Write filter statistics to {f}.".format(
+                f=statsFileName))
+            stats.write(statsFileName)
+
+    def _canShard(self, args, fileNames, outFormat):
+        """Return True if the input dataset can be split into shards by
+        ZMW, which requires that blasr outputs BAM from a dataset XML."""
+        if args.shards is None or int(args.shards) <= 1:
+            return False
+        if args.algorithm == "blasr" and \
+           outFormat in [FILE_FORMATS.BAM, FILE_FORMATS.XML] and \
+           getFileFormat(fileNames.inputFileName) == FILE_FORMATS.XML:
+            return True
+        logging.warning("--shards only works when blasr aligns a dataset " +
+                        "XML and outputs a BAM or XML file, do not shard.")
+        return False
+
+    def _splitInput(self, inputFileName, shards):
+        """Split the input dataset into at most `shards` datasets by ZMW
+        ranges using the .pbi index, write them to temporary XML files,
+        and return a list of these XML files."""
+        shardFiles = []
+        with openDataSet(real_ppath(inputFileName)) as ds:
+            for shard in ds.split(chunks=shards, zmws=True):
+                shardFile = self._tempFileManager.RegisterNewTmpFile(
+                    suffix=".xml")
+                shard.write(shardFile)
+                shardFiles.append(shardFile)
+        logging.info("Split {i} into {n} shards by ZMW.".format(
+            i=inputFileName, n=len(shardFiles)))
+        return shardFiles
+
+    def _alignShards(self):
+        """Align shards of the input dataset simultaneously, each by its own
+        AlignService with nproc/shards threads, sort alignments of each
+        shard, and return the BamPostService which has merged all sorted
+        shard bam files into the output bam file."""
+        shardFiles = self._splitInput(self.fileNames.inputFileName,
+                                      int(self.args.shards))
+        shardNproc = max(1, int(self.args.nproc) // len(shardFiles))
+        shardBytes = self._alignedBytes(FILE_FORMATS.BAM) // len(shardFiles)
+
+        # Create services in the main thread, because AlignService changes
+        # the root dir of the temporary file manager.
+        shards = []
+        for shardFile in shardFiles:
+            shardArgs = copy(self.args)
+            shardArgs.inputFileName = shardFile
+            shardArgs.nproc = shardNproc
+            # Copy file names so that the reference is not resolved again.
+            shardFileNames = copy(self.fileNames)
+            service = self._createAlignService(shardArgs.algorithm,
+                                               shardArgs, shardFileNames,
+                                               self._tempFileManager)
+            shardFileNames.outBamFileName = self._tempFileManager.\
+                RegisterNewTmpFile(suffix=".bam", sizeHint=shardBytes)
+            shards.append((service, shardFileNames))
+
+        errors = []
+
+        def alignAndSort(service, shardFileNames):
+            """Align a shard and sort its alignments."""
+            try:
+                service.run(sizeHint=shardBytes)
+                # blasr filters alignments in-line.
+                shardFileNames.filteredSam = shardFileNames.alignerSamOut
+                self._createPostService(shardFileNames, shares=len(shards),
+                                        intermediate=True).sort()
+                self._deleteConsumed(shardFileNames.alignerSamOut)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=alignAndSort, args=shard)
+                   for shard in shards]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if len(errors) > 0:
+            errMsg = "Failed to align {n} of {m} shards: {e}".format(
+                n=len(errors), m=len(shards), e=str(errors[0]))
+            logging.error(errMsg)
+            raise RuntimeError(errMsg)
+
+        postService = self._createPostService(self.fileNames)
+        postService.merge([shardFileNames.outBamFileName
+                           for _service, shardFileNames in shards])
+        for _service, shardFileNames in shards:
+            self._deleteConsumed(shardFileNames.outBamFileName)
+        return postService
+
+    def _deleteConsumed(self, fileName):
+        """Delete a temporary intermediate file which has been consumed, so
+        that its memory under --memoryTmpDir or its space under --tmpDir
+        can be reused by later stages, see peakTempBytes()."""
+        if getattr(self.args, "keepTmpFiles", False) is True:
+            return
+        if fileName is not None and \
+           self._tempFileManager.IsRegistered(fileName):
+            self._tempFileManager.DeleteTmpFile(fileName)
+
+    def _runMode(self, outFormat):
+        """Return how this run aligns reads, one of RUN_MODES."""
+        if self._canChunkReference(self.args, self.fileNames, outFormat):
+            return "chunks"
+        elif self._canShard(self.args, self.fileNames, outFormat):
+            return "shards"
+        elif self._canStream(self.args, outFormat):
+            return "streaming"
+        return "default"
+
+    def _plan(self, mode):
+        """Return the stage DAG of this run in mode, see planStages()."""
+        return planStages(self.args, self.fileNames, self._alnService,
+                          self._createPostService,
+                          self._tempFileManager.defaultRootDir, mode)
+
+    def _printPlan(self):
+        """Print the stage DAG of this run in JSON to stdout, then remove
+        temporary files made while planning. Log messages go to stderr,
+        so that stdout is only the plan."""
+        routeLoggingToStderr()
+        self._planResources()
+        self._alnService = self._createAlignService(self.args.algorithm,
+                                                    self.args,
+                                                    self.fileNames,
+                                                    self._tempFileManager)
+        self._makeSane(self.args, self.fileNames)
+        outFormat = getFileFormat(self.fileNames.outputFileName)
+        try:
+            stages = self._plan(self._runMode(outFormat))
+        finally:
+            self._cleanUp(True)
+        plan = {"version": get_version(),
+                "algorithm": self.args.algorithm,
+                "outputFileName": self.fileNames.outputFileName,
+                "stages": [stage.toDict() for stage in stages],
+                "tempBytes": peakTempBytes(stages),
+                "outputBytes": sum(stage.outputBytes for stage in stages),
+                "memoryBytes": peakMemory(stages)}
+        sys.stdout.write(json.dumps(plan, indent=2) + "\n")
+        sys.stdout.flush()
+        return 0
+
     def _parseArgs(self):
         """Overwrite ToolRunner.parseArgs(self).
         Parse PBAlignRunner arguments considering both args in argumentList and
@@ -213,10 +588,54 @@ class PBAlignRunner(PBToolRunner):
 
         return output, errCode, errMsg
 
+    def _resourceReportFileName(self, outFile):
+        """Return the resource report file next to the output file."""
+        return path.splitext(real_ppath(outFile))[0] + ".resources.json"
+
+    def _filterStatsFileName(self, outFile):
+        """Return the filter statistics file next to the output file, or
+        None if --filterStats is not specified."""
+        if not self.args.filterStats:
+            return None
+        return path.splitext(real_ppath(outFile))[0] + ".filter_stats.json"
+
+    def _filterStageFiles(self):
+        """Return files produced by the filter stage, the filtered
+        alignments and filter statistics if they have been written, so
+        that the stage is redone under --resume if statistics are lost."""
+        fileNames = [self.fileNames.filteredSam]
+        statsFileName = self._filterStatsFileName(
+            self.fileNames.outputFileName)
+        if statsFileName is not None and path.exists(statsFileName):
+            fileNames.append(statsFileName)
+        return fileNames
+
+    def _checkFilterStats(self):
+        """Warn if --filterStats is specified but no filter statistics
+        have been written, e.g., blasr has filtered alignments itself, or
+        stages after the filter have been skipped under --resume."""
+        statsFileName = self._filterStatsFileName(
+            self.fileNames.outputFileName)
+        if statsFileName is not None and not path.exists(statsFileName):
+            logging.warning("--filterStats: {f} has not been written. ".
+                            format(f=statsFileName) +
+                            "Filter statistics are only gathered when " +
+                            "alignments are filtered in process or hits " +
+                            "against reference chunks are merged.")
+
     def _cleanUp(self, realDelete=False):
-        """ Clean up temporary files and intermediate results. """
+        """ Clean up temporary files and intermediate results. Files are
+        deleted in the background, the output has been published already."""
         logging.debug("Clean up temporary files and directories.")
-        self._tempFileManager.CleanUp(realDelete)
+        self._tempFileManager.CleanUp(realDelete, wait=False)
+        if self._stagingCache is not None:
+            self._stagingCache.release()
+            self._stagingCache = None
+
+    def waitForCleanUp(self):
+        """Wait until temporary files are deleted in the background, and
+        return messages of those which could not be deleted."""
+        return self._tempFileManager.WaitForCleanUp()
 
     def run(self):
         """
@@ -226,47 +645,152 @@ class PBAlignRunner(PBToolRunner):
         logging.info("pbalign version: %s", get_version())
         #logging.debug("Original arguments: " + str(self._argumentList))
 
+        ConfigureExecute(outputLogDir=self.args.outputLogDir,
+                         timeout=self.args.stageTimeout)
+        ConfigureTools(manifestFile=self.args.toolManifest)
+        ConfigureReferenceCache(cacheDir=self.args.referenceCacheDir)
+
+        # Only print commands and estimated resources of stages.
+        if self.args.plan:
+            return self._printPlan()
+
+        # Create a checkpoint manifest before any temporary file is made.
+        self._checkpoint = self._createCheckpoint(self.args)
+
+        # Size threads and memory of stages before any service is created.
+        if self._resources is None:
+            self._planResources()
+
+        # Put intermediate files in memory while they fit in the budget.
+        # Do not when resuming, they would not survive a reboot.
+        if self.args.memoryTmpDir is not None and not self.args.resume:
+            self._tempFileManager.SetMemoryRootDir(self.args.memoryTmpDir,
+                int(self.args.memoryTmpBudget * (1 << 30)))
+
         # Create an AlignService by algorithm name.
-        self._alnService = self._createAlignService(self.args.algorithm,
-                                                    self.args,
-                                                    self.fileNames,
-                                                    self._tempFileManager)
+        if self._alnService is None:
+            self._alnService = self._createAlignService(self.args.algorithm,
+                                                        self.args,
+                                                        self.fileNames,
+                                                        self._tempFileManager)
 
         # Make sane.
         self._makeSane(self.args, self.fileNames)
 
-        # Run align service.
-        self._alnService.run()
-
-        # Create a temporary filtered SAM/BAM file as output for FilterService.
         outFormat = getFileFormat(self.fileNames.outputFileName)
-        suffix = ".bam" if outFormat in \
-                [FILE_FORMATS.BAM, FILE_FORMATS.XML] else ".sam"
-        self.fileNames.filteredSam = self._tempFileManager.\
-            RegisterNewTmpFile(suffix=suffix)
-
-        # Call filter service on SAM or BAM file.
-        self._filterService = FilterService(self.fileNames.alignerSamOut,
-                                            self.fileNames.targetFileName,
-                                            self.fileNames.filteredSam,
-                                            self.args.algorithm,
-                                            #self._alnService.name,
-                                            self._alnService.scoreSign,
-                                            self.args,
-                                            self.fileNames.adapterGffFileName)
-        self._filterService.run()
-
-        # Sort bam before output
-        if outFormat in [FILE_FORMATS.BAM, FILE_FORMATS.XML]:
-            # Sort/make index for BAM output.
-            BamPostService(filenames=self.fileNames, nproc=self.args.nproc).run()
+        mode = self._runMode(outFormat)
+
+        # Fail now, before any command runs, rather than hours later if
+        # temporary space is short.
+        self._selectTmpDir(mode)
+
+        # Capture I/O counts of commands under the temporary dir of this
+        # run, which is removed along with all other temporary files.
+        ConfigureExecute(outputLogDir=self.args.outputLogDir,
+                         timeout=self.args.stageTimeout,
+                         tmpDir=self._tempFileManager.RegisterNewTmpFile(
+                             isDir=True, prefix="io_"))
+
+        # Build a suffix array of the reference once for all blasr runs.
+        # Chunks of the reference have suffix arrays of their own.
+        if self.args.algorithm == "blasr" and mode != "chunks" and \
+           self.args.suffixArrayCacheDir is not None:
+            self._alnService.cacheSuffixArray()
+
+        # Stage reference files on the node-local disk. Only blasr reads
+        # them directly, other aligners read their own index files. Chunks
+        # of the reference are temporary files, which are not staged.
+        if self.args.stagingDir is not None and mode != "chunks" and \
+           self.args.algorithm == "blasr" and self._stagingCache is None:
+            self._stageReference(self.args, self.fileNames)
+
+        checkpoint = self._checkpoint
+        if checkpoint.isDone("output"):
+            pass
+        elif checkpoint.isDone("sort"):
+            # Alignments have been sorted, only make index for BAM output.
+            self._createPostService(self.fileNames).run(isSorted=True,
+                                                      checkpoint=checkpoint)
+        elif mode == "chunks":
+            # Align reads against chunks of the reference one at a time,
+            # apply the hit policy globally, then sort and make index.
+            if checkpoint.isDone("filter"):
+                self.fileNames.filteredSam = checkpoint.files("filter")[0]
+            else:
+                self._alignReferenceChunks()
+                checkpoint.markDone("filter", self._filterStageFiles())
+            self._createPostService(self.fileNames).run(
+                checkpoint=checkpoint)
+        elif mode == "shards":
+            # Align shards simultaneously, merge their sorted outputs,
+            # then make index for BAM output.
+            postService = self._alignShards()
+            checkpoint.markDone("sort", [self.fileNames.outBamFileName])
+            postService.run(isSorted=True, checkpoint=checkpoint)
+        elif mode == "streaming":
+            # Run align service and sort its output at the same time,
+            # then make index for BAM output.
+            postService = self._alignAndSortStreaming()
+            checkpoint.markDone("sort", [self.fileNames.outBamFileName])
+            postService.run(isSorted=True, checkpoint=checkpoint)
+        else:
+            if checkpoint.isDone("filter"):
+                self.fileNames.filteredSam = checkpoint.files("filter")[0]
+            else:
+                # Run align service.
+                if checkpoint.isDone("align"):
+                    self.fileNames.alignerSamOut = \
+                        checkpoint.files("align")[0]
+                else:
+                    self._alnService.run(
+                        sizeHint=self._alignedBytes(outFormat))
+                    checkpoint.markDone("align",
+                                        [self.fileNames.alignerSamOut])
+
+                # Create a temporary filtered SAM/BAM file as output for
+                # FilterService.
+                suffix = ".bam" if outFormat in \
+                        [FILE_FORMATS.BAM, FILE_FORMATS.XML] else ".sam"
+                # blasr output is symlinked unless adapters are filtered.
+                isSymlink = self.args.algorithm == "blasr" and \
+                    not self.args.filterAdapterOnly
+                self.fileNames.filteredSam = self._tempFileManager.\
+                    RegisterNewTmpFile(suffix=suffix, sizeHint=(None if
+                        isSymlink else self._alignedBytes(outFormat)))
+
+                # Call filter service on SAM or BAM file.
+                self._filterService = FilterService(
+                    self.fileNames.alignerSamOut,
+                    self.fileNames.targetFileName,
+                    self.fileNames.filteredSam,
+                    self.args.algorithm,
+                    #self._alnService.name,
+                    self._alnService.scoreSign,
+                    self.args,
+                    self.fileNames.adapterGffFileName,
+                    self._filterStatsFileName(self.fileNames.outputFileName))
+                self._filterService.run()
+                checkpoint.markDone("filter", self._filterStageFiles())
+                if not isSymlink:
+                    self._deleteConsumed(self.fileNames.alignerSamOut)
+
+            # Sort bam before output
+            if outFormat in [FILE_FORMATS.BAM, FILE_FORMATS.XML]:
+                # Sort/make index for BAM output.
+                self._createPostService(self.fileNames).run(
+                                   checkpoint=checkpoint)
+                self._deleteConsumed(self.fileNames.filteredSam)
+                self._deleteConsumed(self.fileNames.alignerSamOut)
 
         # Output all hits in SAM, BAM.
-        self._output(
-            inSam=self.fileNames.filteredSam,
-            refFile=self.fileNames.targetFileName,
-            outFile=self.fileNames.outputFileName,
-            readType=self.args.readType)
+        if not checkpoint.isDone("output"):
+            self._output(
+                inSam=self.fileNames.filteredSam,
+                refFile=self.fileNames.targetFileName,
+                outFile=self.fileNames.outputFileName,
+                readType=self.args.readType)
+            checkpoint.markDone("output", [self.fileNames.outputFileName])
+        self._checkFilterStats()
 
         # Delete temporay files anyway to make
         self._cleanUp(False if (hasattr(self.args, "keepTmpFiles") and
@@ -274,6 +798,10 @@ class PBAlignRunner(PBToolRunner):
 
         endTime = time.time()
         logging.info("Total time: {:.2f} s.".format(float(endTime - startTime)))
+
+        if self.args.resourceReport:
+            WriteResourceReport(self._resourceReportFileName(
+                self.fileNames.outputFileName), float(endTime - startTime))
         return 0
 
 def args_runner(args, output_dataset_type=AlignmentSet):
@@ -299,6 +827,9 @@ resolved_tool_contract_runner_ccs = functools.partial(
 def main(argv=sys.argv, get_parser_func=get_contract_parser,
          contract_runner_func=resolved_tool_contract_runner):
     """Main, supporting both args runner and tool contract runner."""
+    if len(argv) > 1 and argv[1] in ("serve", "submit"):
+        from pbalign.server import serve_main, submit_main
+        return (serve_main if argv[1] == "serve" else submit_main)(argv[2:])
     return pbparser_runner(
         argv=argv[1:],
         parser=get_parser_func(),
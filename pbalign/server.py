@@ -0,0 +1,431 @@
+#!/usr/bin/env python
+###############################################################################
+# Copyright (c) 2011-2013, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+###############################################################################
+
+"""A persistent pbalign server which keeps references warm.
+
+Usage: pbalign serve --socket PATH [--reference R ...] [--workers N]
+       pbalign submit --socket PATH inputFileName referencePath
+                      outputFileName [pbalign options]
+
+The server listens on a Unix domain socket. Each reference is resolved once,
+reference index files (e.g., bowtie2 index files or a GMAP DB) are built
+once per aligner, and reference files are periodically read so that they
+stay in the page cache. Submitted jobs run through the same align, filter
+and sort chain as pbalign, at most --workers jobs at a time.
+
+Jobs run on --workers worker processes, which are forked when the server
+starts, before any thread is started, because a process forked from a
+multithreaded process may inherit locks (e.g., of logging handlers) held by
+other threads. Handler threads only hand jobs over to idle workers through
+pipes. A worker runs each job in its own child process, so that jobs do not
+share process-wide settings, and a job which is killed does not take its
+worker down with it.
+
+A job is a line of JSON, {"args": {pbalign options}}, and the server replies
+a line of JSON, {"exitCode": 0 or 1, "error": error message or null}, when
+the job is done.
+"""
+
+from __future__ import absolute_import
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import os.path as op
+import Queue
+import signal
+import socket
+import SocketServer
+import sys
+import threading
+from argparse import Namespace
+
+from pbcommand.utils import setup_log
+
+from pbalign.__init__ import get_version
+from pbalign.batch import SharedReference, runJobs, JOB_POLL_INTERVAL
+from pbalign.options import get_contract_parser
+from pbalign.pbalignrunner import PBAlignRunner
+from pbalign.utils.fileutil import real_ppath
+from pbalign.utils.tempfileutil import TempFileManager
+
+# Options of pbalign which are paths, and are made absolute by the client,
+# because the server does not share the working directory of the client.
+# --filterStats and --resourceReport are flags, their files are written
+# next to the output file.
+PATH_OPTIONS = ("inputFileName", "referencePath", "outputFileName",
+                "regionTable", "pulseFile", "configFile", "unaligned",
+                "tmpDir", "memoryTmpDir", "stagingDir", "suffixArrayCacheDir",
+                "referenceCacheDir", "toolManifest", "outputLogDir")
+# Path options which are comma-separated lists of paths.
+PATH_LIST_OPTIONS = ("tmpDir",)
+
+WARM_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def warmPageCache(paths):
+    """Read files (and files under directories) in paths, so that they
+    are loaded into the page cache. Return the number of bytes read."""
+    total = 0
+    for path in paths:
+        if op.isdir(path):
+            fileNames = [op.join(root, f) for root, _dirs, files in
+                         os.walk(path) for f in files]
+        elif op.isfile(path):
+            fileNames = [path]
+        else:
+            continue
+        for fileName in fileNames:
+            try:
+                with open(fileName, 'rb') as f:
+                    while True:
+                        chunk = f.read(WARM_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        total += len(chunk)
+            except (IOError, OSError) as e:
+                logging.warning("Could not warm {f}: {e}".format(
+                    f=fileName, e=str(e)))
+    return total
+
+
+def _serveJobs(conn, serverPid):
+    """Main loop of a worker process. Receive (args, fileNames) of jobs
+    from conn, run each job in its own child process and send back its
+    error message, None if it succeeded, until None is received or the
+    server, serverPid, has exited."""
+    # The server stops its workers when it is interrupted.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        if not conn.poll(JOB_POLL_INTERVAL):
+            if os.getppid() != serverPid:
+                return
+            continue
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+        args, fileNames = job
+        try:
+            runner = PBAlignRunner(args, fileNames=fileNames)
+        except Exception as e:
+            conn.send(str(e))
+            continue
+        # runJobs only reads from its multiprocessing.Queue here, which does
+        # not start a feeder thread, so jobs are forked from a process which
+        # is still single-threaded.
+        conn.send(runJobs([runner], 1)[0])
+
+
+class Worker(object):
+    """A worker process of AlignmentServer, and the parent end of the pipe
+    through which jobs are sent to it."""
+    def __init__(self):
+        self._conn, childConn = multiprocessing.Pipe()
+        # Not a daemon, which may not have children.
+        self.process = multiprocessing.Process(target=_serveJobs,
+                                               args=(childConn,
+                                                     os.getpid()))
+        self.process.start()
+        childConn.close()
+
+    def run(self, runner):
+        """Run the job of runner, a prepared PBAlignRunner, on this worker,
+        wait for it and return its error message, None if it succeeded."""
+        self._conn.send((runner.args, runner.fileNames))
+        while not self._conn.poll(JOB_POLL_INTERVAL):
+            if not self.process.is_alive():
+                break
+        try:
+            # The worker may have replied right before it exited.
+            return self._conn.recv()
+        except EOFError:
+            self.process.join()
+            return "pbalign worker {p} exited with code {c}.".format(
+                p=self.process.pid, c=self.process.exitcode)
+
+    def is_alive(self):
+        """Return whether the worker process is alive."""
+        return self.process.is_alive()
+
+    def stop(self):
+        """Stop the worker after its current job and wait for it."""
+        if self.process.is_alive():
+            try:
+                self._conn.send(None)
+            except (IOError, OSError):
+                pass
+            self.process.join()
+        self._conn.close()
+
+
+class AlignmentServer(SocketServer.ThreadingMixIn,
+                      SocketServer.UnixStreamServer):
+    """A Unix socket server which runs pbalign jobs against warm
+    references, at most `workers` jobs at a time."""
+    daemon_threads = True
+
+    def __init__(self, socketPath, workers, tmpDir, warmInterval=600):
+        # Fork workers before any thread is started.
+        self._workers = [Worker() for _i in range(workers)]
+        self._idleWorkers = Queue.Queue()
+        for worker in self._workers:
+            self._idleWorkers.put(worker)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, socketPath,
+                                                   JobHandler)
+        except Exception:
+            self._stopWorkers()
+            raise
+        self.socketPath = socketPath
+        self.warmInterval = warmInterval
+        self._tempFileManager = TempFileManager(tmpDir)
+        self._references = {}
+        self._referencesLock = threading.Lock()
+        self._stopEvent = threading.Event()
+        self._warmer = threading.Thread(target=self._keepWarm)
+        self._warmer.daemon = True
+
+    def getReference(self, referencePath):
+        """Return the SharedReference of referencePath, resolve the
+        reference and warm it up if it is new to this server."""
+        key = real_ppath(referencePath)
+        with self._referencesLock:
+            reference = self._references.get(key)
+            if reference is None:
+                indexDir = self._tempFileManager.RegisterNewTmpFile(
+                    isDir=True, prefix="reference_index_")
+                reference = SharedReference(referencePath, indexDir)
+                self._references[key] = reference
+                logging.info("Loaded {r}".format(r=reference))
+                isNew = True
+            else:
+                isNew = False
+        if isNew:
+            self.warm([reference])
+        return reference
+
+    def warm(self, references=None):
+        """Read files of references (default: all references) into the
+        page cache."""
+        if references is None:
+            with self._referencesLock:
+                references = list(self._references.values())
+        for reference in references:
+            nbytes = warmPageCache(reference.files())
+            logging.debug("Warmed {n} bytes of {r}".format(
+                n=nbytes, r=reference.referencePath))
+
+    def _keepWarm(self):
+        """Warm all references every warmInterval seconds."""
+        while not self._stopEvent.wait(self.warmInterval):
+            self.warm()
+
+    def _takeWorker(self):
+        """Wait for an idle worker and return it, or return None if all
+        workers have exited."""
+        while True:
+            try:
+                return self._idleWorkers.get(timeout=JOB_POLL_INTERVAL)
+            except Queue.Empty:
+                if not any(worker.is_alive() for worker in self._workers):
+                    return None
+
+    def runJob(self, args):
+        """Run a pbalign job, of which options are args (a Namespace), on
+        an idle worker and return (exitCode, error message)."""
+        worker = self._takeWorker()
+        if worker is None:
+            errMsg = "All pbalign workers have exited."
+            logging.error(errMsg)
+            return 1, errMsg
+        try:
+            logging.info("Aligning {i} to {o}".format(
+                i=args.inputFileName, o=args.outputFileName))
+            try:
+                reference = self.getReference(args.referencePath)
+                runner = reference.newRunner(args)
+            except Exception as e:
+                logging.error("Failed to align {i}: {e}".format(
+                    i=args.inputFileName, e=str(e)))
+                return 1, str(e)
+            errMsg = worker.run(runner)
+        finally:
+            if worker.is_alive():
+                self._idleWorkers.put(worker)
+            else:
+                logging.error("pbalign worker {p} has exited.".format(
+                    p=worker.process.pid))
+        if errMsg is not None:
+            return 1, errMsg
+        logging.info("Generated {o}".format(o=args.outputFileName))
+        return 0, None
+
+    def _stopWorkers(self):
+        """Stop all workers after their current jobs."""
+        for worker in self._workers:
+            worker.stop()
+
+    def server_close(self):
+        """Close the socket and stop all workers."""
+        SocketServer.UnixStreamServer.server_close(self)
+        self._stopWorkers()
+
+    def serve(self):
+        """Serve until interrupted, then clean up reference index files
+        and the socket."""
+        if self.warmInterval > 0:
+            self._warmer.start()
+        logging.info("pbalign server is listening on {s}".format(
+            s=self.socketPath))
+        try:
+            self.serve_forever()
+        finally:
+            self._stopEvent.set()
+            if self._warmer.is_alive():
+                self._warmer.join()
+            self.server_close()
+            if op.exists(self.socketPath):
+                os.remove(self.socketPath)
+            self._tempFileManager.CleanUp()
+
+
+class JobHandler(SocketServer.StreamRequestHandler):
+    """Handle a connection which submits a pbalign job."""
+    def handle(self):
+        line = self.rfile.readline()
+        try:
+            args = Namespace(**json.loads(line)["args"])
+        except (ValueError, KeyError, TypeError) as e:
+            exitCode, errMsg = 1, "Bad job request: {e}".format(e=str(e))
+            logging.error(errMsg)
+        else:
+            exitCode, errMsg = self.server.runJob(args)
+        self.wfile.write(json.dumps({"exitCode": exitCode,
+                                     "error": errMsg}) + "\n")
+
+
+def resolvePaths(args):
+    """Return options of a pbalign job, args (a Namespace), as a dict in
+    which path options are absolute paths in the client's working dir."""
+    job = dict(vars(args))
+    for option in PATH_OPTIONS:
+        if job.get(option) is None:
+            continue
+        paths = job[option].split(",") if option in PATH_LIST_OPTIONS \
+            else [job[option]]
+        job[option] = ",".join(op.abspath(op.expanduser(p.strip()))
+                               for p in paths if p.strip() != "")
+    return job
+
+
+def submitJob(socketPath, args):
+    """Submit a pbalign job, of which options are args (a Namespace), to
+    the server listening on socketPath, wait for it to finish and return
+    (exitCode, error message)."""
+    job = resolvePaths(args)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socketPath)
+        sock.sendall(json.dumps({"args": job}) + "\n")
+        reply = json.loads(sock.makefile('r').readline())
+    finally:
+        sock.close()
+    return reply["exitCode"], reply["error"]
+
+
+def get_serve_parser():
+    """Return the argument parser of pbalign serve."""
+    parser = argparse.ArgumentParser(
+        prog="pbalign serve",
+        description="Run a pbalign server which keeps references warm.")
+    parser.add_argument("--socket", dest="socket", required=True,
+                        help="The Unix socket to listen on.")
+    parser.add_argument("--reference", dest="references", action="append",
+                        default=[],
+                        help="A reference to load at start up. Other " +
+                             "references are loaded on first use.")
+    parser.add_argument("--workers", dest="workers", type=int, default=1,
+                        help="Maximum number of simultaneous jobs.")
+    parser.add_argument("--warmInterval", dest="warmInterval", type=int,
+                        default=600,
+                        help="Seconds between reads of reference files " +
+                             "to keep them in the page cache. 0 disables.")
+    parser.add_argument("--tmpDir", dest="tmpDir", default="/tmp",
+                        help="A directory for reference index files.")
+    parser.add_argument("--version", action="version",
+                        version=get_version())
+    return parser
+
+
+def serve_main(argv):
+    """Main function of pbalign serve."""
+    args = get_serve_parser().parse_args(argv)
+    setup_log(logging.getLogger(), level=logging.INFO)
+    if args.workers < 1:
+        errMsg = "--workers must be at least 1."
+        logging.error(errMsg)
+        raise ValueError(errMsg)
+    if op.exists(args.socket):
+        errMsg = "Socket {s} already exists.".format(s=args.socket)
+        logging.error(errMsg)
+        raise IOError(errMsg)
+
+    server = AlignmentServer(args.socket, args.workers, args.tmpDir,
+                             args.warmInterval)
+    try:
+        for referencePath in args.references:
+            server.getReference(referencePath)
+    except Exception:
+        server.server_close()
+        os.remove(args.socket)
+        raise
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        logging.info("pbalign server stopped.")
+    return 0
+
+
+def submit_main(argv):
+    """Main function of pbalign submit."""
+    parser = argparse.ArgumentParser(prog="pbalign submit", add_help=False)
+    parser.add_argument("--socket", dest="socket", required=True)
+    args, pbalignArgs = parser.parse_known_args(argv)
+    jobArgs = get_contract_parser().arg_parser.parser.parse_args(pbalignArgs)
+    exitCode, errMsg = submitJob(args.socket, jobArgs)
+    if errMsg is not None:
+        sys.stderr.write(errMsg + "\n")
+    return exitCode
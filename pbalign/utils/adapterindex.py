@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+###############################################################################
+# Copyright (c) 2011-2013, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+###############################################################################
+
+"""This script defines class AdapterIndex, an index of adapter annotations
+of a reference, which answers whether an alignment overlaps or lies within
+an adapter in O(log n) time per query.
+
+Adapters of each reference sequence are kept in arrays sorted by start,
+along with the running maximum of their ends, so that a binary search on
+starts finds whether any adapter that starts before a position reaches
+beyond another. The index is built from the adapter GFF file of a
+reference repository once, and cached in a JSON file next to it, which is
+rebuilt whenever the GFF file changes."""
+
+from __future__ import absolute_import
+import bisect
+import json
+import logging
+import os
+
+from pbalign.utils.fileutil import real_ppath
+
+# Suffix of the cached index of an adapter GFF file.
+ADAPTER_INDEX_SUFFIX = ".index.json"
+
+# An alignment is adapter-only if it lies within this many bases of an
+# adapter.
+ADAPTER_FLANK = 10
+
+
+def parseGff(gffFileName):
+    """Return adapters in a GFF file as {reference name: [(start, end)]},
+    with 0-based, half-open coordinates."""
+    intervals = {}
+    with open(real_ppath(gffFileName), 'r') as f:
+        for line in f:
+            if line.startswith('#') or len(line.strip()) == 0:
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 5:
+                errMsg = "Malformed GFF line in {f}: {l}".format(
+                    f=gffFileName, l=line.strip())
+                logging.error(errMsg)
+                raise ValueError(errMsg)
+            refName = fields[0].split()[0]
+            intervals.setdefault(refName, []).append(
+                (int(fields[3]) - 1, int(fields[4])))
+    return intervals
+
+
+class AdapterIndex(object):
+    """Sorted arrays of adapter intervals of each reference sequence."""
+    def __init__(self, intervals):
+        """
+            Input:
+                intervals: {reference name: [(start, end)]}, 0-based and
+                           half-open.
+        """
+        self._starts, self._maxEnds = {}, {}
+        for refName, refIntervals in intervals.iteritems():
+            refIntervals = sorted(refIntervals)
+            maxEnds, maxEnd = [], None
+            for _start, end in refIntervals:
+                maxEnd = end if maxEnd is None else max(maxEnd, end)
+                maxEnds.append(maxEnd)
+            self._starts[refName] = [start for start, _end in refIntervals]
+            self._maxEnds[refName] = maxEnds
+
+    def __len__(self):
+        """Return the number of adapters."""
+        return sum(len(starts) for starts in self._starts.itervalues())
+
+    def _maxEndBefore(self, refName, pos, inclusive):
+        """Return the maximum end of adapters of refName which start before
+        pos (or at pos if inclusive), or None if there is none."""
+        starts = self._starts.get(refName)
+        if starts is None:
+            return None
+        bisectFunc = bisect.bisect_right if inclusive else bisect.bisect_left
+        i = bisectFunc(starts, pos)
+        return self._maxEnds[refName][i - 1] if i > 0 else None
+
+    def overlaps(self, refName, start, end):
+        """Return whether [start, end) of refName overlaps an adapter."""
+        maxEnd = self._maxEndBefore(refName, end, False)
+        return maxEnd is not None and maxEnd > start
+
+    def contains(self, refName, start, end, flank=0):
+        """Return whether [start, end) of refName lies within an adapter
+        extended by flank bases on both sides."""
+        maxEnd = self._maxEndBefore(refName, start + flank, True)
+        return maxEnd is not None and maxEnd + flank >= end
+
+    def isAdapterOnly(self, refName, start, end):
+        """Return whether an alignment to [start, end) of refName is an
+        adapter-only hit."""
+        return self.contains(refName, start, end, ADAPTER_FLANK)
+
+
+def _fileStamp(fileName):
+    """Return [mtime, size] of a file."""
+    st = os.stat(real_ppath(fileName))
+    return [st.st_mtime, st.st_size]
+
+
+def _loadCached(indexFileName, stamp):
+    """Return intervals cached in indexFileName if they were built from a
+    GFF file with stamp, otherwise None."""
+    try:
+        with open(indexFileName, 'r') as f:
+            entry = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if entry.get("stamp") != stamp:
+        return None
+    return dict((str(refName), [tuple(i) for i in refIntervals])
+                for refName, refIntervals in entry["intervals"].iteritems())
+
+
+def _saveCached(indexFileName, stamp, intervals):
+    """Cache intervals in indexFileName, written atomically."""
+    tmpFile = "{f}.{pid}.tmp".format(f=indexFileName, pid=os.getpid())
+    try:
+        with open(tmpFile, 'w') as f:
+            json.dump({"stamp": stamp, "intervals": intervals}, f)
+        os.rename(tmpFile, indexFileName)
+    except (IOError, OSError) as e:
+        logging.warning("Could not cache adapter index in {f}: {e}".format(
+            f=indexFileName, e=str(e)))
+
+
+# Adapter indices loaded by this process, {GFF file: (stamp, index)}.
+_loadedIndices = {}
+
+
+def LoadAdapterIndex(gffFileName):
+    """Return the AdapterIndex of an adapter GFF file, from its cached
+    index next to it if the GFF file has not changed."""
+    gffFileName = real_ppath(gffFileName)
+    stamp = _fileStamp(gffFileName)
+    loaded = _loadedIndices.get(gffFileName)
+    if loaded is not None and loaded[0] == stamp:
+        return loaded[1]
+
+    indexFileName = gffFileName + ADAPTER_INDEX_SUFFIX
+    intervals = _loadCached(indexFileName, stamp)
+    if intervals is None:
+        logging.info("Build adapter index of {f}.".format(f=gffFileName))
+        intervals = parseGff(gffFileName)
+        _saveCached(indexFileName, stamp, intervals)
+    else:
+        logging.debug("Use cached adapter index {f}.".format(
+            f=indexFileName))
+    index = AdapterIndex(intervals)
+    _loadedIndices[gffFileName] = (stamp, index)
+    return index
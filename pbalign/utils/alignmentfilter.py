@@ -0,0 +1,569 @@
+#!/usr/bin/env python
+###############################################################################
+# Copyright (c) 2011-2013, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+###############################################################################
+
+"""This script defines functions to filter alignments in process instead of
+calling samFilter: alignments which do not satisfy filter criteria, or lie
+within an adapter if an AdapterIndex is given, are removed, then a hit
+policy is applied to the remaining alignments of each read. The filter
+runs in a single thread: alignments are read in batches, whose metrics are
+computed with NumPy from CIGAR operations, and kept alignments are
+streamed to the output. It uses one core whatever --nproc is, so it is not
+faster than samFilter on multi-core hosts; it saves running samFilter and
+can gather filter statistics (see --filterStats) in the same pass.
+
+Alignments of a read must be adjacent, as aligners output them. A HitBuffer
+resolves the hit policy while alignments of a read stream through it. It
+holds one alignment at a time, or at most maxHits alignments if maxHits is
+set, or the alignments tied for the best score with allbest, so that memory
+does not grow with the size of the file.
+
+A FilterStats object counts alignments and reads rejected by each
+criterion, and histograms of aligned lengths and accuracies of mapped
+alignments, from the same batches in the same pass. An alignment is
+counted under every criterion it fails, and a read under every criterion
+which none of its alignments passes.
+
+For an alignment,
+    aligned length = bases of the read in M, =, X and I operations,
+    mismatches     = NM - inserted bases - deleted bases if it has an NM
+                     tag, otherwise bases in X operations,
+    similarity     = 100 * matches / (M, =, X, I and D bases),
+    accuracy       = 100 * (1 - (mismatches + I + D bases) / aligned length).
+"""
+
+from __future__ import absolute_import
+import heapq
+import itertools
+import json
+import logging
+import random
+
+import numpy as np
+import pysam
+
+# CIGAR operations, as numbered in the SAM format.
+CMATCH, CINS, CDEL, CREF_SKIP, CSOFT_CLIP, CHARD_CLIP, CPAD, CEQUAL, CDIFF = \
+    range(9)
+NUM_CIGAR_OPS = 9
+
+# Flag of secondary alignments.
+SECONDARY_FLAG = 0x100
+
+# Number of alignments whose metrics are computed at a time.
+BATCH_SIZE = 10000
+
+# Criteria by which alignments are rejected, in the order they are applied.
+CRITERIA = ("unmapped", "maxDivergence", "minAccuracy", "minLength",
+            "scoreCutoff", "adapterOnly")
+
+# Bin sizes of histograms of aligned lengths and of accuracies.
+LENGTH_BIN_SIZE = 100
+ACCURACY_BIN_SIZE = 1
+
+
+class FilterCriteria(object):
+    """Criteria which alignments to keep must satisfy."""
+    def __init__(self, minPctSimilarity=None, minPctAccuracy=None,
+                 minLength=None, scoreCutoff=None, scoreSign=-1):
+        self.minPctSimilarity = minPctSimilarity
+        self.minPctAccuracy = minPctAccuracy
+        self.minLength = minLength
+        self.scoreCutoff = scoreCutoff
+        self.scoreSign = scoreSign
+
+    def __repr__(self):
+        return "FilterCriteria(minPctSimilarity={s}, minPctAccuracy={a}, " \
+               "minLength={l}, scoreCutoff={c}, scoreSign={g})".format(
+                   s=self.minPctSimilarity, a=self.minPctAccuracy,
+                   l=self.minLength, c=self.scoreCutoff, g=self.scoreSign)
+
+
+def _percent(value):
+    """Return a fraction or a percentage as an integer percentage, as
+    pbalign passes to samFilter."""
+    return int(value if value > 1.0 else value * 100)
+
+
+def criteriaFromOptions(options, scoreSign):
+    """Return FilterCriteria of pbalign options."""
+    return FilterCriteria(
+        minPctSimilarity=(None if options.maxDivergence is None else
+                          100 - _percent(options.maxDivergence)),
+        minPctAccuracy=(None if options.minAccuracy is None else
+                        _percent(options.minAccuracy)),
+        minLength=options.minLength,
+        scoreCutoff=options.scoreCutoff,
+        scoreSign=scoreSign)
+
+
+def _tag(read, tag, default):
+    """Return the value of a tag of an alignment, or default."""
+    try:
+        return read.opt(tag)
+    except KeyError:
+        return default
+
+
+def alignmentMetrics(reads):
+    """Return (aligned lengths, similarities, accuracies) of a list of
+    alignments as NumPy arrays."""
+    cigars = [read.cigar or [] for read in reads]
+    counts = np.zeros((len(reads), NUM_CIGAR_OPS), dtype=np.int64)
+    if len(reads) > 0:
+        rows = np.repeat(np.arange(len(reads)), [len(c) for c in cigars])
+        ops = np.array(list(itertools.chain.from_iterable(cigars)),
+                       dtype=np.int64).reshape(-1, 2)
+        if len(ops) > 0:
+            np.add.at(counts, (rows, ops[:, 0]), ops[:, 1])
+    nm = np.array([_tag(read, "NM", -1) for read in reads], dtype=np.int64)
+
+    columns = counts[:, CMATCH] + counts[:, CEQUAL] + counts[:, CDIFF]
+    ins, dels = counts[:, CINS], counts[:, CDEL]
+    mismatches = np.where(nm >= 0, np.maximum(nm - ins - dels, 0),
+                          counts[:, CDIFF])
+    alignedLengths = columns + ins
+    matches = columns - mismatches
+    similarities = 100.0 * matches / np.maximum(columns + ins + dels, 1)
+    accuracies = 100.0 * (1.0 - (mismatches + ins + dels) /
+                          np.maximum(alignedLengths, 1).astype(float))
+    return alignedLengths, similarities, accuracies
+
+
+def passedCriteria(reads, criteria):
+    """Return ({criterion: boolean NumPy array, whether each of a list of
+    alignments passes it}, aligned lengths, accuracies). Only criteria
+    which are set are included, and unmapped alignments fail 'unmapped'."""
+    alignedLengths, similarities, accuracies = alignmentMetrics(reads)
+    passed = {"unmapped": np.array([not read.is_unmapped for read in reads],
+                                   dtype=bool)}
+    if criteria.minPctSimilarity is not None:
+        passed["maxDivergence"] = similarities >= criteria.minPctSimilarity
+    if criteria.minPctAccuracy is not None:
+        passed["minAccuracy"] = accuracies >= criteria.minPctAccuracy
+    if criteria.minLength is not None:
+        passed["minLength"] = alignedLengths >= int(criteria.minLength)
+    if criteria.scoreCutoff is not None:
+        # Alignments without scores are kept.
+        scores = np.array([_tag(read, "AS", np.nan) for read in reads],
+                          dtype=float)
+        better = (scores - float(criteria.scoreCutoff)) * \
+            criteria.scoreSign >= 0
+        passed["scoreCutoff"] = better | np.isnan(scores)
+    return passed, alignedLengths, accuracies
+
+
+def _allPassed(passed, numReads):
+    """Return a boolean NumPy array, whether each alignment passes all
+    criteria in passed."""
+    keep = np.ones(numReads, dtype=bool)
+    for mask in passed.itervalues():
+        keep &= mask
+    return keep
+
+
+def satisfies(reads, criteria):
+    """Return a boolean NumPy array, whether each of a list of alignments
+    is mapped and satisfies criteria."""
+    return _allPassed(passedCriteria(reads, criteria)[0], len(reads))
+
+
+class FilterStats(object):
+    """Counts of alignments and reads rejected by each criterion, and
+    histograms of aligned lengths and accuracies of mapped alignments."""
+    def __init__(self):
+        self.alignments = {"input": 0, "passed": 0, "output": 0,
+                           "rejectedBy": dict((c, 0) for c in CRITERIA)}
+        self.reads = {"input": 0, "passed": 0, "output": 0,
+                      "rejectedBy": dict((c, 0) for c in CRITERIA)}
+        self.lengthCounts = np.zeros(0, dtype=np.int64)
+        self.accuracyCounts = np.zeros(100 // ACCURACY_BIN_SIZE + 1,
+                                       dtype=np.int64)
+        # Name of the last read of the last batch and {criterion: whether
+        # any of its alignments so far passes it}.
+        self._pendingRead = None
+        self._pendingPassed = None
+
+    def addBatch(self, reads, passed, alignedLengths, accuracies):
+        """Count a batch of alignments in input order.
+            Input:
+                reads         : a list of alignments.
+                passed        : {criterion: boolean NumPy array, whether
+                                each alignment passes it}.
+                alignedLengths: aligned lengths of alignments.
+                accuracies    : accuracies of alignments.
+        """
+        if len(reads) == 0:
+            return
+        passed = dict(passed)
+        passed["all"] = _allPassed(passed, len(reads))
+        self.alignments["input"] += len(reads)
+        self.alignments["passed"] += int(passed["all"].sum())
+        for criterion in CRITERIA:
+            if criterion in passed:
+                self.alignments["rejectedBy"][criterion] += \
+                    int((~passed[criterion]).sum())
+
+        mapped = passed["unmapped"]
+        lengthCounts = np.bincount(alignedLengths[mapped] // LENGTH_BIN_SIZE)
+        if len(lengthCounts) > len(self.lengthCounts):
+            lengthCounts[0:len(self.lengthCounts)] += self.lengthCounts
+            self.lengthCounts = lengthCounts
+        else:
+            self.lengthCounts[0:len(lengthCounts)] += lengthCounts
+        accuracyBins = np.clip(accuracies[mapped], 0, 100).astype(np.int64) \
+            // ACCURACY_BIN_SIZE
+        self.accuracyCounts += np.bincount(
+            accuracyBins, minlength=len(self.accuracyCounts))
+
+        # Whether any alignment of each read passes each criterion, with
+        # alignments of a read adjacent.
+        qnames = np.array([read.qname for read in reads], dtype=object)
+        starts = np.flatnonzero(np.concatenate(
+            ([True], qnames[1:] != qnames[:-1])))
+        readPassed = dict((c, np.logical_or.reduceat(mask, starts))
+                          for c, mask in passed.iteritems())
+        if self._pendingRead == qnames[0]:
+            for c in readPassed:
+                readPassed[c][0] |= self._pendingPassed[c]
+        elif self._pendingRead is not None:
+            self._countReads(self._pendingPassed, 1)
+        self._countReads(dict((c, r[:-1]) for c, r in readPassed.iteritems()),
+                         len(starts) - 1)
+        self._pendingRead = qnames[-1]
+        self._pendingPassed = dict((c, r[-1]) for c, r in
+                                   readPassed.iteritems())
+
+    def _countReads(self, readPassed, numReads):
+        """Count reads, given whether any of their alignments passes each
+        criterion."""
+        self.reads["input"] += numReads
+        self.reads["passed"] += int(np.sum(readPassed["all"]))
+        for criterion in CRITERIA:
+            if criterion in readPassed:
+                self.reads["rejectedBy"][criterion] += \
+                    int(np.sum(~np.asarray(readPassed[criterion])))
+
+    def addOutput(self, read):
+        """Count an alignment kept after applying the hit policy."""
+        self.alignments["output"] += 1
+        if isPrimary(read):
+            self.reads["output"] += 1
+
+    def finish(self):
+        """Count the last read."""
+        if self._pendingRead is not None:
+            self._countReads(self._pendingPassed, 1)
+            self._pendingRead, self._pendingPassed = None, None
+
+    def toDict(self):
+        """Return counts and histograms as a dict."""
+        stats = {"histograms": {
+            "alignedLength": {"binSize": LENGTH_BIN_SIZE,
+                              "counts": self.lengthCounts.tolist()},
+            "accuracy": {"binSize": ACCURACY_BIN_SIZE,
+                         "counts": self.accuracyCounts.tolist()}}}
+        for name, counts in (("alignments", self.alignments),
+                             ("reads", self.reads)):
+            counts = dict(counts)
+            counts["rejectedBy"] = dict(counts["rejectedBy"])
+            counts["rejectedBy"]["hitPolicy"] = \
+                counts["passed"] - counts["output"]
+            stats[name] = counts
+        return stats
+
+    def write(self, fileName):
+        """Write counts and histograms to a JSON file."""
+        with open(fileName, 'w') as f:
+            json.dump(self.toDict(), f, indent=2, sort_keys=True)
+
+
+def _rank(read, scoreSign):
+    """Return a key by which better alignments of a read sort first."""
+    try:
+        return -scoreSign * read.opt("AS")
+    except KeyError:
+        return float("inf")
+
+
+def selectHits(hits, hitPolicy, maxHits, scoreSign, rng):
+    """Return alignments of a read to keep according to hitPolicy, given
+    all of its alignments in hits.
+        Input:
+            hits     : alignments of a read, of which at most maxHits
+                       best ones are considered.
+            hitPolicy: randombest, allbest, random, all or leftmost.
+            maxHits  : the maximum number of hits, None if unlimited.
+            scoreSign: -1 if lower scores are better, 1 otherwise.
+            rng      : a random.Random object.
+        Output:
+            a list of alignments to keep, the primary one first.
+    """
+    hits = sorted(hits, key=lambda read: _rank(read, scoreSign))
+    if maxHits is not None and maxHits != "":
+        hits = hits[0:int(maxHits)]
+    if len(hits) == 0 or hitPolicy == "all":
+        return hits
+    if hitPolicy == "random":
+        return [rng.choice(hits)]
+
+    bestRank = _rank(hits[0], scoreSign)
+    best = [read for read in hits if _rank(read, scoreSign) == bestRank]
+    if hitPolicy == "allbest":
+        return best
+    elif hitPolicy == "randombest":
+        return [rng.choice(best)]
+    elif hitPolicy == "leftmost":
+        return [min(best, key=lambda read: (read.tid, read.pos))]
+    raise ValueError("Unsupported hit policy {p}.".format(p=hitPolicy))
+
+
+def setPrimary(hits):
+    """Mark the first alignment as primary and others as secondary."""
+    for i, read in enumerate(hits):
+        if i == 0:
+            read.flag &= ~SECONDARY_FLAG
+        else:
+            read.flag |= SECONDARY_FLAG
+
+
+class HitBuffer(object):
+    """A bounded buffer of alignments of the current read, which resolves a
+    hit policy as alignments are added one by one."""
+    def __init__(self, hitPolicy, maxHits, scoreSign, rng):
+        """
+            Input:
+                hitPolicy: randombest, allbest, random, all or leftmost.
+                maxHits  : the maximum number of hits, None if unlimited.
+                scoreSign: -1 if lower scores are better, 1 otherwise.
+                rng      : a random.Random object.
+        """
+        if hitPolicy not in ("randombest", "allbest", "random", "all",
+                             "leftmost"):
+            raise ValueError("Unsupported hit policy {p}.".format(
+                p=hitPolicy))
+        self.hitPolicy = hitPolicy
+        self.maxHits = None if maxHits is None or maxHits == "" \
+            else int(maxHits)
+        self.scoreSign = scoreSign
+        self.rng = rng
+        self._reset()
+
+    def _reset(self):
+        """Forget alignments of the current read."""
+        # Alignments held back, (-rank, -index, read) in a heap if maxHits
+        # is set, so that the worst one is popped first.
+        self._held = []
+        self._bestRank = None
+        self._numHits = 0
+        self._numBest = 0
+
+    def __len__(self):
+        """Return the number of alignments held."""
+        return len(self._held)
+
+    def add(self, read):
+        """Add an alignment of the current read. Return alignments which
+        can be output already, as secondary ones."""
+        rank = _rank(read, self.scoreSign)
+        self._numHits += 1
+        if self.maxHits is not None:
+            # The best maxHits hits, the earliest ones among ties, as
+            # selectHits considers.
+            entry = (-rank, -self._numHits, read)
+            if len(self._held) < self.maxHits:
+                heapq.heappush(self._held, entry)
+            elif self.maxHits > 0 and entry > self._held[0]:
+                heapq.heapreplace(self._held, entry)
+            return []
+
+        isBetter = self._bestRank is None or rank < self._bestRank
+        isTied = rank == self._bestRank
+        if isBetter:
+            self._bestRank = rank
+        if self.hitPolicy == "all":
+            # Hold the best hit to output it as the primary one.
+            if isBetter:
+                emitted, self._held = self._held, [read]
+                return self._secondary(emitted)
+            return self._secondary([read])
+        elif self.hitPolicy == "random":
+            # Reservoir sampling of one hit.
+            if self.rng.randrange(self._numHits) == 0:
+                self._held = [read]
+        elif self.hitPolicy == "allbest":
+            if isBetter:
+                self._held = [read]
+            elif isTied:
+                self._held.append(read)
+        elif self.hitPolicy == "randombest":
+            if isBetter:
+                self._held, self._numBest = [read], 1
+            elif isTied:
+                self._numBest += 1
+                if self.rng.randrange(self._numBest) == 0:
+                    self._held = [read]
+        elif self.hitPolicy == "leftmost":
+            if isBetter or (isTied and (read.tid, read.pos) <
+                            (self._held[0].tid, self._held[0].pos)):
+                self._held = [read]
+        return []
+
+    def flush(self):
+        """Return the remaining alignments to output of the current read,
+        the primary one first, and start a new read."""
+        if self.maxHits is not None:
+            hits = [read for _r, _i, read in
+                    sorted(self._held, reverse=True)]
+            hits = selectHits(hits, self.hitPolicy, None, self.scoreSign,
+                              self.rng)
+        else:
+            hits = self._held
+        setPrimary(hits)
+        self._reset()
+        return hits
+
+    @staticmethod
+    def _secondary(hits):
+        """Mark alignments as secondary and return them."""
+        for read in hits:
+            read.flag |= SECONDARY_FLAG
+        return hits
+
+
+def resolveHits(reads, hitPolicy, maxHits, scoreSign, rng):
+    """Apply hitPolicy (and maxHits) to alignments of each read in reads,
+    in which alignments of a read are adjacent. Yield alignments to keep."""
+    hitBuffer = HitBuffer(hitPolicy, maxHits, scoreSign, rng)
+    qname = None
+    for read in reads:
+        if read.qname != qname:
+            for hit in hitBuffer.flush():
+                yield hit
+            qname = read.qname
+        for hit in hitBuffer.add(read):
+            yield hit
+    for hit in hitBuffer.flush():
+        yield hit
+
+
+def isPrimary(read):
+    """Return whether an alignment is the primary one of its read."""
+    return read.flag & SECONDARY_FLAG == 0
+
+
+def adapterOnly(reads, refNames, adapterIndex):
+    """Return a boolean NumPy array, whether each of a list of mapped
+    alignments is an adapter-only hit.
+        Input:
+            reads       : a list of mapped alignments.
+            refNames    : reference names indexed by target ids.
+            adapterIndex: an AdapterIndex of adapter annotations.
+    """
+    return np.array([adapterIndex.isAdapterOnly(refNames[read.tid],
+                                                read.pos, read.aend)
+                     for read in reads], dtype=bool)
+
+
+def keptReads(inSam, criteria, batchSize, counts, adapterIndex=None,
+               stats=None):
+    """Yield alignments in inSam which satisfy criteria and are not
+    adapter-only hits, in order, count alignments read in counts["in"],
+    and count rejected alignments in stats if it is not None."""
+    reads = iter(inSam)
+    while True:
+        batch = list(itertools.islice(reads, batchSize))
+        if len(batch) == 0:
+            if stats is not None:
+                stats.finish()
+            return
+        counts["in"] += len(batch)
+        passed, alignedLengths, accuracies = passedCriteria(batch, criteria)
+        if adapterIndex is not None:
+            mapped = np.flatnonzero(passed["unmapped"])
+            passed["adapterOnly"] = np.ones(len(batch), dtype=bool)
+            passed["adapterOnly"][mapped] = ~adapterOnly(
+                [batch[i] for i in mapped], inSam.references, adapterIndex)
+        if stats is not None:
+            stats.addBatch(batch, passed, alignedLengths, accuracies)
+        keep = _allPassed(passed, len(batch))
+        for read, kept in itertools.izip(batch, keep):
+            if kept:
+                yield read
+
+
+def samMode(fileName, write, compressionLevel=None):
+    """Return the pysam mode to read or write a SAM or BAM file, which is
+    compressed at compressionLevel (0-9) if it is not None."""
+    isBam = fileName.endswith(".bam")
+    if write:
+        if not isBam:
+            return 'wh'
+        return 'wb' if compressionLevel is None else \
+            'wb{n}'.format(n=compressionLevel)
+    return 'rb' if isBam else 'r'
+
+
+def filterAlignments(inSamFile, outSamFile, criteria, hitPolicy,
+                     maxHits=None, seed=1, batchSize=BATCH_SIZE,
+                     adapterIndex=None, stats=None, compressionLevel=None):
+    """Remove alignments in inSamFile which do not satisfy criteria, and
+    adapter-only hits if adapterIndex is given, apply hitPolicy (and
+    maxHits) to the remaining alignments of each read, and write kept
+    alignments to outSamFile. Alignments of a read must be adjacent in
+    inSamFile. Count rejected alignments and reads in stats, a FilterStats
+    object, if it is not None. A BAM outSamFile is compressed at
+    compressionLevel if it is not None, e.g., a low level if it is sorted
+    right after. Return (number of alignments read, number of alignments
+    written)."""
+    rng = random.Random(seed)
+    counts = {"in": 0, "out": 0}
+    inSam = pysam.Samfile(inSamFile, samMode(inSamFile, False))
+    try:
+        outSam = pysam.Samfile(outSamFile,
+                               samMode(outSamFile, True, compressionLevel),
+                               template=inSam)
+        try:
+            for read in resolveHits(
+                    keptReads(inSam, criteria, batchSize, counts,
+                              adapterIndex, stats),
+                    hitPolicy, maxHits, criteria.scoreSign, rng):
+                outSam.write(read)
+                counts["out"] += 1
+                if stats is not None:
+                    stats.addOutput(read)
+        finally:
+            outSam.close()
+    finally:
+        inSam.close()
+    logging.info("Kept {n} of {m} alignments by {c} and hit policy {p}.".
+                 format(n=counts["out"], m=counts["in"], c=criteria,
+                        p=hitPolicy))
+    return counts["in"], counts["out"]
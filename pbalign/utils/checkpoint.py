@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+###############################################################################
+# Copyright (c) 2011-2013, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+###############################################################################
+
+"""This script defines class Checkpoint, which records completed stages of a
+pbalign run in a JSON manifest, so that a failed run can be resumed without
+repeating stages that have been done."""
+
+from __future__ import absolute_import
+import hashlib
+import json
+import logging
+import os
+from os import path
+
+from pbalign.utils.fileutil import real_ppath
+
+# Stages of a pbalign run and their order. A stage depends on all stages of
+# lower orders, while bai and pbi do not depend on each other.
+STAGE_ORDERS = {"align": 0, "filter": 1, "sort": 2, "bai": 3, "pbi": 3,
+                "output": 4}
+
+# Options which affect results of a pbalign run, and so identify it. Any
+# other option, e.g., where temporary files are kept or how much memory
+# they may use, does not change the hash of a run.
+HASHED_OPTIONS = ("inputFileName", "referencePath", "outputFileName",
+                  "regionTable", "configFile", "pulseFile",
+                  "algorithm", "algorithmOptions", "maxHits",
+                  "minAnchorSize", "useccs", "noSplitSubreads", "concordant",
+                  "nproc", "shards", "streaming", "maxReferenceChunkSize",
+                  "maxDivergence", "minAccuracy", "minLength",
+                  "scoreFunction", "scoreMatrix", "scoreCutoff", "hitPolicy",
+                  "seed", "filterAdapterOnly", "filterEngine", "filterStats",
+                  "unaligned", "metrics", "readType", "forQuiver", "loadQVs",
+                  "byread", "compressionLevel")
+
+# Size of blocks at the head and tail of a file to compute its checksum.
+CHECKSUM_BLOCK_SIZE = 1 << 20
+
+
+def fileChecksum(fileName):
+    """Return a checksum of a file, computed from its size and md5 of its
+    first and last blocks, which is cheap to compute on very large files
+    while still detecting truncated or rewritten files."""
+    fileName = real_ppath(fileName)
+    size = path.getsize(fileName)
+    md5 = hashlib.md5(str(size))
+    with open(fileName, 'rb') as f:
+        md5.update(f.read(CHECKSUM_BLOCK_SIZE))
+        if size > CHECKSUM_BLOCK_SIZE:
+            f.seek(max(CHECKSUM_BLOCK_SIZE, size - CHECKSUM_BLOCK_SIZE))
+            md5.update(f.read(CHECKSUM_BLOCK_SIZE))
+    return md5.hexdigest()
+
+
+def runHash(options, inputFiles):
+    """Return a hash of pbalign options and input files (by path, size and
+    modification time), which identifies a pbalign run."""
+    optionsDict = dict((k, v) for k, v in vars(options).iteritems()
+                       if k in HASHED_OPTIONS)
+    inputsList = []
+    for fileName in inputFiles:
+        if fileName is None:
+            continue
+        fileName = real_ppath(fileName)
+        if path.exists(fileName):
+            stat = os.stat(fileName)
+            inputsList.append((fileName, stat.st_size, int(stat.st_mtime)))
+        else:
+            inputsList.append((fileName, None, None))
+    return hashlib.sha1(json.dumps([optionsDict, inputsList],
+                                   sort_keys=True, default=str)).hexdigest()
+
+
+class Checkpoint(object):
+    """Checkpoint manifest of a pbalign run.
+
+    The manifest records, for each completed stage (e.g., align, filter,
+    sort, bai, pbi and output), files produced by this stage and their
+    checksums. A stage is done only if the manifest was written by a run
+    with the same hash, and all its files still have the same checksums.
+    If not enabled, no stage is done and nothing is recorded.
+    """
+    def __init__(self, fileName, runHash, enabled=True):
+        self.fileName = fileName
+        self.runHash = runHash
+        self.enabled = enabled
+        self.stages = {}
+        if self.enabled:
+            self._load()
+
+    def __repr__(self):
+        return "Checkpoint({f}, stages = {s})".format(
+            f=self.fileName, s=",".join(sorted(self.stages.keys())))
+
+    def _load(self):
+        """Load completed stages from the manifest if it exists and was
+        written by the same run."""
+        if not path.exists(self.fileName):
+            return
+        try:
+            with open(self.fileName, 'r') as f:
+                manifest = json.load(f)
+        except (IOError, ValueError) as e:
+            logging.warning("Ignore unreadable checkpoint manifest " +
+                            "{f}: {e}".format(f=self.fileName, e=str(e)))
+            return
+        if manifest.get("runHash") != self.runHash:
+            logging.info("Checkpoint manifest {f} was written by a ".format(
+                f=self.fileName) + "different run, ignore it.")
+            return
+        self.stages = manifest.get("stages", {})
+
+    def _write(self):
+        """Write the manifest atomically."""
+        tmpFileName = self.fileName + ".tmp"
+        with open(tmpFileName, 'w') as f:
+            json.dump({"runHash": self.runHash, "stages": self.stages}, f,
+                      indent=2, sort_keys=True)
+        os.rename(tmpFileName, self.fileName)
+
+    def isDone(self, stage):
+        """Return True if stage has been done and its files are intact."""
+        if not self.enabled or stage not in self.stages:
+            return False
+        for fileName, checksum in self.stages[stage]:
+            if not path.exists(real_ppath(fileName)) or \
+               fileChecksum(fileName) != checksum:
+                logging.info("Checkpoint: {f} of stage {s} ".format(
+                    f=fileName, s=stage) + "has changed, redo this stage.")
+                del self.stages[stage]
+                return False
+        logging.info("Checkpoint: skip stage {s} which has been done.".
+                     format(s=stage))
+        return True
+
+    def files(self, stage):
+        """Return files produced by a completed stage."""
+        return [fileName for fileName, _checksum in self.stages[stage]]
+
+    def markDone(self, stage, fileNames):
+        """Record that stage is done and has produced fileNames. Since
+        later stages depend on this one, forget all of them."""
+        if not self.enabled:
+            return
+        for laterStage in self.stages.keys():
+            if STAGE_ORDERS[laterStage] > STAGE_ORDERS[stage]:
+                del self.stages[laterStage]
+        self.stages[stage] = [(fileName, fileChecksum(fileName))
+                              for fileName in fileNames]
+        self._write()
+        logging.debug("Checkpoint: stage {s} is done.".format(s=stage))
@@ -35,10 +35,17 @@
 """This scripts defines functions for handling input and output files."""
 
 from __future__ import absolute_import
+import errno
+import gzip
+import os
 import os.path as op
 import logging
+import select
+import time
+import zlib
+from multiprocessing.pool import ThreadPool
+from urlparse import urlparse
 from xml.etree import ElementTree as ET
-from pbcore.util.Process import backticks
 from pbcore.io import DataSet, ReferenceSet
 
 
@@ -63,6 +70,16 @@ VALID_REGIONTABLE_FORMATS = (FILE_FORMATS.RGN, FILE_FORMATS.FOFN)
 VALID_OUTPUT_FORMATS = (FILE_FORMATS.CMP, FILE_FORMATS.SAM,
                         FILE_FORMATS.BAM, FILE_FORMATS.XML)
 
+# Errors of stat which may go away if retried, e.g., a stale NFS handle.
+RETRIABLE_STAT_ERRNOS = (errno.ESTALE, errno.EIO, errno.EAGAIN, errno.EINTR)
+STAT_RETRIES = 3
+STAT_RETRY_DELAY = 0.1
+# Number of threads to check existence of many files.
+ISEXIST_THREADS = 16
+
+# The first bytes of a decompressed BAM file.
+BAM_MAGIC = "BAM\x01"
+
 
 def real_ppath(fn):
     """Return real 'python-style' path of a file.
@@ -94,15 +111,86 @@ def real_upath(fn):
     return real_ppath(fn).replace(' ', r'\ ')
 
 
+def _isListed(fn):
+    """Return whether fn is listed in its parent directory. Listing a
+    directory on NFS revalidates the client's cached view of it, which may
+    still claim that a file created by another host does not exist."""
+    parent, name = op.split(fn)
+    try:
+        return name in os.listdir(parent)
+    except OSError:
+        return False
+
+
 def isExist(ff):
     """Return whether a file or a dir ff exists or not.
-    Call ls instead of python os.path.exists to eliminate NFS errors.
+    Call stat in process, which is NFS-safe: retry if stat fails with a
+    transient error (e.g., a stale file handle), and if stat says that ff
+    does not exist, look it up again in its freshly listed parent dir.
     """
     if ff is None:
         return False
-    cmd = "ls %s" % real_upath(ff)
-    _output, errCode, _errMsg = backticks(cmd)
-    return (errCode == 0)
+    fn = real_ppath(ff)
+    for attempt in range(STAT_RETRIES):
+        try:
+            os.stat(fn)
+            return True
+        except OSError as e:
+            if e.errno not in RETRIABLE_STAT_ERRNOS:
+                return _isListed(fn)
+            time.sleep(STAT_RETRY_DELAY * (2 ** attempt))
+    return _isListed(fn)
+
+
+def checkExist(files, nproc=ISEXIST_THREADS):
+    """Return a list of whether each file or dir in files exists or not,
+    checked by isExist() on a pool of at most nproc threads, so that
+    latencies of network file systems overlap."""
+    files = list(files)
+    nproc = min(nproc, len(files))
+    if nproc <= 1:
+        return [isExist(ff) for ff in files]
+    pool = ThreadPool(nproc)
+    try:
+        return pool.map(isExist, files)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def releaseFifoReader(fifo):
+    """Send EOF to a process which is reading or waiting to read a named
+    pipe, by opening and closing the pipe for writing. Return False if
+    nobody has opened the pipe for reading yet.
+    """
+    try:
+        fd = os.open(real_ppath(fifo), os.O_WRONLY | os.O_NONBLOCK)
+    except OSError:
+        # ENXIO, no reader has opened the pipe.
+        return False
+    os.close(fd)
+    return True
+
+
+def drainFifo(fifo, stopEvent, timeout=1):
+    """Read and discard everything written to a named pipe until stopEvent
+    is set, so that a writer whose reader has died will neither block on
+    opening the pipe nor on writing to it.
+    """
+    fd = os.open(real_ppath(fifo), os.O_RDONLY | os.O_NONBLOCK)
+    try:
+        while not stopEvent.is_set():
+            readable, _w, _x = select.select([fd], [], [], timeout)
+            if len(readable) == 0:
+                continue
+            try:
+                if os.read(fd, 1 << 16) == "":
+                    # No writer at the moment, wait for the next one.
+                    stopEvent.wait(timeout)
+            except OSError:
+                pass
+    finally:
+        os.close(fd)
 
 
 def isValidInputFormat(ff):
@@ -181,11 +269,12 @@ def getFileFormatsFromFOFN(fofnname):
     fs = getFilesFromFOFN(fofnname)
     return [getFileFormat(f) for f in fs]
 
-def checkInputFile(filename, validFormats=VALID_INPUT_FORMATS):
+def checkInputFile(filename, validFormats=VALID_INPUT_FORMATS,
+                   checkFofnFiles=True):
     """
     Check whether an input file has the valid file format and exists.
-    If an input file is a fofn, check whether all files names in the
-    fofn exist.
+    If an input file is a fofn and checkFofnFiles is True, check whether
+    all files names in the fofn exist.
     Return a list of absolute paths of all input files.
     """
     filename = real_ppath(filename)
@@ -200,24 +289,112 @@ def checkInputFile(filename, validFormats=VALID_INPUT_FORMATS):
         logging.error(errMsg)
         raise IOError(errMsg)
 
-    if getFileFormat(filename) == FILE_FORMATS.FOFN:
+    if getFileFormat(filename) == FILE_FORMATS.FOFN and checkFofnFiles:
         fileList = getFilesFromFOFN(filename)
         if len(fileList) == 0:
             errMsg = "FOFN file {fn} is empty.".format(fn=filename)
             logging.error(errMsg)
             raise ValueError(errMsg)
-        fileListRet = []
-        for f in fileList:
-            if not isExist(f):
+        for f, exists in zip(fileList, checkExist(fileList)):
+            if not exists:
                 errMsg = "A file in the fofn {fn} does not exist.".format(fn=f)
                 logging.error(errMsg)
                 raise IOError(errMsg)
-            else:
-                fileListRet.append(f)
 
     return real_upath(filename)
 
 
+def getDataSetResources(xmlFileName):
+    """Return read files, i.e., top-level external resources, of a dataset
+    XML and of its sub-datasets as a list of (read file, its .pbi file or
+    None). Resources nested in a read file's resource, e.g. scraps.bam of
+    subreads.bam, are not read files. Only the XML is parsed, none of the
+    read files is opened."""
+    xmlFileName = real_ppath(xmlFileName)
+    xmlDir = op.dirname(xmlFileName)
+
+    def localName(element):
+        """Return tag of an element without its namespace."""
+        return element.tag.rpartition('}')[2]
+
+    def children(element, name):
+        """Return direct children of an element of a tag."""
+        return [child for child in element if localName(child) == name]
+
+    def resourcePath(element):
+        """Return the absolute path of a ResourceId."""
+        rid = urlparse(element.get("ResourceId", "")).path
+        return real_upath(op.join(xmlDir, rid))
+
+    def pbiPath(resource):
+        """Return the .pbi file of a resource, or None."""
+        for indices in children(resource, "FileIndices"):
+            for index in children(indices, "FileIndex"):
+                if index.get("MetaType", "").endswith("PacBioIndex"):
+                    return resourcePath(index)
+        return None
+
+    resources = []
+    def addResources(dataSet):
+        """Add resources of a dataset and of its sub-datasets."""
+        for resourcesElem in children(dataSet, "ExternalResources"):
+            for resource in children(resourcesElem, "ExternalResource"):
+                readFile = (resourcePath(resource), pbiPath(resource))
+                if readFile not in resources:
+                    resources.append(readFile)
+        for subDataSets in children(dataSet, "DataSets"):
+            for subDataSet in subDataSets:
+                addResources(subDataSet)
+
+    addResources(ET.parse(xmlFileName).getroot())
+    return resources
+
+
+def isBamFile(fileName):
+    """Return whether a file is a BAM file, i.e., it is BGZF (gzip)
+    compressed and its content starts with the BAM magic."""
+    try:
+        with gzip.open(real_ppath(fileName), 'rb') as f:
+            return f.read(len(BAM_MAGIC)) == BAM_MAGIC
+    except (IOError, OSError, EOFError, zlib.error):
+        return False
+
+
+def _validateReadFile(readFile):
+    """Return (error message or None, whether .pbi exists) of a read file
+    and its .pbi file (None to look for readFile.pbi)."""
+    readFile, pbiFile = readFile
+    if not isExist(readFile):
+        return "{f} does not exist.".format(f=readFile), False
+    if getFileFormat(readFile) != FILE_FORMATS.BAM:
+        return None, False
+    if not isBamFile(readFile):
+        return "{f} is not a BAM file.".format(f=readFile), False
+    return None, isExist(pbiFile if pbiFile is not None else
+                         real_ppath(readFile) + ".pbi")
+
+
+def validateReadFiles(readFiles, nproc=ISEXIST_THREADS):
+    """Validate read files on a pool of at most nproc threads: every file
+    must exist and every BAM file must start with the BAM magic.
+        Input:
+            readFiles: a list of (read file, .pbi file or None)
+            nproc    : number of threads
+        Output:
+            a list of (error message or None, whether .pbi exists)
+    """
+    readFiles = list(readFiles)
+    nproc = min(nproc, len(readFiles))
+    if nproc <= 1:
+        return [_validateReadFile(f) for f in readFiles]
+    pool = ThreadPool(nproc)
+    try:
+        return pool.map(_validateReadFile, readFiles)
+    finally:
+        pool.close()
+        pool.join()
+
+
 def getRealFileFormat(filename):
     """Return file format if filename is not a FOFN, otherwise return format
     of the first file within FOFN."""
@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+###############################################################################
+# Copyright (c) 2011-2013, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+###############################################################################
+
+"""This script defines class PlanStage and helpers to estimate resources of
+stages of a pbalign run from sizes of input, .pbi and reference files, so
+that a run can be planned (see pbalign --plan) without running anything.
+All estimates are rough upper bounds in bytes."""
+
+from __future__ import absolute_import
+import gzip
+import logging
+import struct
+import sys
+from copy import copy
+from os import path
+
+from pbalign.filterservice import FilterService
+from pbalign.utils.fileutil import real_ppath, getFileFormat, FILE_FORMATS
+
+# Size of aligned BAM records relative to unaligned input BAM records.
+ALIGNED_BAM_RATIO = 1.2
+# Size of SAM relative to BAM.
+SAM_RATIO = 3.0
+# Size of reference index files relative to the reference FASTA file, for
+# aligners which do not use a suffix array.
+INDEX_RATIOS = {"bowtie": 1.0, "gmap": 4.0}
+# Memory of a process, besides the data it loads.
+BASE_MEMORY = 256 * 1024 * 1024
+# Memory of each aligner thread.
+MEMORY_PER_ALIGN_THREAD = 256 * 1024 * 1024
+# Memory of pbindex per read.
+PBI_MEMORY_PER_READ = 64
+# Size of .bai relative to BAM.
+BAI_RATIO = 0.001
+
+# How a pbalign run aligns reads: against chunks of the reference, by
+# shards of the input, streaming into 'samtools sort', or by default.
+RUN_MODES = ("chunks", "shards", "streaming", "default")
+
+
+class PlanStage(object):
+    """A stage of a planned pbalign run."""
+    def __init__(self, name, cmd, dependsOn=(), inputBytes=0, tempBytes=0,
+                 outputBytes=0, memoryBytes=BASE_MEMORY, threads=1,
+                 freedAfter=None):
+        """Initialize a PlanStage object.
+            Input:
+                name       : stage name, e.g., align, sort or bai
+                cmd        : the command line of this stage
+                dependsOn  : names of stages which must be done before
+                inputBytes : estimated bytes this stage reads
+                tempBytes  : estimated temporary disk space this stage needs
+                outputBytes: estimated bytes of final outputs of this stage
+                memoryBytes: estimated peak memory of this stage
+                threads    : number of threads of this stage
+                freedAfter : name of the stage after which temporary files
+                             of this stage are deleted, by default the last
+                             stage which depends on this stage
+        """
+        self.name = name
+        self.cmd = cmd
+        self.dependsOn = list(dependsOn)
+        self.inputBytes = int(inputBytes)
+        self.tempBytes = int(tempBytes)
+        self.outputBytes = int(outputBytes)
+        self.memoryBytes = int(memoryBytes)
+        self.threads = int(threads)
+        self.freedAfter = freedAfter
+
+    def __repr__(self):
+        return "PlanStage({n}, depends on {d})".format(
+            n=self.name, d=",".join(self.dependsOn))
+
+    def toDict(self):
+        """Return a dict of this stage which can be dumped to JSON."""
+        return {"name": self.name, "cmd": self.cmd,
+                "dependsOn": self.dependsOn,
+                "inputBytes": self.inputBytes,
+                "tempBytes": self.tempBytes,
+                "outputBytes": self.outputBytes,
+                "memoryBytes": self.memoryBytes,
+                "threads": self.threads}
+
+
+def fileSize(fileName):
+    """Return size of a file, or 0 if it does not exist."""
+    if fileName is None:
+        return 0
+    fileName = real_ppath(fileName)
+    return path.getsize(fileName) if path.isfile(fileName) else 0
+
+
+def pbiNumReads(pbiFile):
+    """Return number of reads recorded in the header of a .pbi file, or None
+    if the .pbi file does not exist or can not be read. A .pbi file is BGZF
+    compressed, and its header is magic (4 bytes), version (4 bytes),
+    flags (2 bytes) and number of reads (4 bytes)."""
+    if not path.isfile(pbiFile):
+        return None
+    try:
+        with gzip.open(pbiFile, 'rb') as f:
+            header = f.read(14)
+    except (IOError, OSError):
+        return None
+    if len(header) < 14 or header[0:3] != "PBI":
+        return None
+    return struct.unpack("<I", header[10:14])[0]
+
+
+def numReads(readFileNames):
+    """Return total number of reads of BAM files according to their .pbi
+    files, or None if any of them is unknown."""
+    total = 0
+    for fileName in readFileNames:
+        n = pbiNumReads(real_ppath(fileName) + ".pbi")
+        if n is None:
+            return None
+        total += n
+    return total
+
+
+def alignerMemory(algorithm, referenceBytes, saBytes, nproc):
+    """Return estimated peak memory of an aligner, which loads the
+    reference and its index."""
+    if algorithm == "blasr":
+        indexBytes = saBytes
+    else:
+        indexBytes = referenceBytes * INDEX_RATIOS.get(algorithm, 1.0)
+    return BASE_MEMORY + referenceBytes + indexBytes + \
+        MEMORY_PER_ALIGN_THREAD * nproc
+
+
+def _depths(stages):
+    """Return depths of planned stages in the DAG by name."""
+    depths = {}
+    for stage in stages: # Stages are in topological order.
+        depths[stage.name] = 1 + max([depths[d] for d in stage.dependsOn]
+                                     or [-1])
+    return depths
+
+
+def peakMemory(stages):
+    """Return estimated peak memory of planned stages. Stages of the same
+    depth in the DAG (e.g., shards, or bai and pbi) may run at the same
+    time, so their memory adds up."""
+    depths = _depths(stages)
+    memory = {}
+    for stage in stages:
+        depth = depths[stage.name]
+        memory[depth] = memory.get(depth, 0) + stage.memoryBytes
+    return max(memory.values()) if len(memory) > 0 else 0
+
+
+def peakTempBytes(stages):
+    """Return estimated peak temporary space of planned stages. Temporary
+    files of a stage are deleted after its freedAfter stage, or after the
+    last stage which depends on it, so the peak is the largest amount of
+    temporary data alive at the same time: outputs of the stages which
+    are running plus the inputs they still hold."""
+    depths = _depths(stages)
+    lastDepths = dict((stage.name, depths[stage.name]) for stage in stages)
+    for stage in stages:
+        for d in stage.dependsOn:
+            lastDepths[d] = max(lastDepths[d], depths[stage.name])
+    alive = {}
+    for stage in stages:
+        lastDepth = depths[stage.freedAfter] \
+            if stage.freedAfter is not None else lastDepths[stage.name]
+        for depth in range(depths[stage.name], lastDepth + 1):
+            alive[depth] = alive.get(depth, 0) + stage.tempBytes
+    return max(alive.values()) if len(alive) > 0 else 0
+
+
+def routeLoggingToStderr():
+    """Make log handlers which write to stdout write to stderr instead,
+    so that stdout carries nothing but the plan."""
+    loggers = [logging.getLogger()] + \
+        [logger for logger in logging.Logger.manager.loggerDict.values()
+         if isinstance(logger, logging.Logger)]
+    for logger in loggers:
+        for handler in logger.handlers:
+            if isinstance(handler, logging.StreamHandler) and \
+               getattr(handler, "stream", None) is sys.stdout:
+                handler.stream = sys.stderr
+
+
+def planStages(args, fileNames, alnService, newPostService, tmpDir, mode):
+    """Build every command of a pbalign run without running any of them,
+    and return the stage DAG of this run as a list of PlanStage objects,
+    with input bytes, temporary space, output bytes and memory of each
+    stage estimated from sizes of reads, .pbi and reference files.
+    Planned temporary files are set on a copy of fileNames, which is left
+    as it is.
+        Input:
+            args          : pbalign options
+            fileNames     : PBAlignFiles of the run
+            alnService    : the AlignService of the run
+            newPostService: a function which returns a BamPostService of
+                            (fileNames, shares=1, intermediate=False)
+            tmpDir        : the directory of planned temporary files
+            mode          : how the run aligns, one of RUN_MODES
+        Output:
+            a list of PlanStage objects in topological order
+    """
+    fileNames = copy(fileNames)
+    outFormat = getFileFormat(fileNames.outputFileName)
+    isBam = outFormat in [FILE_FORMATS.BAM, FILE_FORMATS.XML]
+    nproc = int(args.nproc)
+    suffix = ".bam" if isBam else ".sam"
+
+    reads = fileNames.GetInputResources()
+    readsBytes = sum(fileSize(f) for f in reads)
+    nReads = numReads(reads)
+    referenceBytes = fileSize(fileNames.targetFileName)
+    saBytes = fileSize(fileNames.sawriterFileName)
+    alignedBytes = readsBytes * ALIGNED_BAM_RATIO * \
+        (1 if isBam else SAM_RATIO)
+    pbiMemory = BASE_MEMORY + PBI_MEMORY_PER_READ * (nReads or 0)
+
+    def postStages(postService, dependsOn, sortedBamFiles=None,
+                   isSorted=False):
+        """Return stages of postService: sort or merge, bai and pbi."""
+        stages = []
+        for stage, cmd in postService.plannedCmds(isSorted,
+                                                  sortedBamFiles):
+            if stage in ("sort", "merge"):
+                stages.append(PlanStage(
+                    stage, cmd, dependsOn, inputBytes=alignedBytes,
+                    tempBytes=alignedBytes, outputBytes=alignedBytes,
+                    memoryBytes=BASE_MEMORY + postService.sortMemory *
+                    (postService.nproc if stage == "sort" else 1),
+                    threads=postService.nproc, freedAfter=stage))
+                dependsOn = [stage]
+            else:
+                stages.append(PlanStage(
+                    stage, cmd, dependsOn, inputBytes=alignedBytes,
+                    outputBytes=(alignedBytes * BAI_RATIO if
+                                 stage == "bai" else 0),
+                    memoryBytes=(BASE_MEMORY if stage == "bai" else
+                                 pbiMemory)))
+        return stages
+
+    stages = []
+    if mode == "chunks":
+        # Reads are aligned against chunks of the reference one at a time.
+        # Alignments against each chunk are sorted by read name, all of
+        # them are merged, then the hit policy is applied in process. The
+        # chunks and their alignments are deleted after the merge.
+        maxChunkBytes = int(args.maxReferenceChunkSize) << 20
+        nChunks = max(1, (referenceBytes + maxChunkBytes - 1) //
+                      maxChunkBytes)
+        chunkBytes = alignedBytes / nChunks
+        postService = newPostService(fileNames, intermediate=True)
+        chunkBamFiles, nameSortedBamFiles = [], []
+        for i in range(nChunks):
+            chunkFile = path.join(tmpDir, "chunk{i}.fasta".format(i=i))
+            chunkBamFiles.append(path.join(tmpDir,
+                                           "chunk{i}.bam".format(i=i)))
+            nameSortedBamFiles.append(path.join(
+                tmpDir, "chunk{i}.byname.bam".format(i=i)))
+            stages.append(PlanStage(
+                "align.{i}".format(i=i),
+                alnService.plannedCmd(alnService.plannedQueryFileName(),
+                                      chunkBamFiles[-1],
+                                      targetFileName=chunkFile,
+                                      hitPolicy="all"),
+                ["align.{j}".format(j=i - 1)] if i > 0 else [],
+                inputBytes=readsBytes + referenceBytes / nChunks,
+                tempBytes=referenceBytes / nChunks + chunkBytes,
+                memoryBytes=alignerMemory(args.algorithm,
+                                          referenceBytes / nChunks, 0,
+                                          nproc),
+                threads=nproc, freedAfter="merge"))
+        mergedBamFile = path.join(tmpDir, "merged.byname.bam")
+        sortStages = []
+        for i, (stage, cmd) in enumerate(postService.plannedMergeByNameCmds(
+                chunkBamFiles, nameSortedBamFiles, mergedBamFile)):
+            if stage == "sort":
+                sortStages.append("sort.{i}".format(i=i))
+                stages.append(PlanStage(
+                    sortStages[-1], cmd, ["align.{i}".format(i=i)],
+                    inputBytes=chunkBytes, tempBytes=2 * chunkBytes,
+                    memoryBytes=BASE_MEMORY + postService.sortMemory *
+                    postService.nproc,
+                    threads=postService.nproc, freedAfter="merge"))
+            else:
+                stages.append(PlanStage(
+                    "merge", cmd, sortStages, inputBytes=alignedBytes,
+                    tempBytes=alignedBytes, threads=postService.nproc))
+        fileNames.filteredSam = path.join(tmpDir, "filtered.bam")
+        stages.append(PlanStage(
+            "filter", None, ["merge"], inputBytes=alignedBytes,
+            tempBytes=alignedBytes))
+        stages.extend(postStages(newPostService(fileNames), ["filter"]))
+        return stages
+
+    if mode == "shards":
+        # Shards are aligned and sorted simultaneously, then merged.
+        shards = int(args.shards)
+        shardNproc = max(1, nproc // shards)
+        shardBamFiles = []
+        for i in range(shards):
+            shardFile = path.join(tmpDir, "shard{i}.xml".format(i=i))
+            alignerSamOut = path.join(tmpDir,
+                                      "shard{i}.bam".format(i=i))
+            shardFileNames = copy(fileNames)
+            shardFileNames.filteredSam = alignerSamOut
+            shardFileNames.outBamFileName = path.join(
+                tmpDir, "shard{i}.sorted.bam".format(i=i))
+            shardBamFiles.append(shardFileNames.outBamFileName)
+            stages.append(PlanStage(
+                "align.{i}".format(i=i),
+                alnService.plannedCmd(shardFile, alignerSamOut,
+                                      nproc=shardNproc),
+                inputBytes=readsBytes / shards + referenceBytes + saBytes,
+                tempBytes=alignedBytes / shards,
+                memoryBytes=alignerMemory(args.algorithm, referenceBytes,
+                                          saBytes, shardNproc),
+                threads=shardNproc))
+            sorter = newPostService(shardFileNames, shares=shards,
+                                    intermediate=True)
+            stages.append(PlanStage(
+                "sort.{i}".format(i=i), sorter.plannedCmds()[0][1],
+                ["align.{i}".format(i=i)],
+                inputBytes=alignedBytes / shards,
+                tempBytes=2 * alignedBytes / shards,
+                memoryBytes=BASE_MEMORY + sorter.sortMemory *
+                sorter.nproc,
+                threads=sorter.nproc))
+        stages.extend(postStages(
+            newPostService(fileNames),
+            ["sort.{i}".format(i=i) for i in range(shards)],
+            sortedBamFiles=shardBamFiles))
+        return stages
+
+    alignStage = PlanStage(
+        "align", None, inputBytes=readsBytes + referenceBytes + saBytes,
+        memoryBytes=alignerMemory(args.algorithm, referenceBytes,
+                                  saBytes, nproc),
+        threads=nproc)
+    stages.append(alignStage)
+    queryFileName = alnService.plannedQueryFileName()
+    if queryFileName != fileNames.inputFileName:
+        # Reads are converted to FASTA before alignment.
+        alignStage.tempBytes += readsBytes
+
+    if mode == "streaming":
+        # The aligner writes to a named pipe read by 'samtools sort'.
+        fileNames.filteredSam = path.join(tmpDir, "aligned.fifo.bam")
+        alignStage.cmd = alnService.plannedCmd(
+            queryFileName, fileNames.filteredSam)
+        stages.extend(postStages(newPostService(fileNames),
+                                 ["align"]))
+        return stages
+
+    alignerSamOut = path.join(tmpDir, "aligned" + suffix)
+    alignStage.cmd = alnService.plannedCmd(queryFileName, alignerSamOut)
+    alignStage.tempBytes += alignedBytes
+
+    fileNames.filteredSam = path.join(tmpDir, "filtered" + suffix)
+    filterService = FilterService(alignerSamOut,
+                                  fileNames.targetFileName,
+                                  fileNames.filteredSam,
+                                  args.algorithm,
+                                  alnService.scoreSign,
+                                  args,
+                                  fileNames.adapterGffFileName)
+    isSymlink = args.algorithm == "blasr" and not args.filterAdapterOnly
+    if isSymlink and isBam:
+        # The filtered file is a symlink to the aligner's output.
+        alignStage.freedAfter = "sort"
+    stages.append(PlanStage(
+        "filter", filterService.cmd, ["align"], inputBytes=alignedBytes,
+        tempBytes=0 if isSymlink else alignedBytes,
+        outputBytes=0 if isBam else alignedBytes))
+    if isBam:
+        stages.extend(postStages(newPostService(fileNames),
+                                 ["filter"]))
+    return stages
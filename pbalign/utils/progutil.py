@@ -34,13 +34,44 @@
 # Author: Yuan Li
 
 from __future__ import absolute_import
-from pbcore.util.Process import backticks
+import errno
+import json
 import logging
+import logging.handlers
+import os
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+from collections import deque
+
+from pbalign.utils.toolregistry import Tools
+
+# Resource usages of all commands executed by Execute() in this process.
+_resourceUsages = []
+_resourceUsagesLock = threading.Lock()
+
+# Number of lines at the head and at the tail of output of a command which
+# are kept in memory, e.g., for parsing and error messages. All lines are
+# streamed to the log (at debug level) and to output log files.
+KEPT_HEAD_LINES = 1000
+KEPT_TAIL_LINES = 1000
+
+# Output log files of commands rotate at this size, keeping this many
+# backups, see ConfigureExecute().
+OUTPUT_LOG_MAX_BYTES = 64 * 1024 * 1024
+OUTPUT_LOG_BACKUP_COUNT = 4
+
+# Settings of Execute(), see ConfigureExecute().
+_executeSettings = {"outputLogDir": None, "timeout": None, "tmpDir": None}
+_outputLogCount = [0]
+_outputLogLock = threading.Lock()
 
 
 def Availability(progName):
     """Return True if a program is available, otherwise false."""
-    return (backticks("which {0}".format(progName))[1] == 0)
+    return Tools().isAvailable(progName)
 
 
 def CheckAvailability(progName):
@@ -49,21 +80,341 @@ def CheckAvailability(progName):
         raise RuntimeError("{0} is not available.".format(progName))
 
 
-def Execute(name, cmd):
-    """Execute the sepcified command in bash.
-    Raise a RuntimeError if execution of cmd fail.
+class ResourceUsage(object):
+    """Resource usage of an executed command, including all its child
+    processes: wall time, user and system CPU time (in seconds), peak
+    resident set size of the largest process (in KB), and bytes read from
+    and written to storage (readBytes/writeBytes) or through read and
+    write system calls (readChars/writeChars) according to /proc/PID/io.
+    I/O counts are None if /proc/PID/io is not accessible.
+    """
+    def __init__(self, name, cmd, startTime, wallTime, rusage, ioCounts,
+                 exitCode):
+        self.name = name
+        self.stage = _stageOf(cmd)
+        self.cmd = cmd
+        self.startTime = startTime
+        self.wallTime = wallTime
+        self.userTime = rusage.ru_utime
+        self.sysTime = rusage.ru_stime
+        self.maxRssKB = rusage.ru_maxrss
+        self.readBytes = ioCounts.get("read_bytes")
+        self.writeBytes = ioCounts.get("write_bytes")
+        self.readChars = ioCounts.get("rchar")
+        self.writeChars = ioCounts.get("wchar")
+        self.exitCode = exitCode
+
+    def __repr__(self):
+        return "ResourceUsage({stage}: wall {w:.2f} s, user {u:.2f} s, " \
+               "sys {s:.2f} s, maxRSS {m} KB)".format(
+                   stage=self.stage, w=self.wallTime, u=self.userTime,
+                   s=self.sysTime, m=self.maxRssKB)
+
+    def toDict(self):
+        """Return a dict which can be dumped to JSON."""
+        return dict(self.__dict__)
+
+
+def _stageOf(cmd):
+    """Return the stage name of a command, which is the program name and
+    its sub-command for multi-command programs such as samtools."""
+    items = cmd.split()
+    if len(items) == 0:
+        return ""
+    stage = os.path.basename(items[0])
+    if stage == "samtools" and len(items) > 1:
+        stage += " " + items[1]
+    return stage
+
+
+def ConfigureExecute(outputLogDir=None, timeout=None, tmpDir=None):
+    """Configure Execute() of this process.
+    Input:
+        outputLogDir: if not None, write stdout and stderr of every command
+                      to rotating files {stage}.{n}.out and {stage}.{n}.err
+                      under this directory.
+        timeout     : if not None, kill commands which run longer than this
+                      many seconds.
+        tmpDir      : if not None, create files which capture I/O counts of
+                      commands under this directory instead of the system
+                      default temporary directory.
+    """
+    if outputLogDir is not None:
+        outputLogDir = os.path.abspath(os.path.expanduser(outputLogDir))
+        if not os.path.isdir(outputLogDir):
+            os.makedirs(outputLogDir)
+    _executeSettings["outputLogDir"] = outputLogDir
+    _executeSettings["timeout"] = timeout
+    _executeSettings["tmpDir"] = tmpDir
+
+
+class _OutputLines(object):
+    """Output lines of a command, of which only the first headSize and the
+    last tailSize lines are kept in memory."""
+    def __init__(self, headSize=KEPT_HEAD_LINES, tailSize=KEPT_TAIL_LINES):
+        self.headSize = headSize
+        self.head = []
+        self.tail = deque(maxlen=tailSize)
+        self.numOmitted = 0
+
+    def append(self, line):
+        """Keep a line if it is at the head or at the tail."""
+        if len(self.head) < self.headSize:
+            self.head.append(line)
+            return
+        if len(self.tail) == self.tail.maxlen:
+            self.numOmitted += 1
+        self.tail.append(line)
+
+    def lines(self):
+        """Return kept lines. Lines omitted between the head and the tail
+        are only counted in self.numOmitted."""
+        return self.head + list(self.tail)
+
+
+def _openOutputLog(stage, suffix):
+    """Return a logger which writes to a rotating output log file of a
+    command under the output log dir, or None if there is no such dir."""
+    outputLogDir = _executeSettings["outputLogDir"]
+    if outputLogDir is None:
+        return None
+    with _outputLogLock:
+        _outputLogCount[0] += 1
+        count = _outputLogCount[0]
+    baseName = "{s}.{n}.{x}".format(s=stage.replace(" ", "_"), n=count,
+                                     x=suffix)
+    logger = logging.getLogger("pbalign.output." + baseName)
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    handler = logging.handlers.RotatingFileHandler(
+        os.path.join(outputLogDir, baseName),
+        maxBytes=OUTPUT_LOG_MAX_BYTES, backupCount=OUTPUT_LOG_BACKUP_COUNT)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    return logger
+
+
+def _closeOutputLog(logger):
+    """Close handlers of an output log."""
+    if logger is not None:
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            handler.close()
+
+
+def _readLines(stream, lines, name, outputLog=None):
+    """Read lines from a stream as they come, log them, write them to an
+    output log if any, and keep them (without line breaks) in lines."""
+    for line in iter(stream.readline, ''):
+        line = line.rstrip('\n')
+        lines.append(line)
+        logging.debug(name + ": " + line)
+        if outputLog is not None:
+            outputLog.info(line)
+    stream.close()
+
+
+def _readIOCounts(ioFile):
+    """Parse a copy of /proc/PID/io and return a dict of counts."""
+    ioCounts = {}
+    try:
+        with open(ioFile, 'r') as f:
+            for line in f:
+                key, _sep, value = line.partition(":")
+                if value.strip().isdigit():
+                    ioCounts[key.strip()] = int(value)
+    except IOError:
+        pass
+    return ioCounts
+
+
+def _wait4(pid):
+    """Wait for a child process, retry if interrupted."""
+    while True:
+        try:
+            return os.wait4(pid, 0)
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+
+
+def _killGroup(p, timedOut):
+    """Kill the process group of p, of which p is the leader, and set
+    timedOut only if the group has been signalled."""
+    try:
+        os.killpg(p.pid, signal.SIGKILL)
+    except OSError:
+        # The group has exited.
+        return
+    timedOut.set()
+
+
+def _run(name, cmd, timeout=None):
+    """Run cmd in a shell, stream its stdout and stderr line by line, and
+    return (stdout lines, stderr lines, exit code, ResourceUsage, timed
+    out or not). Only the head and the tail of the output are kept in
+    memory. If timeout is not None, the shell runs in its own process
+    group, which is killed after timeout seconds.
+    The shell copies its own /proc/PID/io, which includes I/O of all its
+    reaped children, before it exits, and os.wait4() collects CPU time and
+    peak RSS of the whole process tree."""
+    ioFd, ioFile = tempfile.mkstemp(prefix="pbalign_io_",
+                                    dir=_executeSettings["tmpDir"])
+    os.close(ioFd)
+    wrapped = "( {cmd} ); __rc=$?; cat /proc/$$/io > {ioFile} 2>/dev/null;" \
+              " exit $__rc".format(cmd=cmd, ioFile=ioFile)
+    stage = _stageOf(cmd)
+    outLog = _openOutputLog(stage, "out")
+    errLog = _openOutputLog(stage, "err")
+    startTime = time.time()
+    with open(os.devnull, 'r') as devnull:
+        p = subprocess.Popen(wrapped, shell=True, stdin=devnull,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             close_fds=True,
+                             preexec_fn=None if timeout is None else
+                             os.setpgrp)
+    out, err = _OutputLines(), _OutputLines()
+    readers = [threading.Thread(target=_readLines,
+                                args=(p.stdout, out, name, outLog)),
+               threading.Thread(target=_readLines,
+                                args=(p.stderr, err, name, errLog))]
+    for reader in readers:
+        reader.daemon = True
+        reader.start()
+    timedOut = threading.Event()
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, _killGroup, args=(p, timedOut))
+        timer.daemon = True
+        timer.start()
+    _pid, status, rusage = _wait4(p.pid)
+    if timer is not None:
+        # Let a timer which has fired finish before checking timedOut.
+        timer.cancel()
+        timer.join()
+    # The timer may fire after the shell exits but before it is reaped,
+    # a shell which exited normally has not timed out.
+    isTimedOut = timedOut.is_set() and os.WIFSIGNALED(status)
+    if os.WIFSIGNALED(status):
+        p.returncode = -os.WTERMSIG(status)
+    else:
+        p.returncode = os.WEXITSTATUS(status)
+    for reader in readers:
+        reader.join()
+    _closeOutputLog(outLog)
+    _closeOutputLog(errLog)
+    wallTime = time.time() - startTime
+
+    ioCounts = _readIOCounts(ioFile)
+    os.remove(ioFile)
+    usage = ResourceUsage(name, cmd, startTime, wallTime, rusage, ioCounts,
+                          p.returncode)
+    with _resourceUsagesLock:
+        _resourceUsages.append(usage)
+    logging.info(name + ": Exited with status {c}, {u}".format(
+        c=p.returncode, u=repr(usage)))
+    for lines, streamName in ((out, "stdout"), (err, "stderr")):
+        if lines.numOmitted > 0:
+            logging.info(name + ": Kept the first {h} and the last {t} " \
+                         "lines of {s}, omitted {n} lines in between.".format(
+                             h=len(lines.head), t=len(lines.tail),
+                             s=streamName, n=lines.numOmitted))
+    return out.lines(), err.lines(), p.returncode, usage, isTimedOut
+
+
+def ResourceUsages():
+    """Return resource usages of all commands executed so far."""
+    with _resourceUsagesLock:
+        return list(_resourceUsages)
+
+
+def ResetResourceUsages():
+    """Forget resource usages of commands executed so far, e.g., those
+    inherited by a child process from its parent."""
+    with _resourceUsagesLock:
+        del _resourceUsages[:]
+
+
+def WriteResourceReport(fileName, totalWallTime=None):
+    """Write resource usages of all commands executed so far, and the
+    total wall time, to a JSON file."""
+    usages = ResourceUsages()
+    # Total CPU time (user and system) of commands of each stage, e.g., to
+    # compare runs with different --intermediateCompressionLevel.
+    stageCpuTimes = {}
+    for usage in usages:
+        stageCpuTimes[usage.stage] = stageCpuTimes.get(usage.stage, 0.0) + \
+            usage.userTime + usage.sysTime
+    report = {"totalWallTime": totalWallTime,
+              "stageCpuTimes": stageCpuTimes,
+              "stages": [usage.toDict() for usage in usages]}
+    with open(fileName, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    logging.info("Write resource usages of {n} stages to {f}.".format(
+        n=len(usages), f=fileName))
+
+
+def Execute(name, cmd, timeout=None):
+    """Execute the sepcified command in bash, stream its output to the log,
+    and record its resource usage. Raise a RuntimeError if execution of cmd
+    fail or takes longer than timeout seconds.
 
     Input:
-        cmd: a command-line string to execute in bash
+        cmd    : a command-line string to execute in bash
+        timeout: seconds to wait for cmd, None to use the timeout set by
+                 ConfigureExecute()
     Output:
-        output : the cmd output
+        output : lines of the cmd output, only its first and last lines
+                 if it is long, see KEPT_HEAD_LINES and KEPT_TAIL_LINES
         errCode: the error code (zero means normal exit)
         errMsg : the error message
     """
     logging.info(name + ": Call \"{0}\"".format(cmd))
-    output, errCode, errMsg = backticks(cmd, merge_stderr=False)
+    if timeout is None:
+        timeout = _executeSettings["timeout"]
+    output, err, errCode, _usage, timedOut = _run(name, cmd, timeout)
+    errMsg = ""
+    if timedOut:
+        errMsg = name + " was killed after {t} seconds. ".format(t=timeout) + \
+            os.linesep.join(err)
+        logging.error(errMsg)
+        raise RuntimeError(errMsg)
     if errCode != 0:
-        errMsg = name + " returned a non-zero exit status. " + errMsg
+        errMsg = name + " returned a non-zero exit status. " + \
+            os.linesep.join(output + err)
         logging.error(errMsg)
         raise RuntimeError(errMsg)
     return output, errCode, errMsg
+
+
+class ExecuteInBackground(threading.Thread):
+    """Execute the specified command in bash on a background thread.
+    Call wait() to block until the command is done, which returns
+    (output, errCode, errMsg) as Execute() does, or raises a RuntimeError
+    if execution of cmd fail or times out.
+    """
+    def __init__(self, name, cmd, timeout=None):
+        super(ExecuteInBackground, self).__init__(name=name)
+        self.daemon = True
+        self.cmd = cmd
+        self.timeout = timeout
+        self.result = None
+        self.error = None
+        self.elapsedTime = None
+
+    def run(self):
+        """Execute cmd and save its result or error, and elapsed time."""
+        startTime = time.time()
+        try:
+            self.result = Execute(self.name, self.cmd, self.timeout)
+        except RuntimeError as e:
+            self.error = e
+        finally:
+            self.elapsedTime = time.time() - startTime
+
+    def wait(self):
+        """Wait for cmd to finish and return its result."""
+        self.join()
+        if self.error is not None:
+            raise RuntimeError(str(self.error))
+        return self.result
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+###############################################################################
+# Copyright (c) 2011-2013, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+###############################################################################
+
+"""This script defines class ReferenceCache, a persistent cache of resolved
+references, so that repeated runs against the same reference do not parse
+reference.info.xml or ReferenceSet XML and check reference files again.
+
+Each reference is cached in a JSON file under the cache dir, which records
+what checkReferencePath() returns, byte ranges of contigs of a FASTA reference
+once they are needed (e.g., to split it into chunks), and modification times
+and sizes of the reference path and all files involved in resolving it. An
+entry is used only if none of these files has changed."""
+
+from __future__ import absolute_import
+import hashlib
+import json
+import logging
+import os
+from os import path
+
+from pbalign.utils.fileutil import checkReferencePath, real_ppath
+
+
+def _fileStamp(fileName):
+    """Return [mtime, size] of a file, or None if it does not exist."""
+    try:
+        st = os.stat(real_ppath(fileName))
+    except OSError:
+        return None
+    return [st.st_mtime, st.st_size]
+
+
+def _contigRanges(fastaFile):
+    """Return a list of (start, end) byte ranges of contigs in fastaFile."""
+    ranges = []
+    offset, start = 0, None
+    with open(fastaFile, 'rb') as f:
+        for line in f:
+            if line.startswith('>'):
+                if start is not None:
+                    ranges.append((start, offset))
+                start = offset
+            offset += len(line)
+    if start is not None:
+        ranges.append((start, offset))
+    return ranges
+
+
+def _stampedFiles(referencePath, resolved):
+    """Return files whose changes invalidate a resolved reference: the
+    reference path, reference.info.xml which may make it a repository,
+    and the resolved FASTA, suffix array and adapter GFF files."""
+    refpath = real_ppath(referencePath)
+    files = [refpath,
+             path.join(path.split(path.dirname(refpath))[0],
+                       "reference.info.xml"),
+             path.join(refpath, "reference.info.xml")]
+    _refpath, fastaFile, sawriterFile, _isWithinRepo, gffFile = resolved
+    files.extend(real_ppath(f) for f in (fastaFile, sawriterFile, gffFile)
+                 if f is not None)
+    return files
+
+
+class ReferenceCache(object):
+    """A persistent cache of resolved references under a directory."""
+    def __init__(self, cacheDir):
+        self.cacheDir = path.abspath(path.expanduser(cacheDir))
+        if not path.isdir(self.cacheDir):
+            os.makedirs(self.cacheDir)
+
+    def __repr__(self):
+        return "ReferenceCache({d})".format(d=self.cacheDir)
+
+    def _entryFileName(self, referencePath):
+        """Return the cache file of a reference."""
+        key = hashlib.sha1(real_ppath(referencePath)).hexdigest()
+        return path.join(self.cacheDir, "reference_{k}.json".format(k=key))
+
+    def _loadEntry(self, referencePath):
+        """Return the cache entry of a reference if none of its files has
+        changed, otherwise None."""
+        try:
+            with open(self._entryFileName(referencePath), 'r') as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if entry.get("referencePath") != real_ppath(referencePath):
+            return None
+        for fileName, stamp in entry["stamps"]:
+            if _fileStamp(fileName) != stamp:
+                logging.debug("Reference cache of {r} is stale: {f} " \
+                              "changed.".format(r=referencePath, f=fileName))
+                return None
+        return entry
+
+    def _load(self, referencePath):
+        """Return the resolved reference if it is cached and none of its
+        files has changed, otherwise None."""
+        entry = self._loadEntry(referencePath)
+        if entry is None:
+            return None
+        return tuple(str(v) if isinstance(v, unicode) else v
+                     for v in entry["resolved"])
+
+    def _save(self, referencePath, resolved, contigRanges=None):
+        """Cache a resolved reference and byte ranges of its contigs (if
+        not None), written atomically."""
+        entry = {"referencePath": real_ppath(referencePath),
+                 "resolved": list(resolved),
+                 "stamps": [[f, _fileStamp(f)] for f in
+                            _stampedFiles(referencePath, resolved)]}
+        if contigRanges is not None:
+            entry["contigRanges"] = [list(r) for r in contigRanges]
+        fileName = self._entryFileName(referencePath)
+        tmpFile = "{f}.{pid}.tmp".format(f=fileName, pid=os.getpid())
+        try:
+            with open(tmpFile, 'w') as f:
+                json.dump(entry, f, indent=2)
+            os.rename(tmpFile, fileName)
+        except (IOError, OSError) as e:
+            logging.warning("Could not cache reference {r}: {e}".format(
+                r=referencePath, e=str(e)))
+
+    def resolve(self, referencePath):
+        """Return what checkReferencePath(referencePath) returns, from the
+        cache if possible."""
+        resolved = self._load(referencePath)
+        if resolved is not None:
+            logging.debug("Use cached reference {r}".format(r=resolved))
+            return resolved
+        resolved = checkReferencePath(referencePath)
+        self._save(referencePath, resolved)
+        return resolved
+
+    def contigRanges(self, fastaFile):
+        """Return byte ranges of contigs in fastaFile, from the cache if
+        possible, see _contigRanges()."""
+        entry = self._loadEntry(fastaFile)
+        if entry is not None and entry.get("contigRanges") is not None:
+            logging.debug("Use cached contigs of {f}".format(f=fastaFile))
+            return [tuple(r) for r in entry["contigRanges"]]
+        resolved = self._load(fastaFile) if entry is not None else \
+            checkReferencePath(fastaFile)
+        ranges = _contigRanges(real_ppath(fastaFile))
+        self._save(fastaFile, resolved, ranges)
+        return ranges
+
+
+# The reference cache of this process, None if disabled.
+_referenceCache = [None]
+
+
+def ConfigureReferenceCache(cacheDir=None):
+    """Cache resolved references under cacheDir, or disable the cache if
+    cacheDir is None."""
+    current = _referenceCache[0]
+    if cacheDir is None:
+        _referenceCache[0] = None
+    elif current is None or \
+         current.cacheDir != path.abspath(path.expanduser(cacheDir)):
+        _referenceCache[0] = ReferenceCache(cacheDir)
+
+
+def ResolveReference(referencePath):
+    """Resolve a reference path as checkReferencePath() does, using the
+    reference cache if it is configured."""
+    if _referenceCache[0] is None:
+        return checkReferencePath(referencePath)
+    return _referenceCache[0].resolve(referencePath)
+
+
+def ContigRanges(fastaFile):
+    """Return byte ranges of contigs in fastaFile, using the reference
+    cache if it is configured."""
+    if _referenceCache[0] is None:
+        return _contigRanges(real_ppath(fastaFile))
+    return _referenceCache[0].contigRanges(fastaFile)
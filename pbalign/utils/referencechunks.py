@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+###############################################################################
+# Copyright (c) 2011-2013, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+###############################################################################
+
+"""This script defines functions to align reads against a large reference
+chunk by chunk: split a reference FASTA file into chunks of contigs of
+bounded size, and merge alignments against all chunks while applying the
+hit policy and the maximum number of hits of each read globally.
+
+Alignments against chunks must be merged into one bam file sorted by read
+name (so that all alignments of a read are adjacent), in which contigs are
+in the order of the original reference."""
+
+from __future__ import absolute_import
+import logging
+import random
+
+import pysam
+
+from pbalign.utils.alignmentfilter import FilterCriteria, BATCH_SIZE, \
+    keptReads, resolveHits, isPrimary, samMode
+from pbalign.utils.referencecache import ContigRanges
+
+# Size of blocks to copy when writing chunks.
+COPY_BLOCK_SIZE = 1 << 20
+
+
+def groupContigs(ranges, maxChunkBytes):
+    """Group consecutive contig byte ranges into chunks of at most
+    maxChunkBytes bytes each, except that a contig larger than that is a
+    chunk by itself. Return a list of (start, end) byte ranges of chunks."""
+    chunks = []
+    for start, end in ranges:
+        if len(chunks) > 0 and end - chunks[-1][0] <= maxChunkBytes:
+            chunks[-1] = (chunks[-1][0], end)
+        else:
+            chunks.append((start, end))
+    return chunks
+
+
+def splitReference(fastaFile, maxChunkBytes, chunkFileNames):
+    """Split fastaFile into chunks of contigs of at most maxChunkBytes
+    bytes, and write them to files named by chunkFileNames, a function
+    which returns the file name of the i-th chunk. Return chunk files."""
+    chunks = groupContigs(ContigRanges(fastaFile), maxChunkBytes)
+    chunkFiles = []
+    with open(fastaFile, 'rb') as f:
+        for i, (start, end) in enumerate(chunks):
+            chunkFile = chunkFileNames(i)
+            f.seek(start)
+            remaining = end - start
+            with open(chunkFile, 'wb') as out:
+                while remaining > 0:
+                    block = f.read(min(remaining, COPY_BLOCK_SIZE))
+                    if block == '':
+                        break
+                    out.write(block)
+                    remaining -= len(block)
+            chunkFiles.append(chunkFile)
+    logging.info("Split {f} into {n} chunks of at most {m} bytes.".format(
+        f=fastaFile, n=len(chunkFiles), m=maxChunkBytes))
+    return chunkFiles
+
+
+def mergeHits(nameSortedBamFile, outBamFile, hitPolicy, maxHits,
+              scoreSign=-1, seed=1, compressionLevel=None, stats=None):
+    """Apply hitPolicy and maxHits to all alignments of each read in
+    nameSortedBamFile, a bam file sorted by read name, and write alignments
+    to keep to outBamFile, compressed at compressionLevel (0-9) if it is
+    not None. Count alignments and reads in stats, a FilterStats object,
+    if it is not None; blasr has already filtered alignments against each
+    chunk, so only unmapped ones and those removed by the hit policy are
+    counted as rejected. Return (number of reads, number of alignments)
+    written."""
+    rng = random.Random(seed)
+    numReads, numHits = 0, 0
+    inBam = pysam.Samfile(nameSortedBamFile, 'rb')
+    try:
+        outBam = pysam.Samfile(outBamFile, samMode(outBamFile, True,
+                                                   compressionLevel),
+                               template=inBam)
+        try:
+            if stats is None:
+                mapped = (read for read in inBam if not read.is_unmapped)
+            else:
+                # Only 'unmapped' is checked, criteria are left to blasr.
+                mapped = keptReads(inBam, FilterCriteria(scoreSign=scoreSign),
+                                   BATCH_SIZE, {"in": 0}, stats=stats)
+            for read in resolveHits(mapped, hitPolicy, maxHits, scoreSign,
+                                    rng):
+                outBam.write(read)
+                numReads += 1 if isPrimary(read) else 0
+                numHits += 1
+                if stats is not None:
+                    stats.addOutput(read)
+        finally:
+            outBam.close()
+    finally:
+        inBam.close()
+    logging.info("Kept {h} alignments of {r} reads by hit policy {p}.".format(
+        h=numHits, r=numReads, p=hitPolicy))
+    return numReads, numHits
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+###############################################################################
+# Copyright (c) 2011-2013, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+###############################################################################
+
+"""This script defines class ResourcePlan, which sizes threads and memory of
+stages of a pbalign run according to CPUs and memory available to it, taking
+cgroup (v1 or v2) CPU quota and memory limit into account."""
+
+from __future__ import absolute_import
+import logging
+import multiprocessing
+import os
+
+# Files which tell the cgroups of this process and where they are mounted.
+PROC_SELF_CGROUP = "/proc/self/cgroup"
+PROC_SELF_MOUNTINFO = "/proc/self/mountinfo"
+# cgroup v2 files.
+CGROUP2_CPU_MAX = "cpu.max"
+CGROUP2_MEMORY_MAX = "memory.max"
+# cgroup v1 files.
+CGROUP1_CPU_QUOTA = "cpu.cfs_quota_us"
+CGROUP1_CPU_PERIOD = "cpu.cfs_period_us"
+CGROUP1_MEMORY_LIMIT = "memory.limit_in_bytes"
+
+# Fraction of available memory used by 'samtools sort', which runs after
+# the aligner is done, or along with the aligner when streaming.
+SORT_MEMORY_FRACTION = 0.5
+STREAMING_SORT_MEMORY_FRACTION = 0.25
+# Bounds of memory per 'samtools sort' thread (samtools sort -m).
+MIN_SORT_MEMORY = 256 * 1024 * 1024
+MAX_SORT_MEMORY = 4 * 1024 * 1024 * 1024
+
+
+def _readFirstLine(fileName):
+    """Return the first line of a file, or None if it can not be read."""
+    try:
+        with open(fileName, 'r') as f:
+            return f.readline().strip()
+    except (IOError, OSError):
+        return None
+
+
+def _readLines(fileName):
+    """Return lines of a file, or [] if it can not be read."""
+    try:
+        with open(fileName, 'r') as f:
+            return f.read().splitlines()
+    except (IOError, OSError):
+        return []
+
+
+def _cgroupMounts(mountInfo):
+    """Return a list of (root, mountPoint, fsType, superOptions) of cgroup
+    file systems listed in a /proc/<pid>/mountinfo file."""
+    mounts = []
+    for line in _readLines(mountInfo):
+        # e.g., 30 25 0:26 / /sys/fs/cgroup rw,nosuid - cgroup2 cgroup2 rw
+        if " - " not in line:
+            continue
+        fields, superFields = line.split(" - ", 1)
+        fields, superFields = fields.split(), superFields.split()
+        if len(fields) < 5 or len(superFields) < 3:
+            continue
+        if superFields[0] in ("cgroup", "cgroup2"):
+            mounts.append((fields[3], fields[4], superFields[0],
+                           superFields[2].split(",")))
+    return mounts
+
+
+def cgroupDirs(controller, procCgroup=PROC_SELF_CGROUP,
+               mountInfo=PROC_SELF_MOUNTINFO):
+    """Return the cgroup version and directories of this process's cgroup
+    and all its ancestors up to the root of the mounted hierarchy, the
+    process's own cgroup first.
+        Input:
+            controller : cgroup v1 controller, 'cpu' or 'memory'.
+            procCgroup : /proc/<pid>/cgroup file.
+            mountInfo  : /proc/<pid>/mountinfo file.
+        Output:
+            (version, [directories]), or (None, []) if the cgroup of the
+            process is not found.
+    """
+    cgroupPaths = {}
+    for line in _readLines(procCgroup):
+        # e.g., 0::/system.slice/slurm.service, or 4:cpu,cpuacct:/job
+        fields = line.split(":", 2)
+        if len(fields) != 3:
+            continue
+        if fields[0] == "0" and fields[1] == "":
+            cgroupPaths[2] = fields[2]
+        elif controller in fields[1].split(","):
+            cgroupPaths[1] = fields[2]
+
+    for root, mountPoint, fsType, options in _cgroupMounts(mountInfo):
+        if fsType == "cgroup2" and 2 in cgroupPaths:
+            version, cgroupPath = 2, cgroupPaths[2]
+        elif fsType == "cgroup" and 1 in cgroupPaths and \
+                controller in options:
+            version, cgroupPath = 1, cgroupPaths[1]
+        else:
+            continue
+        # Path of the cgroup relative to the root of the mount, which is
+        # not '/' in a container which mounts only its own cgroup.
+        relPath = os.path.relpath(cgroupPath, root)
+        if relPath == os.pardir or relPath.startswith(os.pardir + os.sep):
+            relPath = os.curdir
+        dirs = [mountPoint]
+        for name in relPath.split(os.sep):
+            if name != os.curdir:
+                dirs.append(os.path.join(dirs[-1], name))
+        return version, dirs[::-1]
+    return None, []
+
+
+def cgroupCpuLimit(procCgroup=PROC_SELF_CGROUP,
+                   mountInfo=PROC_SELF_MOUNTINFO):
+    """Return number of CPUs allowed by the CPU quota of the cgroup of this
+    process, which is the smallest quota of the cgroup and its ancestors,
+    or None if there is no quota."""
+    version, dirs = cgroupDirs("cpu", procCgroup, mountInfo)
+    limits = []
+    for cgroupDir in dirs:
+        if version == 2:
+            line = _readFirstLine(os.path.join(cgroupDir, CGROUP2_CPU_MAX))
+            fields = line.split() if line is not None else []
+            if len(fields) == 2 and fields[0] != "max":
+                limits.append(float(fields[0]) / float(fields[1]))
+        else:
+            quota = _readFirstLine(os.path.join(cgroupDir, CGROUP1_CPU_QUOTA))
+            period = _readFirstLine(os.path.join(cgroupDir,
+                                                 CGROUP1_CPU_PERIOD))
+            if quota is not None and period is not None and int(quota) > 0:
+                limits.append(float(quota) / float(period))
+    return min(limits) if len(limits) > 0 else None
+
+
+def cgroupMemoryLimit(procCgroup=PROC_SELF_CGROUP,
+                      mountInfo=PROC_SELF_MOUNTINFO):
+    """Return memory limit in bytes of the cgroup of this process, which is
+    the smallest limit of the cgroup and its ancestors, or None if there is
+    no limit."""
+    version, dirs = cgroupDirs("memory", procCgroup, mountInfo)
+    fileName = CGROUP2_MEMORY_MAX if version == 2 else CGROUP1_MEMORY_LIMIT
+    limits = []
+    for cgroupDir in dirs:
+        line = _readFirstLine(os.path.join(cgroupDir, fileName))
+        if line is not None and line.isdigit():
+            limits.append(int(line))
+    # cgroup v1 reports a huge number if there is no limit.
+    limits = [limit for limit in limits if limit < physicalMemory()]
+    return min(limits) if len(limits) > 0 else None
+
+
+def physicalMemory():
+    """Return bytes of physical memory of this machine."""
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def availableCpus():
+    """Return number of CPUs available to this process, at least 1."""
+    cpus = multiprocessing.cpu_count()
+    limit = cgroupCpuLimit()
+    if limit is not None:
+        cpus = min(cpus, limit)
+    return max(1, int(cpus))
+
+
+def availableMemory():
+    """Return bytes of memory available to this process."""
+    memory = physicalMemory()
+    limit = cgroupMemoryLimit()
+    if limit is not None:
+        memory = min(memory, limit)
+    return memory
+
+
+class ResourcePlan(object):
+    """Threads and memory of stages of a pbalign run."""
+    def __init__(self, nproc=None, streaming=False, cpus=None, memory=None):
+        """Initialize a ResourcePlan object.
+            Input:
+                nproc    : number of aligner threads specified by --nproc,
+                           None to use all available CPUs.
+                streaming: whether 'samtools sort' runs along with the
+                           aligner (see --streaming).
+                cpus     : number of available CPUs, None to detect.
+                memory   : bytes of available memory, None to detect.
+        """
+        self.cpus = availableCpus() if cpus is None else int(cpus)
+        self.memory = availableMemory() if memory is None else int(memory)
+
+        # Aligner threads.
+        self.alignThreads = self.cpus if nproc is None else int(nproc)
+        if self.alignThreads > self.cpus:
+            logging.warning("--nproc {n} exceeds {c} available CPUs.".format(
+                n=self.alignThreads, c=self.cpus))
+
+        # 'samtools sort' threads and memory per thread, such that they
+        # fit in a fraction of available memory.
+        fraction = STREAMING_SORT_MEMORY_FRACTION if streaming else \
+            SORT_MEMORY_FRACTION
+        sortBudget = int(self.memory * fraction)
+        self.sortThreads = max(1, min(self.alignThreads, self.cpus))
+        self.sortMemory = min(MAX_SORT_MEMORY,
+                              sortBudget // self.sortThreads)
+        if self.sortMemory < MIN_SORT_MEMORY:
+            self.sortThreads = max(1, sortBudget // MIN_SORT_MEMORY)
+            self.sortMemory = MIN_SORT_MEMORY
+
+        # Build bai and pbi indexes at the same time if there are CPUs.
+        self.indexConcurrency = 2 if self.cpus >= 2 else 1
+
+    def __repr__(self):
+        return ("ResourcePlan({c} CPUs, {m} MB memory: {a} align threads, " +
+                "{s} sort threads with {sm} MB each, {i} concurrent index " +
+                "builds)").format(c=self.cpus, m=self.memory >> 20,
+                                   a=self.alignThreads, s=self.sortThreads,
+                                   sm=self.sortMemory >> 20,
+                                   i=self.indexConcurrency)
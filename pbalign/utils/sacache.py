@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+###############################################################################
+# Copyright (c) 2011-2013, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+###############################################################################
+
+"""This script defines class SuffixArrayCache, a shared cache of suffix
+arrays of reference FASTA files built by sawriter, so that blasr does not
+build its index of a reference on every run.
+
+Suffix arrays are keyed by the SHA-1 of the reference content and the size
+of the lookup table, thus shared by copies of the same reference. Since
+hashing a large reference takes a while, hashes of FASTA files are
+remembered by path, size and mtime. A suffix array is built by one process
+holding an exclusive lock, under a temporary name, and published by
+renaming."""
+
+from __future__ import absolute_import
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+from os import path
+
+from pbalign.utils.fileutil import real_ppath
+from pbalign.utils.progutil import Availability, Execute
+
+# Size of the lookup table of suffix arrays in reference repositories, and
+# the largest blasr -minMatch may be smaller than.
+SA_LOOKUP_TABLE_SIZE = 8
+
+# Size of blocks to read when hashing a FASTA file.
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def contentHash(fileName):
+    """Return the SHA-1 hex digest of a file."""
+    sha1 = hashlib.sha1()
+    with open(fileName, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+class SuffixArrayCache(object):
+    """A cache of suffix arrays of reference FASTA files under a dir."""
+    def __init__(self, cacheDir):
+        """Initialize a SuffixArrayCache object. Raise OSError if cacheDir
+        can not be made, or IOError if it is not writable."""
+        self.cacheDir = path.abspath(path.expanduser(cacheDir))
+        try:
+            os.makedirs(self.cacheDir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        if not os.access(self.cacheDir, os.W_OK | os.X_OK):
+            raise IOError("Suffix array cache dir {d} is not writable.".
+                          format(d=self.cacheDir))
+
+    def __repr__(self):
+        return "SuffixArrayCache({d})".format(d=self.cacheDir)
+
+    def _fastaHash(self, fastaFile):
+        """Return the content hash of a FASTA file, which is remembered
+        until the file changes."""
+        st = os.stat(fastaFile)
+        stamp = [fastaFile, st.st_size, st.st_mtime]
+        hashFile = path.join(self.cacheDir, "fasta_{k}.json".format(
+            k=hashlib.sha1(fastaFile).hexdigest()))
+        try:
+            with open(hashFile, 'r') as f:
+                entry = json.load(f)
+            if entry["stamp"] == stamp:
+                return str(entry["sha1"])
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+        sha1 = contentHash(fastaFile)
+        tmpFile = "{f}.{pid}.tmp".format(f=hashFile, pid=os.getpid())
+        try:
+            with open(tmpFile, 'w') as f:
+                json.dump({"stamp": stamp, "sha1": sha1}, f)
+            os.rename(tmpFile, hashFile)
+        except (IOError, OSError) as e:
+            logging.warning("Could not remember the hash of {f}: {e}".format(
+                f=fastaFile, e=str(e)))
+        return sha1
+
+    def saFileName(self, fastaFile, lookupTableSize=SA_LOOKUP_TABLE_SIZE):
+        """Return the cached suffix array of fastaFile, which may not
+        exist."""
+        return path.join(self.cacheDir, "{h}.blt{n}.sa".format(
+            h=self._fastaHash(real_ppath(fastaFile)), n=lookupTableSize))
+
+    def get(self, fastaFile, lookupTableSize=SA_LOOKUP_TABLE_SIZE):
+        """Return the cached suffix array of fastaFile if it exists,
+        otherwise None."""
+        saFile = self.saFileName(fastaFile, lookupTableSize)
+        return saFile if path.exists(saFile) else None
+
+    def build(self, fastaFile, lookupTableSize=SA_LOOKUP_TABLE_SIZE):
+        """Return the cached suffix array of fastaFile, building it with
+        sawriter if it is not cached. Other processes building the same
+        suffix array wait for it. Return None if sawriter is unavailable."""
+        saFile = self.saFileName(fastaFile, lookupTableSize)
+        if path.exists(saFile):
+            return saFile
+        if not Availability("sawriter"):
+            logging.warning("sawriter is not available, could not build " +
+                            "a suffix array for {f}.".format(f=fastaFile))
+            return None
+
+        lockFile = open(saFile + ".lock", 'a')
+        try:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            if path.exists(saFile):
+                return saFile
+            tmpFile = "{f}.{pid}.tmp".format(f=saFile, pid=os.getpid())
+            cmdStr = "sawriter {sa} {fasta} -blt {n} -welter".format(
+                sa=tmpFile, fasta=real_ppath(fastaFile), n=lookupTableSize)
+            try:
+                Execute("sawriter", cmdStr)
+                os.rename(tmpFile, saFile)
+            finally:
+                if path.exists(tmpFile):
+                    os.remove(tmpFile)
+            logging.info("Built suffix array {s} for {f}.".format(
+                s=saFile, f=fastaFile))
+            return saFile
+        finally:
+            lockFile.close()
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+###############################################################################
+# Copyright (c) 2011-2013, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+###############################################################################
+
+"""This script defines class StagingCache, a cache of reference files on a
+node-local disk, so that aligners do not read multi-GB reference files (such
+as suffix arrays) from shared file systems whenever a job starts.
+
+A staged copy of a file is an entry under entries/ of the cache dir, which is
+copied under a temporary name then published by renaming. Processes which
+use an entry hold a shared lock of its lock file under locks/, and the process
+which copies a file holds an exclusive lock of its build lock file. Lock
+files are never removed. The cache dir is bounded in size, and least recently
+used entries which are not in use are evicted first. Bytes of an entry being
+copied are reserved under reservations/ while holding the cache lock, so that
+copies running at the same time do not take the cache over its size."""
+
+from __future__ import absolute_import
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import time
+from os import path
+
+from pbalign.utils.fileutil import real_ppath
+
+def _makedirs(dirName):
+    """Make a directory if it does not exist."""
+    try:
+        os.makedirs(dirName)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _removeFile(fileName):
+    """Remove a file if it exists."""
+    try:
+        os.remove(fileName)
+    except OSError:
+        pass
+
+
+def _entrySize(entryDir):
+    """Return total size of files in an entry."""
+    total = 0
+    for root, _dirs, files in os.walk(entryDir):
+        for f in files:
+            try:
+                total += os.path.getsize(path.join(root, f))
+            except OSError:
+                pass
+    return total
+
+
+class StagingCache(object):
+    """A size-bounded LRU cache of files on a node-local disk."""
+    def __init__(self, cacheDir, maxBytes):
+        self.cacheDir = path.abspath(path.expanduser(cacheDir))
+        self.maxBytes = maxBytes
+        self.entriesDir = path.join(self.cacheDir, "entries")
+        self.locksDir = path.join(self.cacheDir, "locks")
+        self.reservationsDir = path.join(self.cacheDir, "reservations")
+        _makedirs(self.entriesDir)
+        _makedirs(self.locksDir)
+        _makedirs(self.reservationsDir)
+        # Lock files of entries used by this process.
+        self._held = []
+
+    def __repr__(self):
+        return "StagingCache({d}, max size = {s} bytes)".format(
+            d=self.cacheDir, s=self.maxBytes)
+
+    def _key(self, fileName):
+        """Return the entry key of a file, which changes with the file."""
+        st = os.stat(fileName)
+        return hashlib.sha1("{f}\t{s}\t{m}".format(
+            f=fileName, s=st.st_size, m=st.st_mtime)).hexdigest()
+
+    def _lockFile(self, key):
+        """Open and return the lock file of an entry."""
+        return open(path.join(self.locksDir, key + ".lock"), 'a')
+
+    def _reservedBytes(self):
+        """Return bytes reserved for entries which are being copied by
+        live processes, and remove reservations of dead processes."""
+        total = 0
+        for name in os.listdir(self.reservationsDir):
+            reservation = path.join(self.reservationsDir, name)
+            try:
+                pid = int(name.rsplit(".", 1)[1])
+                os.kill(pid, 0)
+            except (IndexError, ValueError):
+                continue
+            except OSError as e:
+                if e.errno == errno.ESRCH:
+                    _removeFile(reservation)
+                    continue
+            try:
+                with open(reservation, 'r') as f:
+                    total += int(f.read())
+            except (IOError, OSError, ValueError):
+                pass
+        return total
+
+    def _evict(self, needBytes):
+        """Evict least recently used entries which are not in use, until
+        needBytes more bytes fit in the cache besides bytes reserved for
+        entries being copied. Return whether they fit."""
+        entries = []
+        for key in os.listdir(self.entriesDir):
+            entryDir = path.join(self.entriesDir, key)
+            if key.endswith(".tmp") or not path.isdir(entryDir):
+                continue
+            entries.append((path.getmtime(entryDir), key,
+                            _entrySize(entryDir)))
+        total = self._reservedBytes() + \
+            sum(size for _mtime, _key, size in entries)
+        for _mtime, key, size in sorted(entries):
+            if total + needBytes <= self.maxBytes:
+                break
+            lockFile = self._lockFile(key)
+            try:
+                fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                # The entry is in use.
+                lockFile.close()
+                continue
+            try:
+                logging.info("Evict {k} from the staging cache.".format(k=key))
+                shutil.rmtree(path.join(self.entriesDir, key))
+                total -= size
+            finally:
+                lockFile.close()
+        return total + needBytes <= self.maxBytes
+
+    def stage(self, fileName):
+        """Return a staged copy of fileName, copying it to the cache if it
+        is not there, or fileName itself if it does not fit in the cache or
+        can not be copied, since staging is only an optimization. The
+        staged copy is kept until release() is called."""
+        fileName = real_ppath(fileName)
+        key = self._key(fileName)
+        entryDir = path.join(self.entriesDir, key)
+        stagedFile = path.join(entryDir, path.basename(fileName))
+
+        lockFile = self._lockFile(key)
+        isStaged = False
+        try:
+            fcntl.flock(lockFile, fcntl.LOCK_SH)
+            if not path.exists(stagedFile):
+                # Only one process copies a file, others wait for it and
+                # then check again.
+                buildLock = self._lockFile(key + ".build")
+                try:
+                    fcntl.flock(buildLock, fcntl.LOCK_EX)
+                    if not path.exists(stagedFile) and \
+                       not self._copy(fileName, stagedFile):
+                        return fileName
+                except (IOError, OSError) as e:
+                    logging.warning("Could not stage {f} to {c}, use it " \
+                                    "in place: {e}".format(f=fileName,
+                                                           c=self.cacheDir,
+                                                           e=str(e)))
+                    return fileName
+                finally:
+                    buildLock.close()
+            # Mark the entry as recently used.
+            os.utime(entryDir, None)
+            self._held.append(lockFile)
+            isStaged = True
+            return stagedFile
+        finally:
+            # Lock files are never removed, other processes may hold locks
+            # of them, which would not protect a new file of the same name.
+            if not isStaged:
+                lockFile.close()
+
+    def _copy(self, fileName, stagedFile):
+        """Copy fileName to its entry, and publish it by renaming. Return
+        False if it does not fit in the cache. If the copy fails, remove
+        the partial entry, release its reservation and raise."""
+        size = os.path.getsize(fileName)
+        entryDir = path.dirname(stagedFile)
+        # Reserve bytes of the entry while holding the cache lock, so that
+        # copies of other processes do not use the space freed for it.
+        reservation = path.join(self.reservationsDir, "{k}.{pid}".format(
+            k=path.basename(entryDir), pid=os.getpid()))
+        globalLock = open(path.join(self.cacheDir, "cache.lock"), 'a')
+        try:
+            fcntl.flock(globalLock, fcntl.LOCK_EX)
+            fits = self._evict(size)
+            if fits:
+                with open(reservation, 'w') as f:
+                    f.write(str(size))
+        finally:
+            globalLock.close()
+        if not fits:
+            logging.warning("{f} does not fit in the staging cache {c}, " \
+                            "use it in place.".format(f=fileName,
+                                                      c=self.cacheDir))
+            return False
+
+        tmpDir = "{d}.{pid}.tmp".format(d=entryDir, pid=os.getpid())
+        startTime = time.time()
+        try:
+            _makedirs(tmpDir)
+            shutil.copyfile(fileName,
+                            path.join(tmpDir, path.basename(stagedFile)))
+            os.rename(tmpDir, entryDir)
+        except (IOError, OSError):
+            shutil.rmtree(tmpDir, ignore_errors=True)
+            raise
+        finally:
+            # The published entry is counted by its size instead.
+            _removeFile(reservation)
+        logging.info("Staged {f} to {s} in {t:.2f} s.".format(
+            f=fileName, s=stagedFile, t=time.time() - startTime))
+        return True
+
+    def release(self):
+        """Release all entries used by this process, so that they can be
+        evicted."""
+        while len(self._held) > 0:
+            self._held.pop().close()
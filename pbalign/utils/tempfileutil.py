@@ -33,13 +33,63 @@
 
 """This scripts defines class TempFile and class TempFileManager for managing
 temporary files and directories."""
-from os import path, makedirs, remove, fdopen
+from os import path, makedirs, remove, fdopen, mkfifo, sep, statvfs
+import errno
+import os
 import shutil
 import logging
+import subprocess
 import tempfile
+import threading
 import time
 from pbalign.utils.fileutil import isExist
 
+# Times to try removing a temporary dir, and seconds to wait between tries.
+RMTREE_TRIES = 5
+RMTREE_RETRY_DELAY = 3
+
+# A shell script which deletes $1 temporary files and then directories in
+# the remaining arguments, trying each directory RMTREE_TRIES times (see
+# _deleteTmpFiles()), and writes a line to stderr for each of them which
+# can not be deleted.
+CLEANUP_SCRIPT = """
+n=$1; shift; i=0
+while [ $i -lt $n ]; do
+    if ! err=$(rm -f -- "$1" 2>&1); then
+        echo "Unable to remove a temporary file $1:" $err >&2
+    fi
+    shift; i=$((i + 1))
+done
+for d in "$@"; do
+    t=1
+    until err=$(rm -rf -- "$d" 2>&1); do
+        if [ $t -ge {tries} ]; then
+            echo "Unable to remove a temporary dir $d:" $err >&2
+            break
+        fi
+        t=$((t + 1)); sleep {delay}
+    done
+done
+""".format(tries=RMTREE_TRIES, delay=RMTREE_RETRY_DELAY)
+
+# Size hints of temporary files are estimates. A file is only put in the
+# memory root dir if this many times its size hint fits, and that much is
+# reserved for it, so that a file which outgrows its estimate does not fill
+# up the RAM-backed file system, which would fail with ENOSPC or make the
+# node run out of memory.
+MEMORY_SIZE_HINT_FACTOR = 2
+
+
+def splitRootDirs(rootDirs):
+    """Return candidate root dirs in a comma-separated list."""
+    return [d.strip() for d in rootDirs.split(",") if d.strip() != ""]
+
+
+def freeBytes(dirName):
+    """Return bytes available to this user in the file system of dirName."""
+    st = statvfs(path.abspath(path.expanduser(dirName)))
+    return st.f_bavail * st.f_frsize
+
 
 class TempFile():
     """Class of temporary files and directories."""
@@ -66,10 +116,35 @@ class TempFileManager():
         self.defaultRootDir = rootDir
         if (self.defaultRootDir != ""):
             self.defaultRootDir = path.abspath(path.expanduser(rootDir))
-        self.fileDB = []
-        self.dirDB = []
+        # Registered files and directories by name.
+        self._files = {}
+        self._dirs = {}
+        # The process which is deleting files of the last CleanUp() and
+        # the file of its error messages, and messages of files which
+        # could not be deleted.
+        self._cleaner = None
+        self._cleanUpErrors = []
+        # A RAM-backed (e.g., tmpfs) root dir for temporary files with a
+        # size hint, bytes which may be used and have been reserved in it.
+        self.memoryRootDir = ""
+        self.memoryBudget = 0
+        self._memoryReserved = 0
+        self._memoryLock = threading.Lock()
+        # Bytes reserved for each file under the memory root dir.
+        self._memoryReservations = {}
+        self.isRootDirPinned = False
         self.SetRootDir(self.defaultRootDir)
 
+    @property
+    def fileDB(self):
+        """Registered temporary files."""
+        return self._files.values()
+
+    @property
+    def dirDB(self):
+        """Registered temporary directories."""
+        return self._dirs.values()
+
     def __repr__(self):
         return "TempFileManager:\n" + \
                "   the default root dir is: {0}\n".\
@@ -80,7 +155,21 @@ class TempFileManager():
                format(",".join([obj.__repr__() for obj in self.dirDB]))
 
     def SetRootDir(self, rootDir):
-        """ Set default root directory for temporary files. """
+        """ Set default root directory for temporary files. rootDir can be
+        a comma-separated list of candidates, of which the existing one with
+        the most free space is used. """
+        if self.isRootDirPinned:
+            logging.debug("Keep the pinned temporary dir {0}".format(
+                self.defaultRootDir))
+            return
+
+        candidates = splitRootDirs(rootDir)
+        if len(candidates) > 1:
+            existing = [d for d in candidates
+                        if path.isdir(path.abspath(path.expanduser(d)))]
+            rootDir = max(existing, key=freeBytes) if len(existing) > 0 \
+                else candidates[0]
+
         changeRootDir = True
         if (rootDir != ""):
             rootDir = path.abspath(path.expanduser(rootDir))
@@ -89,13 +178,14 @@ class TempFileManager():
                 # In case a dir (such as /scratch) is specified, create
                 # another layer of sub-dir, and use it as the real rootDir.
                 rootDir = tempfile.mkdtemp(dir=rootDir)
-                self.dirDB.append(TempFile(rootDir, own=True, isDir=True))
+                self._RegisterTmpFile(TempFile(rootDir, own=True, isDir=True))
                 changeRootDir = False
             elif not isExist(rootDir):
                 # Make the user-specified temporary directory.
                 try:
                     makedirs(rootDir)
-                    self.dirDB.append(TempFile(rootDir, own=True, isDir=True))
+                    self._RegisterTmpFile(TempFile(rootDir, own=True,
+                                                   isDir=True))
                     changeRootDir = False
                 except (IOError, OSError):
                     # If fail to make the user-specified temp dir,
@@ -105,34 +195,130 @@ class TempFileManager():
         if changeRootDir:
             try:
                 rootDir = tempfile.mkdtemp()
-                self.dirDB.append(TempFile(rootDir, own=True, isDir=True))
+                self._RegisterTmpFile(TempFile(rootDir, own=True, isDir=True))
             except (IOError, OSError):
                 # If fail to make temp dir
                 rootDir = ""
 
         self.defaultRootDir = rootDir
 
+    def PinRootDir(self, rootDir):
+        """ Use rootDir as the default root directory for temporary files,
+        create it if it does not exist, and ignore later calls of
+        SetRootDir(). Temporary files of a run can then be found again by
+        the next run which pins the same directory. """
+        rootDir = path.abspath(path.expanduser(rootDir))
+        if not path.isdir(rootDir):
+            makedirs(rootDir)
+        if not self._isRegistered(rootDir):
+            self._RegisterTmpFile(TempFile(rootDir, own=True, isDir=True))
+        self.defaultRootDir = rootDir
+        self.isRootDirPinned = True
+
+    def SelectRootDir(self, rootDirs, requiredBytes):
+        """ Make sure that requiredBytes fit in the default root dir, or use
+        a new dir under the first of rootDirs (a comma-separated list) in
+        which they fit. Ignore later calls of SetRootDir(). Raise IOError if
+        they fit in none of rootDirs. """
+        if self.defaultRootDir != "" and \
+           freeBytes(self.defaultRootDir) >= requiredBytes:
+            self.isRootDirPinned = True
+            return self.defaultRootDir
+
+        if self.isRootDirPinned:
+            # Temporary files of an earlier run may be reused.
+            logging.warning("The pinned temporary dir {d} may not have " \
+                            "{n} bytes free.".format(d=self.defaultRootDir,
+                                                     n=requiredBytes))
+            return self.defaultRootDir
+
+        free = []
+        for rootDir in splitRootDirs(rootDirs):
+            try:
+                nbytes = freeBytes(rootDir)
+            except OSError:
+                continue
+            if nbytes >= requiredBytes:
+                self.SetRootDir(rootDir)
+                self.isRootDirPinned = True
+                logging.info("Use temporary dir {d}.".format(
+                    d=self.defaultRootDir))
+                return self.defaultRootDir
+            free.append("{d}: {n}".format(d=rootDir, n=nbytes))
+
+        errMsg = "Not enough temporary space, {n} bytes are required but " \
+                 "bytes free are {f}. Please specify --tmpDir with more " \
+                 "free space.".format(n=requiredBytes, f=", ".join(free))
+        logging.error(errMsg)
+        raise IOError(errMsg)
+
+    def SetMemoryRootDir(self, rootDir, budget):
+        """ Create temporary files whose size hints fit in budget bytes
+        under a new dir in rootDir (e.g., /dev/shm) instead of the default
+        root dir. Temporary files which do not fit spill to disk, see
+        MEMORY_SIZE_HINT_FACTOR. Memory reserved for a file is released
+        when it is deleted by DeleteTmpFile(). """
+        rootDir = path.abspath(path.expanduser(rootDir))
+        try:
+            self.memoryRootDir = tempfile.mkdtemp(dir=rootDir,
+                                                  prefix="pbalign_")
+        except (IOError, OSError) as e:
+            logging.warning("Could not use {d} for temporary files: {e}".
+                            format(d=rootDir, e=str(e)))
+            return
+        self._RegisterTmpFile(TempFile(self.memoryRootDir, own=True,
+                                       isDir=True))
+        self.memoryBudget = budget
+        self._memoryReserved = 0
+        self._memoryReservations = {}
+
+    def _reserveMemory(self, sizeHint):
+        """ Reserve MEMORY_SIZE_HINT_FACTOR times sizeHint bytes under the
+        memory root dir, return the reserved bytes if they fit in both the
+        budget and free space of its file system, otherwise 0. """
+        if self.memoryRootDir == "":
+            return 0
+        nbytes = int(sizeHint * MEMORY_SIZE_HINT_FACTOR)
+        with self._memoryLock:
+            if self._memoryReserved + nbytes > self.memoryBudget:
+                return 0
+            st = statvfs(self.memoryRootDir)
+            if nbytes > st.f_bavail * st.f_frsize:
+                return 0
+            self._memoryReserved += nbytes
+            return nbytes
+
+    def _releaseMemory(self, fileName):
+        """ Release memory reserved for a file, if any. """
+        with self._memoryLock:
+            self._memoryReserved -= self._memoryReservations.pop(fileName, 0)
+
     def _isRegistered(self, tempFileName):
         """ Is this a registered file or directory? """
         tempFileName = path.abspath(path.expanduser(tempFileName))
-        if tempFileName in [obj.name for obj in self.fileDB] or \
-           tempFileName in [obj.name for obj in self.dirDB]:
-            return True
-        else:
-            return False
+        return tempFileName in self._files or tempFileName in self._dirs
 
     def _RegisterTmpFile(self, tmpFile):
         """ Register a TmpFile obj. """
         if tmpFile.isDir:
-            self.dirDB.append(tmpFile)
+            self._dirs[tmpFile.name] = tmpFile
         else:
-            self.fileDB.append(tmpFile)
+            self._files[tmpFile.name] = tmpFile
         return tmpFile.name
 
     def RegisterNewTmpFile(self, isDir=False, rootDir="",
-                           suffix="", prefix=""):
+                           suffix="", prefix="", sizeHint=None):
         """Create a new temporary file/directory under rootDir and
-        register it in self.fileDB/self.dirDB. """
+        register it in self.fileDB/self.dirDB. If rootDir is not specified
+        and the expected size of a file, sizeHint, fits in the memory
+        budget, create it under the memory root dir. """
+        reserved = 0
+        if rootDir == "" and not isDir and sizeHint is not None:
+            reserved = self._reserveMemory(sizeHint)
+        if reserved > 0:
+            rootDir = self.memoryRootDir
+            logging.debug("Create a temporary file of {n} bytes under {d}".
+                          format(n=sizeHint, d=rootDir))
         if rootDir == "":
             if self.defaultRootDir == "":
                 raise IOError("TempManager default root dir not set.")
@@ -158,8 +344,45 @@ class TempFileManager():
             logging.error(errMsg)
             raise IOError(errMsg)
 
+        if reserved > 0:
+            with self._memoryLock:
+                self._memoryReservations[thisPath] = reserved
         return self._RegisterTmpFile(TempFile(thisPath, own=True, isDir=isDir))
 
+    def DeleteTmpFile(self, tempFileName):
+        """Delete a registered temporary file which is no longer needed,
+        deregister it, and release memory reserved for it, so that later
+        temporary files may use that memory."""
+        tempFileName = path.abspath(path.expanduser(tempFileName))
+        if not self._isRegistered(tempFileName):
+            errMsg = "Failed to delete an unregistered temporary file {0}.".\
+                format(tempFileName)
+            logging.error(errMsg)
+            raise IOError(errMsg)
+        obj = self._files.pop(tempFileName, None)
+        if obj is not None and obj.own:
+            _deleteTmpFiles([obj], self._cleanUpErrors)
+        self._releaseMemory(tempFileName)
+
+    def IsRegistered(self, tempFileName):
+        """Is this a registered temporary file or directory?"""
+        return self._isRegistered(tempFileName)
+
+    def IsInMemory(self, tempFileName):
+        """Is this a temporary file under the memory root dir?"""
+        tempFileName = path.abspath(path.expanduser(tempFileName))
+        with self._memoryLock:
+            return tempFileName in self._memoryReservations
+
+    def RegisterNewTmpFifo(self, rootDir="", suffix="", prefix=""):
+        """Create a new named pipe under rootDir and register it in
+        self.fileDB, so that it is removed like any other temporary file."""
+        thisPath = self.RegisterNewTmpFile(rootDir=rootDir, suffix=suffix,
+                                           prefix=prefix)
+        remove(thisPath)
+        mkfifo(thisPath)
+        return thisPath
+
     def RegisterExistingTmpFile(self, thisPath, own=False, isDir=False):
         """Register an existing temporary file/directory if it exists.
            Input:
@@ -194,43 +417,115 @@ class TempFileManager():
         return self._RegisterTmpFile(TempFile(thisPath,
                                               own=own, isDir=isDir))
 
-    def CleanUp(self, realDelete=True):
+    def CleanUp(self, realDelete=True, wait=True):
         """Deregister all temporary files and directories, and delete them from
         the file system if realDelete is True.
+        Only owned files and directories which are not within another owned
+        directory are deleted, each directory as a whole. If wait is False,
+        they are deleted by a detached process, which neither delays the
+        exit of this process nor dies with it, see WaitForCleanUp().
+        Files which can not be deleted are logged and reported by
+        WaitForCleanUp().
         """
-        # Always clean up temp files first.
-        while len(self.fileDB) > 0:
-            obj = self.fileDB.pop()
-            if realDelete and obj.own and isExist(obj.name):
-                logging.debug("Remove a temporary file {0}".format(obj.name))
-                remove(obj.name)
+        toDelete = []
+        if realDelete:
+            ownedDirs = [obj.name for obj in self.dirDB if obj.own]
+            toDelete = [obj for obj in self.fileDB + self.dirDB
+                        if obj.own and not _isWithinAny(obj.name, ownedDirs)]
+        self._files = {}
+        self._dirs = {}
+        self.defaultRootDir = ""
+        self.isRootDirPinned = False
+        self.memoryRootDir = ""
+        self.memoryBudget = 0
+        self._memoryReserved = 0
+        self._memoryReservations = {}
 
-        # Then clean up temp dirs
-        while len(self.dirDB) > 0:
-            obj = self.dirDB.pop()
-            if realDelete and obj.own and isExist(obj.name):
-                logging.debug("Remove a temporary dir {0}".format(obj.name))
-                # bug 25074, in some systems occationally there might be a NFS
-                # lock error: "Device or resource busy, unable to delete
-                # .nfsxxxxxx".
-                # This is because although all temp files have been deleted,
-                # nfs still takes a while to send back an ack for the rpc call.
-                # In that case, wait a few seconds before deleting the temp
-                # directory, and try this several times.
-                # If the temporary dir could not be deleted anyway, print a
-                # warning instead of exiting with an error.
-                times = 0
-                maxTry = 5
-                while times < maxTry:
-                    try:
-                        shutil.rmtree(obj.name)
-                        break
-                    except (IOError, OSError):
-                        times += 1
-                        # wait 3 seconds
-                        time.sleep(3)
-                if times >= maxTry:
-                    logging.warn("Unable to remove a temporary dir {0}".
-                                 format(obj.name))
+        self._cleanUpErrors = self.WaitForCleanUp()
+        if wait:
+            _deleteTmpFiles(toDelete, self._cleanUpErrors)
+        elif len(toDelete) > 0:
+            self._cleaner = _startCleaner(toDelete)
 
-        self.defaultRootDir = ""
+    def WaitForCleanUp(self):
+        """Wait until temporary files of the last CleanUp() are deleted.
+        Return messages of files and directories which could not be
+        deleted since the last call, [] if all were deleted."""
+        if self._cleaner is not None:
+            process, stderr = self._cleaner
+            self._cleaner = None
+            process.wait()
+            stderr.seek(0)
+            for errMsg in stderr.read().splitlines():
+                if errMsg.strip() != "":
+                    logging.warn(errMsg)
+                    self._cleanUpErrors.append(errMsg)
+            stderr.close()
+        errors, self._cleanUpErrors = self._cleanUpErrors, []
+        return errors
+
+
+def _startCleaner(tmpFiles):
+    """Start a process which deletes temporary files and directories in
+    its own session, so that it neither blocks nor is killed with this
+    process, which may exit as soon as its outputs are written. Return
+    the process and an unnamed file of its error messages."""
+    files = [obj.name for obj in tmpFiles if not obj.isDir]
+    dirs = [obj.name for obj in tmpFiles if obj.isDir]
+    stderr = tempfile.TemporaryFile()
+    with open(os.devnull, 'r') as devnull:
+        process = subprocess.Popen(
+            ["/bin/sh", "-c", CLEANUP_SCRIPT, "sh", str(len(files))] +
+            files + dirs, stdin=devnull, stdout=stderr, stderr=stderr,
+            close_fds=True, preexec_fn=os.setsid)
+    logging.debug("Remove {n} temporary files and directories in the " \
+                  "background, process {p}.".format(n=len(tmpFiles),
+                                                    p=process.pid))
+    return process, stderr
+
+
+def _isWithinAny(fileName, dirNames):
+    """Is fileName within any of dirNames (excluding itself)?"""
+    return any(fileName.startswith(d.rstrip(sep) + sep) for d in dirNames)
+
+
+def _deleteTmpFiles(tmpFiles, errors):
+    """Delete temporary files and directories. Log and append a message to
+    errors for each of them which can not be deleted, and go on, like
+    CLEANUP_SCRIPT does in the background."""
+    for obj in tmpFiles:
+        if not obj.isDir:
+            logging.debug("Remove a temporary file {0}".format(obj.name))
+            try:
+                remove(obj.name)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    errMsg = "Unable to remove a temporary file {0}: {1}".\
+                        format(obj.name, e)
+                    logging.warn(errMsg)
+                    errors.append(errMsg)
+            continue
+
+        logging.debug("Remove a temporary dir {0}".format(obj.name))
+        # bug 25074, in some systems occationally there might be a NFS
+        # lock error: "Device or resource busy, unable to delete
+        # .nfsxxxxxx".
+        # This is because although all temp files have been deleted,
+        # nfs still takes a while to send back an ack for the rpc call.
+        # In that case, wait a few seconds before deleting the temp
+        # directory, and try this several times.
+        # If the temporary dir could not be deleted anyway, print a
+        # warning instead of exiting with an error.
+        for times in range(RMTREE_TRIES):
+            try:
+                shutil.rmtree(obj.name)
+                break
+            except (IOError, OSError) as e:
+                if getattr(e, "errno", None) == errno.ENOENT:
+                    break
+                if times + 1 < RMTREE_TRIES:
+                    time.sleep(RMTREE_RETRY_DELAY)
+        else:
+            errMsg = "Unable to remove a temporary dir {0}".format(obj.name)
+            logging.warn(errMsg)
+            errors.append(errMsg)
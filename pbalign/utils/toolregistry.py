@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+###############################################################################
+# Copyright (c) 2011-2013, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT
+# NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+###############################################################################
+
+"""This script defines class ToolRegistry, a process-wide registry of
+external programs called by pbalign, which resolves the path and version of
+each program only once, derives capability flags (e.g., whether 'samtools
+sort' supports -o) from versions, and optionally persists what it found to a
+JSON manifest, so that later runs do not need to fork programs to ask for
+their versions again."""
+
+from __future__ import absolute_import
+import json
+import logging
+import os
+import re
+import subprocess
+import threading
+
+# Arguments to ask programs for their versions.
+VERSION_ARGUMENTS = {"samtools": ["--version"]}
+
+# Version assumed if a program does not tell its version.
+DEFAULT_VERSIONS = {"samtools": ["0", "1", "19"]}
+
+
+def _findProgram(progName):
+    """Return the absolute path of a program found in PATH, or None."""
+    if os.path.dirname(progName) != "":
+        paths = [progName]
+    else:
+        paths = [os.path.join(pathDir, progName) for pathDir in
+                 os.environ.get("PATH", "").split(os.pathsep)]
+    for progPath in paths:
+        if os.path.isfile(progPath) and os.access(progPath, os.X_OK):
+            return os.path.abspath(progPath)
+    return None
+
+
+def _parseVersion(text):
+    """Parse a version such as '1.3.1' or 'Version: 0.1.19-44428cd' from
+    output of a program, and return it as a list of strings."""
+    for line in text.splitlines():
+        m = re.search(r"(\d+)\.(\d+)(?:\.(\d+))?", line)
+        if m is not None:
+            return [v for v in m.groups() if v is not None]
+    return None
+
+
+def _probeVersion(progName, progPath):
+    """Run a program to ask for its version, and return the version as a
+    list of strings, or None if it can not be told."""
+    if progName not in VERSION_ARGUMENTS:
+        return None
+    try:
+        p = subprocess.Popen([progPath] + VERSION_ARGUMENTS[progName],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             close_fds=True)
+        out, err = p.communicate()
+    except OSError:
+        return None
+    return _parseVersion(out) or _parseVersion(err)
+
+
+class Tool(object):
+    """An external program: its path, size and modification time of the
+    executable, version (a list of strings) and capability flags."""
+    def __init__(self, name, path, size=None, mtime=None, version=None):
+        self.name = name
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.version = version if version is not None else \
+            DEFAULT_VERSIONS.get(name)
+        self.capabilities = _capabilities(name, self.version)
+
+    def __repr__(self):
+        return "Tool({n}, {p}, version {v})".format(
+            n=self.name, p=self.path,
+            v=".".join(self.version) if self.version is not None else None)
+
+    @property
+    def isAvailable(self):
+        """Return True if the program is found."""
+        return self.path is not None
+
+    def toDict(self):
+        """Return a dict which can be dumped to the manifest."""
+        return {"path": self.path, "size": self.size, "mtime": self.mtime,
+                "version": self.version}
+
+
+def _capabilities(name, version):
+    """Return capability flags of a program of a version."""
+    if name != "samtools" or version is None:
+        return {}
+    major, minor = int(version[0]), int(version[1])
+    return {
+        # samtools >= 1.0 sorts with 'sort -o out.bam in.bam' and merges
+        # with multiple threads, older ones with 'sort in.bam outPrefix'.
+        "sortOutputOption": major >= 1,
+        "mergeThreads": major >= 1,
+        # Compression levels of output of 'sort -l' and 'merge -l'.
+        "sortCompressionLevel": major >= 1,
+        "mergeCompressionLevel": (major, minor) >= (1, 3),
+        # samtools >= 1.0 merges bam files of different @SQ lines.
+        "mergeTargets": major >= 1,
+        # samtools 1.2 only accepts 'index in.bam' and writes in.bam.bai.
+        "indexOutputArgument": not (major == 1 and minor == 2)}
+
+
+class ToolRegistry(object):
+    """Resolve external programs once per process, and optionally persist
+    them to a JSON manifest shared by later runs."""
+    def __init__(self, manifestFile=None):
+        self.manifestFile = manifestFile
+        self._tools = {}
+        self._manifest = {}
+        self._lock = threading.Lock()
+        if manifestFile is not None:
+            self._manifest = self._loadManifest(manifestFile)
+
+    def __repr__(self):
+        return "ToolRegistry({t})".format(t=", ".join(
+            repr(tool) for tool in self._tools.values()))
+
+    @staticmethod
+    def _loadManifest(manifestFile):
+        """Return tools recorded in a manifest, or {} if it can not be
+        read."""
+        try:
+            with open(manifestFile, 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _saveManifest(self):
+        """Write all resolved tools to the manifest atomically."""
+        manifest = dict(self._manifest)
+        manifest.update((name, tool.toDict()) for name, tool in
+                        self._tools.iteritems() if tool.isAvailable)
+        tmpFile = "{f}.{pid}.tmp".format(f=self.manifestFile, pid=os.getpid())
+        try:
+            with open(tmpFile, 'w') as f:
+                json.dump(manifest, f, indent=2, sort_keys=True)
+            os.rename(tmpFile, self.manifestFile)
+        except (IOError, OSError) as e:
+            logging.warning("Could not write tool manifest {f}: {e}".format(
+                f=self.manifestFile, e=str(e)))
+        self._manifest = manifest
+
+    def _resolve(self, progName):
+        """Find a program, and tell its version from the manifest if the
+        executable has not changed, otherwise by running it."""
+        progPath = _findProgram(progName)
+        if progPath is None:
+            return Tool(progName, None), False
+        st = os.stat(progPath)
+        size, mtime = st.st_size, st.st_mtime
+        recorded = self._manifest.get(progName)
+        if recorded is not None and recorded.get("path") == progPath and \
+           recorded.get("size") == size and recorded.get("mtime") == mtime:
+            return Tool(progName, progPath, size, mtime,
+                        recorded.get("version")), False
+        return Tool(progName, progPath, size, mtime,
+                    _probeVersion(progName, progPath)), True
+
+    def get(self, progName):
+        """Return the Tool of a program, resolve it if it is new."""
+        with self._lock:
+            tool = self._tools.get(progName)
+            if tool is None:
+                tool, isNew = self._resolve(progName)
+                self._tools[progName] = tool
+                logging.debug("Resolved {t}".format(t=tool))
+                if isNew and tool.isAvailable and \
+                   self.manifestFile is not None:
+                    self._saveManifest()
+            return tool
+
+    def isAvailable(self, progName):
+        """Return True if a program is available."""
+        return self.get(progName).isAvailable
+
+    def version(self, progName):
+        """Return version of a program as a list of strings."""
+        return self.get(progName).version
+
+    def capability(self, progName, flag):
+        """Return a capability flag of a program, False if unknown."""
+        return self.get(progName).capabilities.get(flag, False)
+
+
+# The registry of this process.
+_registry = [ToolRegistry()]
+
+
+def Tools():
+    """Return the tool registry of this process."""
+    return _registry[0]
+
+
+def ConfigureTools(manifestFile=None):
+    """Use a manifest to persist tools resolved by this process, and reuse
+    tools recorded in it."""
+    current = Tools()
+    if manifestFile is not None:
+        manifestFile = os.path.abspath(os.path.expanduser(manifestFile))
+    if manifestFile != current.manifestFile:
+        _registry[0] = ToolRegistry(manifestFile)
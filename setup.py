@@ -20,6 +20,7 @@ setup(
     test_requires=['pbtestdata'],
     entry_points={'console_scripts': [
         'pbalign=pbalign.pbalignrunner:main',
+        'pbalign_batch=pbalign.batch:main',
         'maskAlignedReads.py = pbalign.tools.mask_aligned_reads:main',
         'loadChemistry.py = pbalign.tools.loadChemistry:main',
         'extractUnmappedSubreads.py = pbalign.tools.extractUnmappedSubreads:main',
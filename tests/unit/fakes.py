@@ -0,0 +1,107 @@
+"""Fake programs, alignments, runners and references shared by unit
+tests."""
+
+import os
+import signal
+import stat
+from os import path
+
+
+class FakeProgram(object):
+    """A fake program under binDir which runs a shell script and counts
+    how many times it is called."""
+    def __init__(self, binDir, name, script):
+        self.fileName = path.join(binDir, name)
+        self.counter = self.fileName + ".calls"
+        with open(self.fileName, 'w') as f:
+            f.write("#!/bin/sh\necho x >> {c}\n{s}\n".format(
+                c=self.counter, s=script))
+        os.chmod(self.fileName, stat.S_IRWXU)
+
+    def numCalls(self):
+        """Return number of times the fake program is called."""
+        if not path.exists(self.counter):
+            return 0
+        with open(self.counter) as f:
+            return len(f.readlines())
+
+
+class FakeRead(object):
+    """An alignment of a read with a score, a target id, a position, a
+    CIGAR and an NM tag."""
+    def __init__(self, score, tid=0, pos=0, cigar=None, nm=None,
+                 is_unmapped=False, qname="r"):
+        self.score, self.tid, self.pos = score, tid, pos
+        self.qname = qname
+        self.cigar = cigar if cigar is not None else [(0, 100)]
+        self.nm = nm
+        self.is_unmapped = is_unmapped
+        self.flag = 0
+
+    def opt(self, tag):
+        """Return the alignment score or the NM tag."""
+        if tag == "AS" and self.score is not None:
+            return self.score
+        if tag == "NM" and self.nm is not None:
+            return self.nm
+        raise KeyError(tag)
+
+
+class FakeSamfile(object):
+    """A pysam.Samfile which reads alignments from and writes alignments
+    to FakeSamfile.files, a dict of file names to lists of alignments."""
+    files = {}
+    modes = {}
+
+    def __init__(self, fileName, mode, template=None):
+        self.fileName = fileName
+        FakeSamfile.modes[fileName] = mode
+        if mode.startswith('w'):
+            FakeSamfile.files[fileName] = []
+
+    def __iter__(self):
+        return iter(FakeSamfile.files[self.fileName])
+
+    def write(self, read):
+        """Write an alignment."""
+        FakeSamfile.files[self.fileName].append(read)
+
+    def close(self):
+        """Nothing to close."""
+        pass
+
+
+class FakeRunner(object):
+    """A PBAlignRunner which writes its process id to its output file, or
+    fails if its input file name ends with 'bad', or is killed if it ends
+    with 'killed'."""
+    def __init__(self, args, fileNames=None):
+        self.args = args
+        self.fileNames = fileNames
+
+    def run(self):
+        """Write the process id to the output file."""
+        if self.args.inputFileName.endswith("bad"):
+            raise RuntimeError("bad input")
+        if self.args.inputFileName.endswith("killed"):
+            os.kill(os.getpid(), signal.SIGKILL)
+        with open(self.args.outputFileName, 'w') as f:
+            f.write(str(os.getpid()))
+
+    def waitForCleanUp(self):
+        """Nothing to clean up."""
+        return []
+
+
+class FakeReference(object):
+    """A SharedReference which returns FakeRunners."""
+    def __init__(self, referencePath, indexDir):
+        self.referencePath = referencePath
+
+    def newRunner(self, args):
+        """Return a FakeRunner."""
+        return FakeRunner(args)
+
+    def files(self):
+        """No files to keep warm."""
+        return []
@@ -0,0 +1,79 @@
+"""Test pbalign/utils/adapterindex.py"""
+
+import tempfile
+import shutil
+import unittest
+from os import path
+
+import pbalign.utils.adapterindex as adapterindex
+from pbalign.utils.adapterindex import AdapterIndex, LoadAdapterIndex, \
+    ADAPTER_INDEX_SUFFIX
+
+
+GFF = """##gff-version 3
+chr1\t.\tadapter\t101\t145\t0.00\t+\t.\tID=adapter1
+chr1\t.\tadapter\t11\t60\t0.00\t+\t.\tID=adapter2
+chr1\t.\tadapter\t21\t30\t0.00\t+\t.\tID=adapter3
+chr2 desc\t.\tadapter\t1\t45\t0.00\t+\t.\tID=adapter4
+"""
+
+
+class Test_AdapterIndex(unittest.TestCase):
+    """Test pbalign/utils/adapterindex.py"""
+    def setUp(self):
+        self.outDir = tempfile.mkdtemp()
+        self.gff = path.join(self.outDir, "adapters.gff")
+        with open(self.gff, 'w') as f:
+            f.write(GFF)
+        adapterindex._loadedIndices.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.outDir)
+
+    def test_overlaps(self):
+        """Test querying adapters which overlap an interval."""
+        index = AdapterIndex(adapterindex.parseGff(self.gff))
+        self.assertEqual(len(index), 4)
+        self.assertTrue(index.overlaps("chr1", 55, 70))
+        self.assertTrue(index.overlaps("chr1", 0, 11))
+        self.assertFalse(index.overlaps("chr1", 0, 10))
+        self.assertFalse(index.overlaps("chr1", 60, 100))
+        self.assertTrue(index.overlaps("chr1", 144, 200))
+        self.assertTrue(index.overlaps("chr2", 0, 1))
+        self.assertFalse(index.overlaps("chr3", 0, 1000))
+
+    def test_contains(self):
+        """Test querying adapters which contain an interval."""
+        index = AdapterIndex(adapterindex.parseGff(self.gff))
+        self.assertTrue(index.contains("chr1", 30, 60))
+        self.assertFalse(index.contains("chr1", 30, 61))
+        self.assertTrue(index.contains("chr1", 30, 61, flank=1))
+        self.assertFalse(index.contains("chr1", 50, 110))
+        self.assertTrue(index.isAdapterOnly("chr1", 95, 150))
+        self.assertFalse(index.isAdapterOnly("chr1", 60, 150))
+        self.assertFalse(index.isAdapterOnly("chr3", 0, 1))
+
+    def test_LoadAdapterIndex(self):
+        """Test caching the index next to the GFF file."""
+        index = LoadAdapterIndex(self.gff)
+        self.assertTrue(path.exists(self.gff + ADAPTER_INDEX_SUFFIX))
+        self.assertTrue(LoadAdapterIndex(self.gff) is index)
+
+        # Load from the cached index, without parsing the GFF file.
+        adapterindex._loadedIndices.clear()
+        parseGff = adapterindex.parseGff
+        adapterindex.parseGff = None
+        try:
+            self.assertTrue(LoadAdapterIndex(self.gff).overlaps(
+                "chr2", 0, 1))
+        finally:
+            adapterindex.parseGff = parseGff
+
+        # Rebuild the index once the GFF file changes.
+        with open(self.gff, 'a') as f:
+            f.write("chr3\t.\tadapter\t1\t45\t0.00\t+\t.\tID=adapter5\n")
+        self.assertTrue(LoadAdapterIndex(self.gff).overlaps("chr3", 0, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
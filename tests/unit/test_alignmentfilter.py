@@ -0,0 +1,162 @@
+"""Test pbalign/utils/alignmentfilter.py"""
+
+import random
+import unittest
+
+import numpy as np
+
+from pbalign.utils.alignmentfilter import FilterCriteria, alignmentMetrics, \
+    satisfies, selectHits, setPrimary, HitBuffer, resolveHits, isPrimary, \
+    FilterStats, samMode, SECONDARY_FLAG
+from fakes import FakeRead
+
+
+class Test_AlignmentFilter(unittest.TestCase):
+    """Test pbalign/utils/alignmentfilter.py"""
+    def test_alignmentMetrics(self):
+        """Test computing metrics of alignments from CIGARs."""
+        reads = [FakeRead(0, cigar=[(4, 5), (0, 90), (1, 5), (2, 5)], nm=20),
+                 FakeRead(0, cigar=[(7, 45), (8, 5)]),
+                 FakeRead(0, cigar=[])]
+        lengths, similarities, accuracies = alignmentMetrics(reads)
+        self.assertEqual(list(lengths), [95, 50, 0])
+        # 10 mismatches, 80 matches in 100 columns.
+        self.assertAlmostEqual(similarities[0], 80.0)
+        self.assertAlmostEqual(accuracies[0], 100.0 * (1 - 20.0 / 95))
+        self.assertAlmostEqual(similarities[1], 90.0)
+        self.assertAlmostEqual(accuracies[1], 90.0)
+
+    def test_satisfies(self):
+        """Test filter criteria."""
+        reads = [FakeRead(-100, cigar=[(0, 100)], nm=5),
+                 FakeRead(-100, cigar=[(0, 100)], nm=40),
+                 FakeRead(-100, cigar=[(0, 10)], nm=0),
+                 FakeRead(-10, cigar=[(0, 100)], nm=0),
+                 FakeRead(None, cigar=[(0, 100)], nm=0),
+                 FakeRead(-100, is_unmapped=True)]
+        criteria = FilterCriteria(minPctSimilarity=70, minPctAccuracy=70,
+                                  minLength=50, scoreCutoff=-50,
+                                  scoreSign=-1)
+        self.assertEqual(list(satisfies(reads, criteria)),
+                         [True, False, False, False, True, False])
+
+    def test_selectHits(self):
+        """Test applying hit policies to alignments against all chunks."""
+        rng = random.Random(1)
+        hits = [FakeRead(-50, 1, 10), FakeRead(-90, 2, 5),
+                FakeRead(-90, 0, 7), FakeRead(-70, 0, 1)]
+        self.assertEqual([h.score for h in
+                          selectHits(hits, "all", 3, -1, rng)],
+                         [-90, -90, -70])
+        self.assertEqual(len(selectHits(hits, "all", None, -1, rng)), 4)
+        self.assertEqual([h.tid for h in
+                          selectHits(hits, "allbest", 10, -1, rng)], [2, 0])
+        self.assertEqual(selectHits(hits, "leftmost", 10, -1, rng), [hits[2]])
+        self.assertTrue(selectHits(hits, "randombest", 10, -1, rng)[0]
+                        in hits[1:3])
+        self.assertEqual(len(selectHits(hits, "random", 10, -1, rng)), 1)
+        self.assertEqual(selectHits([], "randombest", 10, -1, rng), [])
+
+    def test_resolveHits(self):
+        """Test applying hit policies to streamed alignments."""
+        rng = random.Random(1)
+        def reads():
+            """Return alignments of two reads."""
+            return [FakeRead(-50, 1, 10, qname="a"),
+                    FakeRead(-90, 2, 5, qname="a"),
+                    FakeRead(-90, 0, 7, qname="a"),
+                    FakeRead(-70, 0, 1, qname="a"),
+                    FakeRead(-10, 0, 3, qname="b")]
+        def resolve(hitPolicy, maxHits):
+            """Return (qname, score, tid, is primary) of kept alignments."""
+            return [(h.qname, h.score, h.tid, isPrimary(h)) for h in
+                    resolveHits(reads(), hitPolicy, maxHits, -1, rng)]
+
+        kept = resolve("all", None)
+        self.assertEqual(sorted(kept),
+                         [("a", -90, 0, False), ("a", -90, 2, True),
+                          ("a", -70, 0, False), ("a", -50, 1, False),
+                          ("b", -10, 0, True)])
+        self.assertEqual(resolve("all", 3),
+                         [("a", -90, 2, True), ("a", -90, 0, False),
+                          ("a", -70, 0, False), ("b", -10, 0, True)])
+        self.assertEqual(resolve("all", 0), [])
+        self.assertEqual(resolve("allbest", None),
+                         [("a", -90, 2, True), ("a", -90, 0, False),
+                          ("b", -10, 0, True)])
+        self.assertEqual(resolve("leftmost", None),
+                         [("a", -90, 0, True), ("b", -10, 0, True)])
+        self.assertEqual(resolve("leftmost", 1),
+                         [("a", -90, 2, True), ("b", -10, 0, True)])
+        self.assertTrue(resolve("randombest", None)[0] in
+                        [("a", -90, 2, True), ("a", -90, 0, True)])
+        self.assertEqual([h[0] for h in resolve("random", None)], ["a", "b"])
+
+    def test_HitBuffer_bounded(self):
+        """Test that a hit buffer holds at most one alignment."""
+        hitBuffer = HitBuffer("all", None, -1, random.Random(1))
+        numOut = 0
+        for i in range(1000):
+            numOut += len(hitBuffer.add(FakeRead(-i)))
+            self.assertEqual(len(hitBuffer), 1)
+        hits = hitBuffer.flush()
+        self.assertEqual([h.score for h in hits], [-999])
+        self.assertEqual(numOut, 999)
+        self.assertEqual(len(hitBuffer), 0)
+
+    def test_FilterStats(self):
+        """Test counting rejected alignments and reads in batches."""
+        stats = FilterStats()
+        stats.addBatch([FakeRead(0, qname="a"), FakeRead(0, qname="a"),
+                        FakeRead(0, qname="b")],
+                       {"unmapped": np.array([True, True, True]),
+                        "minLength": np.array([False, True, False])},
+                       np.array([40, 150, 30]), np.array([80.0, 99.5, 70.0]))
+        # Read b continues in the next batch.
+        stats.addBatch([FakeRead(0, qname="b"),
+                        FakeRead(0, qname="c", is_unmapped=True)],
+                       {"unmapped": np.array([True, False]),
+                        "minLength": np.array([False, False])},
+                       np.array([60, 0]), np.array([75.0, 0.0]))
+        stats.finish()
+        stats.addOutput(FakeRead(0, qname="a"))
+
+        result = stats.toDict()
+        self.assertEqual(result["alignments"]["input"], 5)
+        self.assertEqual(result["alignments"]["passed"], 1)
+        self.assertEqual(result["alignments"]["output"], 1)
+        self.assertEqual(result["alignments"]["rejectedBy"]["unmapped"], 1)
+        self.assertEqual(result["alignments"]["rejectedBy"]["minLength"], 4)
+        self.assertEqual(result["alignments"]["rejectedBy"]["minAccuracy"], 0)
+        self.assertEqual(result["alignments"]["rejectedBy"]["hitPolicy"], 0)
+        self.assertEqual(result["reads"]["input"], 3)
+        self.assertEqual(result["reads"]["passed"], 1)
+        self.assertEqual(result["reads"]["output"], 1)
+        self.assertEqual(result["reads"]["rejectedBy"]["unmapped"], 1)
+        self.assertEqual(result["reads"]["rejectedBy"]["minLength"], 2)
+        self.assertEqual(result["histograms"]["alignedLength"]["counts"],
+                         [3, 1])
+        accuracyCounts = result["histograms"]["accuracy"]["counts"]
+        self.assertEqual(len(accuracyCounts), 101)
+        self.assertEqual([i for i, n in enumerate(accuracyCounts) if n > 0],
+                         [70, 75, 80, 99])
+
+    def test_samMode(self):
+        """Test pysam modes, with compression levels of BAM files."""
+        self.assertEqual(samMode("a.bam", False), 'rb')
+        self.assertEqual(samMode("a.sam", False), 'r')
+        self.assertEqual(samMode("a.bam", True), 'wb')
+        self.assertEqual(samMode("a.bam", True, 0), 'wb0')
+        self.assertEqual(samMode("a.sam", True, 1), 'wh')
+
+    def test_setPrimary(self):
+        """Test marking primary and secondary alignments."""
+        hits = [FakeRead(0), FakeRead(0)]
+        hits[0].flag = SECONDARY_FLAG
+        setPrimary(hits)
+        self.assertEqual([h.flag & SECONDARY_FLAG for h in hits],
+                         [0, SECONDARY_FLAG])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+"""Test pbalign/bampostservice.py"""
+
+import unittest
+
+import pbalign.bampostservice as bampostservice
+from pbalign.bampostservice import BamPostService
+
+
+class FakeFileNames(object):
+    """PBAlignFiles of a run which outputs out.bam."""
+    targetFileName = "ref.fasta"
+    filteredSam = "filtered.bam"
+    outBamFileName = "out.bam"
+    outBaiFileName = "out.bam.bai"
+    outPbiFileName = "out.bam.pbi"
+
+
+class Test_BamPostService(unittest.TestCase):
+    """Test pbalign/bampostservice.py"""
+    def newService(self, compressionLevel, capable=True):
+        """Return a BamPostService with samtools which supports all
+        capabilities if capable, otherwise none."""
+        service = BamPostService(FakeFileNames(), nproc=4,
+                                 sortMemory=1 << 30,
+                                 compressionLevel=compressionLevel)
+        service._samtoolsCapability = lambda flag: capable
+        return service
+
+    def test_sortcmd(self):
+        """Test that 'samtools sort' compresses at the given level."""
+        self.assertEqual(
+            self.newService(1)._sortcmd("in.bam", "out.bam", 4),
+            "samtools sort --threads 4 -m 1024M -l 1 -o out.bam in.bam")
+        self.assertEqual(
+            self.newService(None)._sortcmd("in.bam", "out.bam", 4,
+                                           byName=True),
+            "samtools sort --threads 4 -m 1024M -n -o out.bam in.bam")
+        # Old samtools supports neither -o nor -l.
+        self.assertEqual(
+            self.newService(1, capable=False)._sortcmd("in.bam",
+                                                       "out.bam", 4),
+            "samtools sort --threads 4 -m 1024M in.bam out")
+
+    def test_mergecmd(self):
+        """Test that 'samtools merge' compresses at the given level."""
+        self.assertEqual(
+            self.newService(0)._mergecmd(["a.bam", "b.bam"], "out.bam", 4),
+            "samtools merge -f -@ 4 -l 0 out.bam a.bam b.bam")
+        self.assertEqual(
+            self.newService(None)._mergecmd(["a.bam"], "out.bam", 4),
+            "samtools merge -f -@ 4 out.bam a.bam")
+
+    def test_mergeByName(self):
+        """Test that mergeByName() sorts each bam file by read name, then
+        merges them by read name."""
+        service = self.newService(1)
+        cmds = []
+        execute = bampostservice.Execute
+        bampostservice.Execute = lambda name, cmd: cmds.append(cmd)
+        try:
+            service.mergeByName(["a.bam", "b.bam"],
+                                ["a.byname.bam", "b.byname.bam"],
+                                "merged.bam")
+        finally:
+            bampostservice.Execute = execute
+        self.assertEqual(cmds, [
+            "samtools sort --threads 4 -m 1024M -l 1 -n -o a.byname.bam " +
+            "a.bam",
+            "samtools sort --threads 4 -m 1024M -l 1 -n -o b.byname.bam " +
+            "b.bam",
+            "samtools merge -f -@ 4 -l 1 -n merged.bam a.byname.bam " +
+            "b.byname.bam"])
+        self.assertEqual(service.plannedMergeByNameCmds(
+            ["a.bam", "b.bam"], ["a.byname.bam", "b.byname.bam"],
+            "merged.bam"), [("sort", cmds[0]), ("sort", cmds[1]),
+                            ("merge", cmds[2])])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+"""Test pbalign/batch.py"""
+
+import argparse
+import os
+import tempfile
+import shutil
+import unittest
+from os import path
+
+import pbalign.batch as batch
+from pbalign.batch import readManifest, run_batch, runJobs
+from fakes import FakeReference, FakeRunner
+
+
+class Test_Batch(unittest.TestCase):
+    """Test pbalign/batch.py"""
+    def setUp(self):
+        self.outDir = tempfile.mkdtemp()
+        self.manifest = path.join(self.outDir, "manifest.txt")
+        self.getContractParser = batch.get_contract_parser
+        self.sharedReference = batch.SharedReference
+        batch.get_contract_parser = self.fakeContractParser
+        batch.SharedReference = FakeReference
+
+    def tearDown(self):
+        batch.get_contract_parser = self.getContractParser
+        batch.SharedReference = self.sharedReference
+        shutil.rmtree(self.outDir)
+
+    def fakeContractParser(self):
+        """Return a contract parser of options which run_batch() uses."""
+        parser = argparse.ArgumentParser()
+        for name in ("inputFileName", "referencePath", "outputFileName"):
+            parser.add_argument(name)
+        parser.add_argument("--nproc", type=int)
+        parser.add_argument("--tmpDir", default=self.outDir)
+        parser.add_argument("--referenceCacheDir", default=None)
+        return argparse.Namespace(arg_parser=argparse.Namespace(
+            parser=parser))
+
+    def test_readManifest(self):
+        """Test readManifest()."""
+        with open(self.manifest, 'w') as f:
+            f.write("# input output\n" +
+                    "a.subreadset.xml  a.alignmentset.xml\n\n" +
+                    "dir with spaces/b.bam\tb.bam\n")
+        self.assertEqual(readManifest(self.manifest),
+                         [("a.subreadset.xml", "a.alignmentset.xml"),
+                          ("dir with spaces/b.bam", "b.bam")])
+
+    def test_readManifest_error(self):
+        """Test readManifest() with bad manifests."""
+        with open(self.manifest, 'w') as f:
+            f.write("# empty\n")
+        with self.assertRaises(ValueError):
+            readManifest(self.manifest)
+
+        with open(self.manifest, 'w') as f:
+            f.write("a.bam\n")
+        with self.assertRaises(ValueError):
+            readManifest(self.manifest)
+
+    def test_run_batch(self):
+        """Test that run_batch() runs each job in its own process and
+        counts failed jobs."""
+        outFiles = [path.join(self.outDir, "{n}.bam".format(n=n))
+                    for n in range(3)]
+        pairs = [("a.bam", outFiles[0]), ("b.bad", outFiles[1]),
+                 ("c.bam", outFiles[2])]
+        self.assertEqual(run_batch(pairs, "ref.fasta", [], nproc=4, jobs=2),
+                         1)
+        self.assertFalse(path.exists(outFiles[1]))
+        pids = set()
+        for outFile in (outFiles[0], outFiles[2]):
+            with open(outFile, 'r') as f:
+                pids.add(int(f.read()))
+        self.assertEqual(len(pids), 2)
+        self.assertFalse(os.getpid() in pids)
+
+    def test_runJobs_killed(self):
+        """Test that a job process killed without a result fails and
+        frees its job slot."""
+        runners = [FakeRunner(argparse.Namespace(
+            inputFileName=inFile,
+            outputFileName=path.join(self.outDir, inFile + ".bam")))
+                   for inFile in ("a.killed", "b.bam", "c.bam")]
+        errors = runJobs(runners, 1)
+        self.assertTrue("a.killed exited with code -9" in errors[0])
+        self.assertEqual(errors[1:], [None, None])
+
+
+if __name__ == "__main__":
+    unittest.main()
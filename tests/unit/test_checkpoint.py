@@ -0,0 +1,79 @@
+"""Test pbalign.utils/checkpoint.py"""
+
+import tempfile
+import shutil
+import unittest
+from argparse import Namespace
+from os import path
+
+from pbalign.utils.checkpoint import Checkpoint, runHash, fileChecksum
+
+
+class Test_Checkpoint(unittest.TestCase):
+    """Test pbalign.utils/checkpoint.py"""
+    def setUp(self):
+        self.outDir = tempfile.mkdtemp()
+        self.manifest = path.join(self.outDir, "checkpoint.json")
+        self.alnFile = path.join(self.outDir, "aln.bam")
+        with open(self.alnFile, 'w') as f:
+            f.write("alignments")
+
+    def tearDown(self):
+        shutil.rmtree(self.outDir)
+
+    def test_runHash(self):
+        """Test runHash()."""
+        h1 = runHash(Namespace(nproc=8, resume=True), [self.alnFile])
+        h2 = runHash(Namespace(nproc=8, resume=False), [self.alnFile])
+        h3 = runHash(Namespace(nproc=16, resume=True), [self.alnFile])
+        self.assertEqual(h1, h2)
+        self.assertNotEqual(h1, h3)
+
+        # Options which are not known to affect results are not hashed.
+        h4 = runHash(Namespace(nproc=8, newOption="x"), [self.alnFile])
+        self.assertEqual(h1, h4)
+
+    def test_resume(self):
+        """Test that a new Checkpoint skips stages which have been done."""
+        c = Checkpoint(self.manifest, "hash")
+        self.assertFalse(c.isDone("align"))
+        c.markDone("align", [self.alnFile])
+        self.assertTrue(c.isDone("align"))
+
+        c = Checkpoint(self.manifest, "hash")
+        self.assertTrue(c.isDone("align"))
+        self.assertEqual(c.files("align"), [self.alnFile])
+
+        # A different run must not use this manifest.
+        c = Checkpoint(self.manifest, "anotherhash")
+        self.assertFalse(c.isDone("align"))
+
+    def test_changedFile(self):
+        """Test that a stage is redone if its file has changed."""
+        c = Checkpoint(self.manifest, "hash")
+        checksum = fileChecksum(self.alnFile)
+        c.markDone("align", [self.alnFile])
+        with open(self.alnFile, 'a') as f:
+            f.write("truncated")
+        self.assertNotEqual(checksum, fileChecksum(self.alnFile))
+        self.assertFalse(c.isDone("align"))
+
+    def test_markDone(self):
+        """Test that redoing a stage forgets all later stages."""
+        c = Checkpoint(self.manifest, "hash")
+        c.markDone("align", [self.alnFile])
+        c.markDone("filter", [self.alnFile])
+        c.markDone("align", [self.alnFile])
+        self.assertTrue(c.isDone("align"))
+        self.assertFalse(c.isDone("filter"))
+
+    def test_disabled(self):
+        """Test that a disabled Checkpoint records nothing."""
+        c = Checkpoint(self.manifest, "hash", enabled=False)
+        c.markDone("align", [self.alnFile])
+        self.assertFalse(c.isDone("align"))
+        self.assertFalse(path.exists(self.manifest))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,6 @@
 """Test pbalign.util/fileutil.py"""
 
+import gzip
 import tempfile
 import unittest
 import filecmp
@@ -11,7 +12,8 @@ from pbcore.io import DataSet
 from pbalign.utils.fileutil import getFileFormat, \
     isValidInputFormat, isValidOutputFormat, getFilesFromFOFN, \
     checkInputFile, checkOutputFile, checkReferencePath, \
-    real_upath, real_ppath, isExist
+    real_upath, real_ppath, isExist, checkExist, getDataSetResources, \
+    isBamFile, validateReadFiles
 
 from test_setpath import ROOT_DIR, DATA_DIR
 
@@ -81,6 +83,79 @@ class Test_fileutil(unittest.TestCase):
         self.assertTrue(fs[1].endswith("m130406_011850_42141_c100513442550000001823074308221310_s1_p0.1.subreads.bam"))
 
 
+    def test_getDataSetResources(self):
+        """Test getDataSetResources()."""
+        xmlFN = path.join(self.rootDir,  "data/subreads_dataset1.xml")
+        resources = getDataSetResources(xmlFN)
+        self.assertEqual(len(resources), 2)
+        self.assertTrue(resources[0][0].endswith("m140905_042212_sidney_c100564852550000001823085912221377_s1_X0.1.subreads.bam"))
+        self.assertEqual(resources[0][1], resources[0][0] + ".pbi")
+
+    def test_getDataSetResources_nested(self):
+        """Test that getDataSetResources() skips resources nested in a read
+        file's resource, and adds resources of sub-datasets."""
+        xmlFN = path.join(self.outDir, "nested.subreadset.xml")
+        with open(xmlFN, 'w') as f:
+            f.write("""<?xml version="1.0" encoding="utf-8"?>
+<SubreadSet xmlns="http://pacificbiosciences.com/PacBioDatasets.xsd"
+ xmlns:pbbase="http://pacificbiosciences.com/PacBioBaseDataModel.xsd">
+ <pbbase:ExternalResources>
+  <pbbase:ExternalResource ResourceId="a.subreads.bam">
+   <pbbase:ExternalResources>
+    <pbbase:ExternalResource ResourceId="a.scraps.bam">
+     <pbbase:FileIndices>
+      <pbbase:FileIndex MetaType="PacBio.Index.PacBioIndex"
+                        ResourceId="a.scraps.bam.pbi"/>
+     </pbbase:FileIndices>
+    </pbbase:ExternalResource>
+   </pbbase:ExternalResources>
+   <pbbase:FileIndices>
+    <pbbase:FileIndex MetaType="PacBio.Index.PacBioIndex"
+                      ResourceId="a.subreads.bam.pbi"/>
+   </pbbase:FileIndices>
+  </pbbase:ExternalResource>
+ </pbbase:ExternalResources>
+ <DataSets>
+  <SubreadSet>
+   <pbbase:ExternalResources>
+    <pbbase:ExternalResource ResourceId="a.subreads.bam">
+     <pbbase:FileIndices>
+      <pbbase:FileIndex MetaType="PacBio.Index.PacBioIndex"
+                        ResourceId="a.subreads.bam.pbi"/>
+     </pbbase:FileIndices>
+    </pbbase:ExternalResource>
+    <pbbase:ExternalResource ResourceId="b.subreads.bam"/>
+   </pbbase:ExternalResources>
+  </SubreadSet>
+ </DataSets>
+</SubreadSet>
+""")
+        aFN = path.join(self.outDir, "a.subreads.bam")
+        bFN = path.join(self.outDir, "b.subreads.bam")
+        self.assertEqual(getDataSetResources(xmlFN),
+                         [(aFN, aFN + ".pbi"), (bFN, None)])
+
+    def test_validateReadFiles(self):
+        """Test isBamFile() and validateReadFiles()."""
+        bamFN = path.join(self.outDir, "a.subreads.bam")
+        f = gzip.open(bamFN, 'wb')
+        f.write("BAM\x01")
+        f.close()
+        notBamFN = path.join(self.outDir, "b.subreads.bam")
+        with open(notBamFN, 'w') as f:
+            f.write("BAM\x01")
+        self.assertTrue(isBamFile(bamFN))
+        self.assertFalse(isBamFile(notBamFN))
+
+        results = validateReadFiles([(bamFN, None), (notBamFN, None),
+                                     (bamFN + ".missing", None)])
+        self.assertEqual(results[0], (None, False))
+        self.assertIsNotNone(results[1][0])
+        self.assertIsNotNone(results[2][0])
+
+        open(bamFN + ".pbi", 'w').close()
+        self.assertEqual(validateReadFiles([(bamFN, None)]), [(None, True)])
+
     def test_checkOutputFile(self):
         """Test checkOutputFile()."""
         samFN = path.join(self.outDir, "lambda_out.sam")
@@ -137,6 +212,20 @@ class Test_fileutil(unittest.TestCase):
     def test_isExist(self):
         """Test isExist(ff)."""
         self.assertFalse(isExist(None))
+        self.assertTrue(isExist(self.outDir))
+        self.assertFalse(isExist(path.join(self.outDir, "missing")))
+        spaced = path.join(self.outDir, "with space")
+        open(spaced, 'w').close()
+        self.assertTrue(isExist(real_upath(spaced)))
+
+    def test_checkExist(self):
+        """Test checkExist(files)."""
+        files = [path.join(self.outDir, "{i}.bam".format(i=i))
+                 for i in range(40)]
+        for f in files[::2]:
+            open(f, 'w').close()
+        self.assertEqual(checkExist(files), [i % 2 == 0 for i in range(40)])
+        self.assertEqual(checkExist([]), [])
 
     def test_realpath(self):
         """Test real_upath and real_ppath."""
@@ -97,6 +97,8 @@ class Test_Options(unittest.TestCase):
         self.assertEqual(int(options.minAccuracy),   50)
         self.assertIsNone(options.algorithmOptions)
         self.assertIsNone(options.minAnchorSize)
+        # The native filter engine is opt-in.
+        self.assertEqual(options.filterEngine, "samFilter")
 
     def test_parseOptions_multi_algorithmOptions(self):
         """Test parseOptions with multiple algorithmOptions."""
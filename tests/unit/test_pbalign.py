@@ -5,6 +5,7 @@ import shutil
 from os import path
 
 from pbalign.pbalignrunner import PBAlignRunner
+from pbalign.utils.fileutil import FILE_FORMATS
 
 from test_setpath import ROOT_DIR, DATA_DIR
 
@@ -28,6 +29,16 @@ class Test_PBAlignRunner(unittest.TestCase):
         pbobj = PBAlignRunner(argumentList = argumentList)
         self.assertEqual(pbobj.start(), 0)
 
+    def test_init_with_shards(self):
+        """Test PBAlignRunner.__init__() with --shards."""
+        argumentList = ['--shards', '2', '--nproc', '4',
+                        self.queryFile, self.referenceFile,
+                        self.bamOut]
+        pbobj = PBAlignRunner(argumentList = argumentList)
+        self.assertEqual(pbobj.start(), 0)
+        self.assertTrue(path.exists(self.bamOut + ".bai"))
+        self.assertTrue(path.exists(self.bamOut + ".pbi"))
+
     def test_init_with_algorithmOptions(self):
         """Test PBAlignRunner.__init__() with --algorithmOptions."""
         argumentList = ['--algorithmOptions', '--minMatch 10 --useccsall',
@@ -58,6 +69,66 @@ class Test_PBAlignRunner(unittest.TestCase):
             # Expect a ValueError since --minMatch and --minAnchorSize conflicts.
             pbobj.start()
 
+    def _plannedRunner(self, options):
+        """Return a PBAlignRunner with options, whose align service has
+        been created, as run() would do before it selects --tmpDir."""
+        argumentList = options + ['--tmpDir', self.OUT_DIR, self.queryFile,
+                                  self.referenceFile, self.bamOut]
+        pbobj = PBAlignRunner(argumentList = argumentList)
+        pbobj._planResources()
+        pbobj._alnService = pbobj._createAlignService(
+            pbobj.args.algorithm, pbobj.args, pbobj.fileNames,
+            pbobj._tempFileManager)
+        pbobj._makeSane(pbobj.args, pbobj.fileNames)
+        return pbobj
+
+    def test_runMode_and_plan(self):
+        """Test PBAlignRunner._runMode() and _plan() of default, shards
+        and streaming runs."""
+        cases = [([], "default", "filter"),
+                 (['--shards', '2', '--nproc', '4'], "shards", "sort.1"),
+                 (['--streaming'], "streaming", "sort")]
+        for options, expectedMode, expectedStage in cases:
+            pbobj = self._plannedRunner(options)
+            try:
+                mode = pbobj._runMode(FILE_FORMATS.BAM)
+                self.assertEqual(mode, expectedMode)
+                stages = pbobj._plan(mode)
+                self.assertEqual(stages[0].name.split(".")[0], "align")
+                self.assertTrue(expectedStage in
+                                [stage.name for stage in stages])
+            finally:
+                pbobj._cleanUp(True)
+                pbobj.waitForCleanUp()
+
+    def test_chunks_do_not_cache_or_stage_reference(self):
+        """Test that a run against chunks of the reference neither builds
+        a suffix array of nor stages the whole reference."""
+        pbobj = self._plannedRunner(
+            ['--maxReferenceChunkSize', '1',
+             '--suffixArrayCacheDir', path.join(self.OUT_DIR, "sa"),
+             '--stagingDir', path.join(self.OUT_DIR, "staging")])
+        calls = []
+
+        class AlignedChunks(Exception):
+            """Raised instead of aligning reads against chunks."""
+
+        def alignReferenceChunks():
+            """Stop the run where it would align against chunks."""
+            raise AlignedChunks()
+        # The lambda reference is smaller than a chunk of 1 MB.
+        pbobj._canChunkReference = lambda *args: True
+        pbobj._alnService.cacheSuffixArray = lambda: calls.append("sa")
+        pbobj._stageReference = lambda *args: calls.append("staging")
+        pbobj._alignReferenceChunks = alignReferenceChunks
+        try:
+            with self.assertRaises(AlignedChunks):
+                pbobj.run()
+        finally:
+            pbobj._cleanUp(True)
+            pbobj.waitForCleanUp()
+        self.assertEqual(calls, [])
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,194 @@
+"""Test pbalign/utils/planutil.py"""
+
+import gzip
+import logging
+import struct
+import sys
+import tempfile
+import shutil
+import unittest
+from argparse import Namespace
+from os import path
+
+from pbalign.utils.planutil import PlanStage, pbiNumReads, peakMemory, \
+    peakTempBytes, fileSize, routeLoggingToStderr, planStages
+
+
+class FakeFileNames(object):
+    """PBAlignFiles of a run which aligns reads.bam to ref.fasta."""
+    def __init__(self, outDir):
+        self.inputFileName = path.join(outDir, "reads.bam")
+        with open(self.inputFileName, 'w') as f:
+            f.write("x" * 1000)
+        self.targetFileName = path.join(outDir, "ref.fasta")
+        with open(self.targetFileName, 'w') as f:
+            f.write(">ref\nACGT\n")
+        self.sawriterFileName = None
+        self.adapterGffFileName = None
+        self.outputFileName = path.join(outDir, "out.bam")
+        self.filteredSam = None
+
+    def GetInputResources(self):
+        """Return read files."""
+        return [self.inputFileName]
+
+
+class FakeAlignService(object):
+    """An AlignService which plans 'align query output' commands."""
+    scoreSign = -1
+
+    def __init__(self, queryFileName):
+        self.queryFileName = queryFileName
+
+    def plannedQueryFileName(self):
+        """Return the file which is aligned."""
+        return self.queryFileName
+
+    def plannedCmd(self, queryFileName, alignerSamOut, nproc=None,
+                   targetFileName=None, hitPolicy=None):
+        """Return a made-up command line."""
+        cmd = "align {q} {o}".format(q=queryFileName, o=alignerSamOut)
+        if targetFileName is not None:
+            cmd += " {t} {p}".format(t=targetFileName, p=hitPolicy)
+        return cmd
+
+
+class FakePostService(object):
+    """A BamPostService which plans sort, bai and pbi."""
+    sortMemory, nproc = 100, 2
+
+    def __init__(self, fileNames, shares=1, intermediate=False):
+        self.fileNames = fileNames
+
+    def plannedCmds(self, isSorted=False, sortedBamFiles=None):
+        """Return made-up commands."""
+        return [("sort", "sort " + self.fileNames.filteredSam),
+                ("bai", "bai"), ("pbi", "pbi")]
+
+    def plannedMergeByNameCmds(self, bamFiles, sortedBamFiles, outBamFile):
+        """Return made-up commands."""
+        return [("sort", "sort -n {i} {o}".format(i=i, o=o))
+                for i, o in zip(bamFiles, sortedBamFiles)] + \
+            [("merge", "merge -n " + outBamFile)]
+
+
+class Test_PlanUtil(unittest.TestCase):
+    """Test pbalign/utils/planutil.py"""
+    def setUp(self):
+        self.outDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.outDir)
+
+    def test_pbiNumReads(self):
+        """Test pbiNumReads()."""
+        pbiFile = path.join(self.outDir, "reads.bam.pbi")
+        self.assertIsNone(pbiNumReads(pbiFile))
+        f = gzip.open(pbiFile, 'wb')
+        f.write("PBI\x01" + struct.pack("<IHI", 0x030001, 0, 1234))
+        f.close()
+        self.assertEqual(pbiNumReads(pbiFile), 1234)
+
+    def test_fileSize(self):
+        """Test fileSize()."""
+        fileName = path.join(self.outDir, "ref.fasta")
+        with open(fileName, 'w') as f:
+            f.write(">ref\nACGT\n")
+        self.assertEqual(fileSize(fileName), 10)
+        self.assertEqual(fileSize(fileName + ".sa"), 0)
+        self.assertEqual(fileSize(None), 0)
+
+    def test_peakMemory(self):
+        """Test peakMemory() adds up memory of concurrent stages."""
+        stages = [PlanStage("align", "blasr", memoryBytes=100),
+                  PlanStage("sort", "samtools sort", ["align"],
+                            memoryBytes=50),
+                  PlanStage("bai", "samtools index", ["sort"],
+                            memoryBytes=60),
+                  PlanStage("pbi", "pbindex", ["sort"], memoryBytes=70)]
+        self.assertEqual(peakMemory(stages), 130)
+        self.assertEqual(stages[1].toDict()["dependsOn"], ["align"])
+
+    def test_peakTempBytes(self):
+        """Test peakTempBytes() adds up temporary files alive at once."""
+        stages = [PlanStage("align", "blasr", tempBytes=100),
+                  PlanStage("filter", "samFilter", ["align"],
+                            tempBytes=100),
+                  PlanStage("sort", "samtools sort", ["filter"],
+                            tempBytes=100, freedAfter="sort"),
+                  PlanStage("bai", "samtools index", ["sort"]),
+                  PlanStage("pbi", "pbindex", ["sort"])]
+        # Aligned alignments are deleted after filter.
+        self.assertEqual(peakTempBytes(stages), 200)
+        stages[0].freedAfter = "sort"
+        self.assertEqual(peakTempBytes(stages), 300)
+        self.assertEqual(peakTempBytes([]), 0)
+
+    def test_planStages(self):
+        """Test planning stages of a run by default."""
+        args = Namespace(nproc=4, algorithm="blasr", filterAdapterOnly=False)
+        fileNames = FakeFileNames(self.outDir)
+        stages = planStages(args, fileNames,
+                            FakeAlignService(fileNames.inputFileName),
+                            FakePostService, self.outDir, "default")
+        self.assertEqual([stage.name for stage in stages],
+                         ["align", "filter", "sort", "bai", "pbi"])
+        self.assertEqual(stages[0].cmd, "align {r} {f}".format(
+            r=fileNames.inputFileName,
+            f=path.join(self.outDir, "aligned.bam")))
+        self.assertEqual(stages[2].cmd, "sort {f}".format(
+            f=path.join(self.outDir, "filtered.bam")))
+        self.assertEqual(stages[0].tempBytes, int(1000 * 1.2))
+        self.assertEqual(stages[1].tempBytes, 0)
+        # Planned temporary files are not set on the run's file names.
+        self.assertIsNone(fileNames.filteredSam)
+
+    def test_planStages_chunks(self):
+        """Test planning stages of a run against reference chunks."""
+        args = Namespace(nproc=4, algorithm="blasr", filterAdapterOnly=False,
+                         maxReferenceChunkSize=1)
+        fileNames = FakeFileNames(self.outDir)
+        # A reference of 1.5 MB is split into 2 chunks of at most 1 MB.
+        with open(fileNames.targetFileName, 'w') as f:
+            f.write("x" * (3 << 19))
+        stages = planStages(args, fileNames,
+                            FakeAlignService(fileNames.inputFileName),
+                            FakePostService, self.outDir, "chunks")
+        self.assertEqual([stage.name for stage in stages],
+                         ["align.0", "align.1", "sort.0", "sort.1", "merge",
+                          "filter", "sort", "bai", "pbi"])
+        self.assertEqual(stages[1].cmd, "align {r} {b} {c} all".format(
+            r=fileNames.inputFileName,
+            b=path.join(self.outDir, "chunk1.bam"),
+            c=path.join(self.outDir, "chunk1.fasta")))
+        self.assertEqual(stages[4].dependsOn, ["sort.0", "sort.1"])
+        self.assertEqual(stages[6].cmd, "sort {f}".format(
+            f=path.join(self.outDir, "filtered.bam")))
+        # The reference chunks, chunk alignments, their sorted copies, the
+        # merged and filtered alignments, and the sorted output.
+        self.assertEqual(sum(stage.tempBytes for stage in stages),
+                         (3 << 19) + 6 * int(1000 * 1.2))
+        # Only the merged and filtered alignments outlive the merge.
+        self.assertEqual(peakTempBytes(stages),
+                         (3 << 19) + 4 * int(1000 * 1.2))
+        self.assertIsNone(fileNames.filteredSam)
+
+    def test_routeLoggingToStderr(self):
+        """Test that log handlers on stdout are moved to stderr."""
+        logger = logging.getLogger("pbalign.test_planutil")
+        stdoutHandler = logging.StreamHandler(sys.stdout)
+        fileHandler = logging.FileHandler(path.join(self.outDir, "log"))
+        logger.addHandler(stdoutHandler)
+        logger.addHandler(fileHandler)
+        try:
+            routeLoggingToStderr()
+            self.assertTrue(stdoutHandler.stream is sys.stderr)
+            self.assertFalse(fileHandler.stream is sys.stderr)
+        finally:
+            logger.removeHandler(stdoutHandler)
+            logger.removeHandler(fileHandler)
+            fileHandler.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
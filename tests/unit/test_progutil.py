@@ -1,5 +1,11 @@
+import json
+import os
+import shutil
+import tempfile
+import time
 import unittest
 from os import path
+import pbalign.utils.progutil as progutil
 from pbalign.utils.progutil import *
 
 class Test_progutil(unittest.TestCase):
@@ -15,5 +21,101 @@ class Test_progutil(unittest.TestCase):
     def testExecute(self):
         Execute("ls", "ls")
 
+    def testResourceUsages(self):
+        Execute("ls", "ls")
+        usage = ResourceUsages()[-1]
+        self.assertEqual(usage.stage, "ls")
+        self.assertEqual(usage.exitCode, 0)
+        self.assertTrue(usage.wallTime >= 0)
+        self.assertTrue(usage.maxRssKB > 0)
+
+    def testExecuteInBackground(self):
+        job = ExecuteInBackground("echo", "echo pbalign")
+        job.start()
+        output, errCode, _errMsg = job.wait()
+        self.assertEqual(errCode, 0)
+        self.assertEqual(output, ["pbalign"])
+        self.assertTrue(job.elapsedTime >= 0)
+
+        job = ExecuteInBackground("false", "false")
+        job.start()
+        with self.assertRaises(RuntimeError):
+            job.wait()
+
+    def testExecuteLongOutput(self):
+        n = KEPT_HEAD_LINES + KEPT_TAIL_LINES + 10
+        output, _errCode, _errMsg = Execute("seq", "seq 1 %d" % n)
+        self.assertEqual(len(output), KEPT_HEAD_LINES + KEPT_TAIL_LINES)
+        self.assertEqual(output[0], "1")
+        self.assertEqual(output[KEPT_HEAD_LINES], str(KEPT_HEAD_LINES + 11))
+        self.assertEqual(output[-1], str(n))
+
+    def testExecuteTimeout(self):
+        with self.assertRaises(RuntimeError):
+            Execute("sleep", "sleep 10", timeout=1)
+        self.assertEqual(ResourceUsages()[-1].exitCode, -9)
+
+    def testExecuteTimeoutAfterExit(self):
+        """A command which exits normally before it is reaped has not
+        timed out, even if the timer fires in between."""
+        wait4 = progutil._wait4
+        def lateWait4(pid):
+            """Reap the child after the timer has fired."""
+            time.sleep(2)
+            return wait4(pid)
+        progutil._wait4 = lateWait4
+        try:
+            output, errCode, _errMsg = Execute("echo", "echo pbalign",
+                                               timeout=1)
+        finally:
+            progutil._wait4 = wait4
+        self.assertEqual(errCode, 0)
+        self.assertEqual(output, ["pbalign"])
+
+    def testOutputLogDir(self):
+        logDir = tempfile.mkdtemp()
+        try:
+            ConfigureExecute(outputLogDir=logDir)
+            Execute("echo", "echo pbalign")
+        finally:
+            ConfigureExecute()
+        logFiles = [f for f in os.listdir(logDir) if f.endswith(".out")]
+        self.assertEqual(len(logFiles), 1)
+        with open(path.join(logDir, logFiles[0])) as f:
+            self.assertEqual(f.read(), "pbalign\n")
+        shutil.rmtree(logDir)
+
+    def testTmpDir(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            ConfigureExecute(tmpDir=tmpDir)
+            Execute("echo", "echo pbalign")
+        finally:
+            ConfigureExecute()
+        self.assertTrue(ResourceUsages()[-1].writeBytes is not None)
+        self.assertEqual(os.listdir(tmpDir), [])
+        shutil.rmtree(tmpDir)
+
+    def testWriteResourceReport(self):
+        ResetResourceUsages()
+        Execute("echo", "echo pbalign")
+        Execute("echo", "echo pbalign again")
+        Execute("ls", "ls")
+        outDir = tempfile.mkdtemp()
+        try:
+            reportFile = path.join(outDir, "resources.json")
+            WriteResourceReport(reportFile, totalWallTime=1.0)
+            with open(reportFile) as f:
+                report = json.load(f)
+        finally:
+            shutil.rmtree(outDir)
+        self.assertEqual(len(report["stages"]), 3)
+        self.assertEqual(sorted(report["stageCpuTimes"].keys()),
+                         ["echo", "ls"])
+        echoTimes = [s["userTime"] + s["sysTime"] for s in report["stages"]
+                     if s["stage"] == "echo"]
+        self.assertAlmostEqual(report["stageCpuTimes"]["echo"],
+                               sum(echoTimes))
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,111 @@
+"""Test pbalign/utils/referencecache.py"""
+
+import tempfile
+import shutil
+import unittest
+from os import path
+
+import pbalign.utils.referencecache as referencecache
+from pbalign.utils.referencecache import ReferenceCache
+
+
+class Test_ReferenceCache(unittest.TestCase):
+    """Test pbalign/utils/referencecache.py"""
+    def setUp(self):
+        self.outDir = tempfile.mkdtemp()
+        self.cacheDir = path.join(self.outDir, "cache")
+        self.fasta = path.join(self.outDir, "ref.fasta")
+        with open(self.fasta, 'w') as f:
+            f.write(">chr1\nACGT\n")
+        self.numResolved = 0
+        self.checkReferencePath = referencecache.checkReferencePath
+        referencecache.checkReferencePath = self.countedCheckReferencePath
+
+    def tearDown(self):
+        referencecache.checkReferencePath = self.checkReferencePath
+        shutil.rmtree(self.outDir)
+
+    def countedCheckReferencePath(self, refpath):
+        """Call checkReferencePath and count calls."""
+        self.numResolved += 1
+        return self.checkReferencePath(refpath)
+
+    def test_resolve(self):
+        """Test that a resolved reference is reused until it changes."""
+        expected = self.checkReferencePath(self.fasta)
+        cache = ReferenceCache(self.cacheDir)
+        self.assertEqual(cache.resolve(self.fasta), expected)
+        self.assertEqual(self.numResolved, 1)
+
+        # A new cache in another run reuses the resolved reference.
+        cache = ReferenceCache(self.cacheDir)
+        self.assertEqual(cache.resolve(self.fasta), expected)
+        self.assertEqual(self.numResolved, 1)
+
+        # A modified FASTA file invalidates the cached reference.
+        with open(self.fasta, 'a') as f:
+            f.write(">chr2\nTTTT\n")
+        cache.resolve(self.fasta)
+        self.assertEqual(self.numResolved, 2)
+
+    def test_contigRanges(self):
+        """Test that byte ranges of contigs are cached with the reference,
+        and parsed again only when the FASTA file changes."""
+        contigRanges = referencecache._contigRanges
+        parsed = []
+        def countedContigRanges(fastaFile):
+            """Call _contigRanges and record calls."""
+            parsed.append(fastaFile)
+            return contigRanges(fastaFile)
+        referencecache._contigRanges = countedContigRanges
+        try:
+            cache = ReferenceCache(self.cacheDir)
+            self.assertEqual(cache.contigRanges(self.fasta), [(0, 11)])
+            self.assertEqual(ReferenceCache(self.cacheDir).contigRanges(
+                self.fasta), [(0, 11)])
+            self.assertEqual(len(parsed), 1)
+            # The reference itself is still resolved from the cache.
+            cache.resolve(self.fasta)
+            self.assertEqual(self.numResolved, 1)
+
+            with open(self.fasta, 'a') as f:
+                f.write(">chr2\nTTTT\n")
+            self.assertEqual(cache.contigRanges(self.fasta),
+                             [(0, 11), (11, 22)])
+            self.assertEqual(len(parsed), 2)
+        finally:
+            referencecache._contigRanges = contigRanges
+        cache.resolve(self.fasta)
+        self.assertEqual(self.numResolved, 2)
+
+    def test_contigRanges(self):
+        """Test that byte ranges of contigs are cached with the reference,
+        and parsed again only when the FASTA file changes."""
+        contigRanges = referencecache._contigRanges
+        parsed = []
+        def countedContigRanges(fastaFile):
+            """Call _contigRanges and record calls."""
+            parsed.append(fastaFile)
+            return contigRanges(fastaFile)
+        referencecache._contigRanges = countedContigRanges
+        try:
+            cache = ReferenceCache(self.cacheDir)
+            self.assertEqual(cache.contigRanges(self.fasta), [(0, 11)])
+            self.assertEqual(ReferenceCache(self.cacheDir).contigRanges(
+                self.fasta), [(0, 11)])
+            self.assertEqual(len(parsed), 1)
+            # The reference itself is still resolved from the cache.
+            cache.resolve(self.fasta)
+            self.assertEqual(self.numResolved, 1)
+
+            with open(self.fasta, 'a') as f:
+                f.write(">chr2\nTTTT\n")
+            self.assertEqual(cache.contigRanges(self.fasta),
+                             [(0, 11), (11, 22)])
+            self.assertEqual(len(parsed), 2)
+        finally:
+            referencecache._contigRanges = contigRanges
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+"""Test pbalign/utils/referencechunks.py"""
+
+import tempfile
+import shutil
+import unittest
+from argparse import Namespace
+from os import path
+
+import pbalign.utils.referencechunks as referencechunks
+from pbalign.utils.alignmentfilter import isPrimary, FilterStats
+from pbalign.utils.referencechunks import groupContigs, splitReference, \
+    mergeHits
+from fakes import FakeRead, FakeSamfile
+
+
+class Test_ReferenceChunks(unittest.TestCase):
+    """Test pbalign/utils/referencechunks.py"""
+    def test_groupContigs(self):
+        """Test grouping contigs into chunks of bounded size."""
+        ranges = [(0, 10), (10, 30), (30, 100), (100, 110), (110, 115)]
+        self.assertEqual(groupContigs(ranges, 30),
+                         [(0, 30), (30, 100), (100, 115)])
+        self.assertEqual(groupContigs(ranges, 1000), [(0, 115)])
+
+    def test_splitReference(self):
+        """Test splitting a FASTA file into chunks."""
+        outDir = tempfile.mkdtemp()
+        try:
+            fasta = path.join(outDir, "ref.fasta")
+            contigs = [">chr1\nACGT\nAC\n", ">chr2\nGGGGGGGG\n", ">chr3\nT\n"]
+            with open(fasta, 'w') as f:
+                f.write("".join(contigs))
+            chunkFiles = splitReference(
+                fasta, 25, lambda i: path.join(outDir, "%d.fasta" % i))
+            chunks = []
+            for chunkFile in chunkFiles:
+                with open(chunkFile) as f:
+                    chunks.append(f.read())
+            self.assertEqual(chunks, [contigs[0], contigs[1] + contigs[2]])
+        finally:
+            shutil.rmtree(outDir)
+
+    def test_mergeHits(self):
+        """Test applying the hit policy to alignments against all chunks,
+        sorted by read name."""
+        pysam = referencechunks.pysam
+        referencechunks.pysam = Namespace(Samfile=FakeSamfile)
+        try:
+            FakeSamfile.files["merged.bam"] = [
+                FakeRead(-50, 0, 10, qname="a"),
+                FakeRead(-90, 1, 5, qname="a"),
+                FakeRead(-70, 2, 1, qname="a"),
+                FakeRead(None, is_unmapped=True, qname="b"),
+                FakeRead(-10, 1, 3, qname="c")]
+            self.assertEqual(mergeHits("merged.bam", "out.bam", "all", 2,
+                                       compressionLevel=1), (2, 3))
+            self.assertEqual(
+                [(h.qname, h.score, isPrimary(h))
+                 for h in FakeSamfile.files["out.bam"]],
+                [("a", -90, True), ("a", -70, False), ("c", -10, True)])
+            self.assertEqual(FakeSamfile.modes["out.bam"], "wb1")
+
+            self.assertEqual(mergeHits("merged.bam", "out.bam", "leftmost",
+                                       None), (2, 2))
+            self.assertEqual(FakeSamfile.modes["out.bam"], "wb")
+        finally:
+            referencechunks.pysam = pysam
+
+    def test_mergeHits_stats(self):
+        """Test counting alignments and reads while merging hits."""
+        pysam = referencechunks.pysam
+        referencechunks.pysam = Namespace(Samfile=FakeSamfile)
+        try:
+            FakeSamfile.files["merged.bam"] = [
+                FakeRead(-50, 0, 10, qname="a"),
+                FakeRead(-90, 1, 5, qname="a"),
+                FakeRead(None, is_unmapped=True, qname="b"),
+                FakeRead(-10, 1, 3, qname="c")]
+            stats = FilterStats()
+            self.assertEqual(mergeHits("merged.bam", "out.bam", "randombest",
+                                       None, stats=stats), (2, 2))
+            result = stats.toDict()
+            self.assertEqual(result["alignments"]["input"], 4)
+            self.assertEqual(result["alignments"]["output"], 2)
+            self.assertEqual(result["alignments"]["rejectedBy"]["unmapped"],
+                             1)
+            self.assertEqual(result["alignments"]["rejectedBy"]["hitPolicy"],
+                             1)
+            self.assertEqual(result["reads"]["input"], 3)
+            self.assertEqual(result["reads"]["output"], 2)
+            self.assertEqual(result["reads"]["rejectedBy"]["unmapped"], 1)
+        finally:
+            referencechunks.pysam = pysam
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+"""Test pbalign/utils/resourceutil.py"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from os import path
+
+from pbalign.utils.resourceutil import ResourcePlan, availableCpus, \
+    availableMemory, cgroupCpuLimit, cgroupMemoryLimit, cgroupDirs, \
+    MIN_SORT_MEMORY, MAX_SORT_MEMORY
+
+GB = 1024 * 1024 * 1024
+
+
+class Test_ResourceUtil(unittest.TestCase):
+    """Test pbalign/utils/resourceutil.py"""
+    def setUp(self):
+        self.rootDir = tempfile.mkdtemp()
+        self.procCgroup = path.join(self.rootDir, "cgroup")
+        self.mountInfo = path.join(self.rootDir, "mountinfo")
+
+    def tearDown(self):
+        shutil.rmtree(self.rootDir)
+
+    def writeFile(self, fileName, content):
+        """Write content to fileName, making its directory."""
+        if not path.isdir(path.dirname(fileName)):
+            os.makedirs(path.dirname(fileName))
+        with open(fileName, 'w') as f:
+            f.write(content)
+
+    def test_cgroup2(self):
+        """Test that limits are read along a nested cgroup v2 path."""
+        mountPoint = path.join(self.rootDir, "fs", "cgroup")
+        self.writeFile(self.procCgroup, "0::/slurm/job_1/step_0\n")
+        self.writeFile(self.mountInfo,
+                       "25 1 8:1 / / rw - ext4 /dev/sda1 rw\n" +
+                       "30 25 0:26 / {m} rw,nosuid - cgroup2 cgroup2 rw\n"
+                       .format(m=mountPoint))
+        slurm = path.join(mountPoint, "slurm")
+        job = path.join(slurm, "job_1")
+        step = path.join(job, "step_0")
+        self.assertEqual(cgroupDirs("cpu", self.procCgroup, self.mountInfo),
+                         (2, [step, job, slurm, mountPoint]))
+
+        self.writeFile(path.join(slurm, "cpu.max"), "800000 100000\n")
+        self.writeFile(path.join(job, "cpu.max"), "200000 100000\n")
+        self.writeFile(path.join(step, "cpu.max"), "max 100000\n")
+        self.writeFile(path.join(job, "memory.max"), "1073741824\n")
+        self.writeFile(path.join(step, "memory.max"), "max\n")
+        self.assertEqual(cgroupCpuLimit(self.procCgroup, self.mountInfo), 2.0)
+        self.assertEqual(cgroupMemoryLimit(self.procCgroup, self.mountInfo),
+                         GB)
+
+    def test_cgroup1(self):
+        """Test that limits are read from cgroup v1 controller mounts of
+        a container, which mount only the container's own cgroup."""
+        cpuMount = path.join(self.rootDir, "fs", "cpu")
+        memoryMount = path.join(self.rootDir, "fs", "memory")
+        self.writeFile(self.procCgroup,
+                       "9:memory:/docker/abc\n4:cpu,cpuacct:/docker/abc\n")
+        self.writeFile(self.mountInfo,
+                       ("40 30 0:35 /docker/abc {c} rw - cgroup cgroup " +
+                        "rw,cpu,cpuacct\n" +
+                        "41 30 0:36 /docker/abc {m} rw - cgroup cgroup " +
+                        "rw,memory\n").format(c=cpuMount, m=memoryMount))
+        self.writeFile(path.join(cpuMount, "cpu.cfs_quota_us"), "150000\n")
+        self.writeFile(path.join(cpuMount, "cpu.cfs_period_us"), "100000\n")
+        self.writeFile(path.join(memoryMount, "memory.limit_in_bytes"),
+                       "536870912\n")
+        self.assertEqual(cgroupCpuLimit(self.procCgroup, self.mountInfo), 1.5)
+        self.assertEqual(cgroupMemoryLimit(self.procCgroup, self.mountInfo),
+                         GB / 2)
+
+    def test_cgroup_none(self):
+        """Test that there is no limit without cgroup files."""
+        self.assertEqual(cgroupDirs("cpu", self.procCgroup, self.mountInfo),
+                         (None, []))
+        self.assertIsNone(cgroupCpuLimit(self.procCgroup, self.mountInfo))
+        self.assertIsNone(cgroupMemoryLimit(self.procCgroup, self.mountInfo))
+
+    def test_available(self):
+        """Test availableCpus() and availableMemory()."""
+        self.assertTrue(availableCpus() >= 1)
+        self.assertTrue(availableMemory() > 0)
+
+    def test_ResourcePlan_big_node(self):
+        """Test that sort memory is capped on a node with many CPUs."""
+        plan = ResourcePlan(nproc=None, cpus=64, memory=64 * GB)
+        self.assertEqual(plan.alignThreads, 64)
+        self.assertEqual(plan.sortThreads, 64)
+        self.assertEqual(plan.sortMemory, GB / 2)
+        self.assertTrue(plan.sortThreads * plan.sortMemory <= 32 * GB)
+        self.assertEqual(plan.indexConcurrency, 2)
+
+    def test_ResourcePlan_small_memory(self):
+        """Test that sort threads are reduced if memory is short."""
+        plan = ResourcePlan(nproc=8, cpus=8, memory=GB)
+        self.assertEqual(plan.alignThreads, 8)
+        self.assertEqual(plan.sortThreads, 2)
+        self.assertEqual(plan.sortMemory, MIN_SORT_MEMORY)
+
+        plan = ResourcePlan(nproc=1, cpus=1, memory=64 * GB)
+        self.assertEqual(plan.sortMemory, MAX_SORT_MEMORY)
+        self.assertEqual(plan.indexConcurrency, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+"""Test pbalign/utils/sacache.py"""
+
+import os
+import tempfile
+import shutil
+import unittest
+from argparse import Namespace
+from os import path
+
+from pbalign.alignservice.blasr import BlasrService
+from pbalign.utils.sacache import SuffixArrayCache
+from fakes import FakeProgram
+
+
+class Test_SuffixArrayCache(unittest.TestCase):
+    """Test pbalign/utils/sacache.py"""
+    def setUp(self):
+        self.outDir = tempfile.mkdtemp()
+        self.cacheDir = path.join(self.outDir, "sa")
+        # A fake sawriter which counts how many times it is called.
+        binDir = path.join(self.outDir, "bin")
+        os.mkdir(binDir)
+        self.sawriter = FakeProgram(binDir, "sawriter", "echo sa > $1")
+        self.oldPath = os.environ["PATH"]
+        os.environ["PATH"] = binDir + os.pathsep + self.oldPath
+
+        self.fastas = [path.join(self.outDir, name) for name in
+                       ("a.fasta", "copy_of_a.fasta")]
+        for fasta in self.fastas:
+            with open(fasta, 'w') as f:
+                f.write(">chr1\nACGT\n")
+
+    def tearDown(self):
+        os.environ["PATH"] = self.oldPath
+        shutil.rmtree(self.outDir)
+
+    def test_build(self):
+        """Test that a suffix array is built once per reference content."""
+        cache = SuffixArrayCache(self.cacheDir)
+        self.assertIsNone(cache.get(self.fastas[0]))
+        saFile = cache.build(self.fastas[0])
+        self.assertTrue(path.exists(saFile))
+        self.assertEqual(self.sawriter.numCalls(), 1)
+
+        # A copy of the same reference shares the suffix array.
+        cache = SuffixArrayCache(self.cacheDir)
+        self.assertEqual(cache.get(self.fastas[1]), saFile)
+        self.assertEqual(cache.build(self.fastas[1]), saFile)
+        self.assertEqual(self.sawriter.numCalls(), 1)
+
+        # A suffix array with another lookup table size is built again.
+        self.assertNotEqual(cache.build(self.fastas[0], 6), saFile)
+        self.assertEqual(self.sawriter.numCalls(), 2)
+
+    def test_unusable_cache_dir(self):
+        """Test that blasr runs without a cached suffix array if the cache
+        dir can not be made."""
+        notDir = path.join(self.outDir, "not_a_dir")
+        open(notDir, 'w').close()
+        cacheDir = path.join(notDir, "sa")
+        with self.assertRaises(OSError):
+            SuffixArrayCache(cacheDir)
+
+        # Only the attributes used by cacheSuffixArray() are set.
+        service = BlasrService.__new__(BlasrService)
+        service._options = Namespace(suffixArrayCacheDir=cacheDir,
+                                     minAnchorSize=None)
+        service._fileNames = Namespace(sawriterFileName=None,
+                                       targetFileName=self.fastas[0])
+        service.cacheSuffixArray()
+        self.assertIsNone(service._fileNames.sawriterFileName)
+        self.assertEqual(self.sawriter.numCalls(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
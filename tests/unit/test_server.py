@@ -0,0 +1,133 @@
+"""Test pbalign/server.py"""
+
+import os
+import tempfile
+import shutil
+import threading
+import unittest
+from argparse import Namespace
+from os import path, mkdir
+
+import pbalign.server as server
+from pbalign.server import warmPageCache, AlignmentServer, submitJob, \
+    resolvePaths
+from fakes import FakeReference, FakeRunner
+
+
+class Test_Server(unittest.TestCase):
+    """Test pbalign/server.py"""
+    def setUp(self):
+        self.outDir = tempfile.mkdtemp()
+        self.sharedReference = server.SharedReference
+        server.SharedReference = FakeReference
+        self.pbalignRunner = server.PBAlignRunner
+        server.PBAlignRunner = FakeRunner
+
+    def tearDown(self):
+        server.SharedReference = self.sharedReference
+        server.PBAlignRunner = self.pbalignRunner
+        shutil.rmtree(self.outDir)
+
+    def test_warmPageCache(self):
+        """Test warmPageCache()."""
+        fileName = path.join(self.outDir, "ref.fasta")
+        with open(fileName, 'w') as f:
+            f.write(">ref\nACGT\n")
+        indexDir = path.join(self.outDir, "index")
+        mkdir(indexDir)
+        with open(path.join(indexDir, "ref.1.bt2"), 'w') as f:
+            f.write("x" * 100)
+        self.assertEqual(warmPageCache([fileName, indexDir,
+                                        path.join(self.outDir, "missing")]),
+                         110)
+
+    def test_serve_submit(self):
+        """Test submitting jobs to a server, which runs each job in its
+        own process."""
+        socketPath = path.join(self.outDir, "pbalign.sock")
+        alignmentServer = AlignmentServer(socketPath, 2, self.outDir,
+                                          warmInterval=0)
+        workers = [w.process for w in alignmentServer._workers]
+        serving = threading.Thread(target=alignmentServer.serve)
+        serving.daemon = True
+        serving.start()
+        try:
+            outFile = path.join(self.outDir, "out.bam")
+            self.assertEqual(submitJob(socketPath, Namespace(
+                inputFileName="in.bam", referencePath="ref.fasta",
+                outputFileName=outFile)), (0, None))
+            with open(outFile, 'r') as f:
+                self.assertNotEqual(int(f.read()), os.getpid())
+
+            exitCode, errMsg = submitJob(socketPath, Namespace(
+                inputFileName="in.bad", referencePath="ref.fasta",
+                outputFileName=path.join(self.outDir, "bad.bam")))
+            self.assertEqual(exitCode, 1)
+            self.assertTrue("bad input" in errMsg)
+        finally:
+            alignmentServer.shutdown()
+            serving.join()
+        self.assertFalse(path.exists(socketPath))
+        self.assertFalse(any(w.is_alive() for w in workers))
+
+    def test_workers_forked_at_start(self):
+        """Test that workers are forked when the server is created, and
+        that a killed job does not take its worker down."""
+        socketPath = path.join(self.outDir, "pbalign.sock")
+        threadCount = threading.active_count()
+        alignmentServer = AlignmentServer(socketPath, 1, self.outDir,
+                                          warmInterval=0)
+        self.assertEqual(threading.active_count(), threadCount)
+        workers = [w.process for w in alignmentServer._workers]
+        self.assertEqual(len(workers), 1)
+        self.assertTrue(workers[0].is_alive())
+        serving = threading.Thread(target=alignmentServer.serve)
+        serving.daemon = True
+        serving.start()
+        try:
+            exitCode, errMsg = submitJob(socketPath, Namespace(
+                inputFileName="in.killed", referencePath="ref.fasta",
+                outputFileName=path.join(self.outDir, "killed.bam")))
+            self.assertEqual(exitCode, 1)
+            self.assertTrue(errMsg is not None)
+
+            outFile = path.join(self.outDir, "out.bam")
+            self.assertEqual(submitJob(socketPath, Namespace(
+                inputFileName="in.bam", referencePath="ref.fasta",
+                outputFileName=outFile)), (0, None))
+            with open(outFile, 'r') as f:
+                pid = int(f.read())
+            self.assertNotEqual(pid, os.getpid())
+            self.assertNotEqual(pid, workers[0].pid)
+            self.assertTrue(workers[0].is_alive())
+        finally:
+            alignmentServer.shutdown()
+            serving.join()
+        self.assertFalse(workers[0].is_alive())
+
+    def test_resolvePaths(self):
+        """Test that each of a list of temporary dirs is made absolute."""
+        job = resolvePaths(Namespace(inputFileName="in.bam",
+                                     tmpDir="scratch,/tmp",
+                                     unaligned=None))
+        self.assertEqual(job["inputFileName"], path.abspath("in.bam"))
+        self.assertEqual(job["tmpDir"],
+                         path.abspath("scratch") + ",/tmp")
+        self.assertIsNone(job["unaligned"])
+
+    def test_resolvePaths_of_later_options(self):
+        """Test that paths of cache, staging and log dirs are made absolute,
+        and flags are left as they are."""
+        job = resolvePaths(Namespace(stagingDir="stage",
+                                     referenceCacheDir="~/refs",
+                                     toolManifest="tools.json",
+                                     filterStats=True))
+        self.assertEqual(job["stagingDir"], path.abspath("stage"))
+        self.assertEqual(job["referenceCacheDir"],
+                         path.expanduser("~/refs"))
+        self.assertEqual(job["toolManifest"], path.abspath("tools.json"))
+        self.assertTrue(job["filterStats"] is True)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+"""Test pbalign/utils/stagingcache.py"""
+
+import os
+import tempfile
+import shutil
+import unittest
+from os import path
+
+from pbalign.utils import stagingcache
+from pbalign.utils.stagingcache import StagingCache
+
+
+class Test_StagingCache(unittest.TestCase):
+    """Test pbalign/utils/stagingcache.py"""
+    def setUp(self):
+        self.outDir = tempfile.mkdtemp()
+        self.cacheDir = path.join(self.outDir, "staging")
+        self.files = []
+        for name in ("a.fasta", "b.fasta", "c.fasta"):
+            fileName = path.join(self.outDir, name)
+            with open(fileName, 'w') as f:
+                f.write(">{n}\n{s}\n".format(n=name, s="A" * 100))
+            self.files.append(fileName)
+
+    def tearDown(self):
+        shutil.rmtree(self.outDir)
+
+    def test_stage(self):
+        """Test that a staged file is copied once and reused."""
+        cache = StagingCache(self.cacheDir, 1000)
+        staged = cache.stage(self.files[0])
+        self.assertNotEqual(staged, self.files[0])
+        self.assertTrue(staged.startswith(self.cacheDir))
+        with open(staged) as f1, open(self.files[0]) as f2:
+            self.assertEqual(f1.read(), f2.read())
+        self.assertEqual(StagingCache(self.cacheDir, 1000).stage(
+            self.files[0]), staged)
+
+    def test_evict(self):
+        """Test that least recently used entries not in use are evicted."""
+        size = path.getsize(self.files[0])
+        cache = StagingCache(self.cacheDir, 2 * size)
+        staged = [cache.stage(self.files[0]), cache.stage(self.files[1])]
+        # Both entries are in use, so the third file is used in place.
+        self.assertEqual(cache.stage(self.files[2]), self.files[2])
+
+        cache.release()
+        os.utime(path.dirname(staged[0]), (0, 0))
+        staged.append(cache.stage(self.files[2]))
+        self.assertFalse(path.exists(staged[0]))
+        self.assertTrue(path.exists(staged[1]))
+        self.assertTrue(path.exists(staged[2]))
+
+    def test_large_file(self):
+        """Test that a file larger than the cache is used in place."""
+        cache = StagingCache(self.cacheDir, 10)
+        self.assertEqual(cache.stage(self.files[0]), self.files[0])
+
+    def test_copy_error(self):
+        """Test that a file which fails to be copied is used in place, and
+        that lock files are closed but kept, since other processes may hold
+        locks of them."""
+        cache = StagingCache(self.cacheDir, 1000)
+        def failedCopy(fileName, stagedFile):
+            """Fail to copy a file."""
+            raise IOError("No space left on device")
+        cache._copy = failedCopy
+        self.assertEqual(cache.stage(self.files[0]), self.files[0])
+        self.assertEqual(cache._held, [])
+        self.assertEqual(len(os.listdir(cache.locksDir)), 2)
+
+    def test_reservation(self):
+        """Test that bytes reserved by copies in progress are not used by
+        other copies, and that a failed copy releases its reservation."""
+        size = path.getsize(self.files[0])
+        cache = StagingCache(self.cacheDir, 2 * size)
+        # A live process is copying a file of 2 * size bytes.
+        with open(path.join(cache.reservationsDir,
+                            "other.{p}".format(p=os.getpid())), 'w') as f:
+            f.write(str(2 * size))
+        self.assertEqual(cache.stage(self.files[0]), self.files[0])
+        os.remove(path.join(cache.reservationsDir,
+                            "other.{p}".format(p=os.getpid())))
+
+        copyfile = stagingcache.shutil.copyfile
+        def failedCopy(src, dst):
+            """Fail to copy a file."""
+            raise IOError("No space left on device")
+        stagingcache.shutil.copyfile = failedCopy
+        try:
+            self.assertEqual(cache.stage(self.files[1]), self.files[1])
+        finally:
+            stagingcache.shutil.copyfile = copyfile
+        self.assertEqual(os.listdir(cache.reservationsDir), [])
+        self.assertEqual([d for d in os.listdir(cache.entriesDir)
+                          if d.endswith(".tmp")], [])
+        self.assertNotEqual(cache.stage(self.files[1]), self.files[1])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,16 @@
+import pbalign.utils.tempfileutil as tempfileutil
 from pbalign.utils.tempfileutil import TempFileManager
 import unittest
 from os import path
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+from fakes import FakeProgram
 
 def keep_writing_to_file(fn):
     """Keep writing a to a file."""
@@ -85,6 +95,128 @@ class Test_TempFileManager(unittest.TestCase):
 #        import shutil
 #        shutil.rmtree(rootDir)
 #
+    def test_RegisterNewTmpFifo(self):
+        """Test TempFileManager.RegisterNewTmpFifo()."""
+        t = TempFileManager()
+        fifo = t.RegisterNewTmpFifo(suffix=".bam")
+        self.assertTrue(fifo.endswith(".bam"))
+        self.assertTrue(stat.S_ISFIFO(os.stat(fifo).st_mode))
+        self.assertTrue(t._isRegistered(fifo))
+
+        t.CleanUp()
+        self.assertFalse(path.exists(fifo))
+
+    def test_CleanUp_background(self):
+        """Test TempFileManager.CleanUp() in the background."""
+        t = TempFileManager()
+        rootDir = t.defaultRootDir
+        newDN = t.RegisterNewTmpFile(isDir=True)
+        newFN = t.RegisterNewTmpFile(rootDir=newDN)
+        self.assertTrue(t._isRegistered(newFN))
+
+        t.CleanUp(wait=False)
+        self.assertFalse(t._isRegistered(newFN))
+        self.assertEqual(t.fileDB, [])
+        self.assertEqual(t.dirDB, [])
+        t.WaitForCleanUp()
+        self.assertFalse(path.exists(rootDir))
+
+    def test_CleanUp_background_error(self):
+        """Test that files which can not be deleted in the background are
+        reported by WaitForCleanUp()."""
+        t = TempFileManager()
+        busyDir = tempfile.mkdtemp()
+        # A directory registered as a file can not be removed.
+        t.RegisterExistingTmpFile(busyDir, own=True)
+        t.CleanUp(wait=False)
+        errors = t.WaitForCleanUp()
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(busyDir in errors[0])
+        self.assertEqual(t.WaitForCleanUp(), [])
+        os.rmdir(busyDir)
+
+    def test_CleanUp_background_exit(self):
+        """Test that a process exits without waiting for its temporary
+        files to be deleted in the background."""
+        binDir = tempfile.mkdtemp()
+        # Deleting takes 5 seconds.
+        FakeProgram(binDir, "rm", 'sleep 5; exec /bin/rm "$@"')
+        script = "from pbalign.utils.tempfileutil import TempFileManager\n" \
+                 "t = TempFileManager()\n" \
+                 "print(t.RegisterNewTmpFile(isDir=True))\n" \
+                 "t.CleanUp(wait=False)\n"
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path),
+                   PATH=binDir + os.pathsep + os.environ["PATH"])
+        try:
+            startTime = time.time()
+            tmpDir = subprocess.check_output([sys.executable, "-c", script],
+                                             env=env).strip()
+            self.assertTrue(time.time() - startTime < 4)
+            self.assertTrue(path.isdir(tmpDir))
+            for _i in range(100):
+                if not path.exists(tmpDir):
+                    break
+                time.sleep(0.2)
+            self.assertFalse(path.exists(tmpDir))
+        finally:
+            shutil.rmtree(binDir)
+
+    def test_SetMemoryRootDir(self):
+        """Test that files spill to disk above the memory budget."""
+        t = TempFileManager()
+        diskDir = t.defaultRootDir
+        memoryDir = t.RegisterNewTmpFile(isDir=True)
+        # Twice the size hint of a file is reserved for it.
+        t.SetMemoryRootDir(memoryDir, 200)
+
+        inMemory = t.RegisterNewTmpFile(suffix=".bam", sizeHint=60)
+        self.assertEqual(path.dirname(path.dirname(inMemory)), memoryDir)
+        self.assertTrue(t.IsInMemory(inMemory))
+        onDisk = t.RegisterNewTmpFile(suffix=".bam", sizeHint=60)
+        self.assertEqual(path.dirname(onDisk), diskDir)
+        self.assertFalse(t.IsInMemory(onDisk))
+        noHint = t.RegisterNewTmpFile(suffix=".bam")
+        self.assertEqual(path.dirname(noHint), diskDir)
+
+        # Deleting a file releases memory reserved for it.
+        t.DeleteTmpFile(inMemory)
+        self.assertFalse(path.exists(inMemory))
+        self.assertFalse(t._isRegistered(inMemory))
+        inMemory = t.RegisterNewTmpFile(suffix=".bam", sizeHint=60)
+        self.assertTrue(t.IsInMemory(inMemory))
+
+        t.CleanUp()
+        self.assertFalse(path.exists(inMemory))
+        self.assertFalse(path.exists(memoryDir))
+
+    def test_SelectRootDir(self):
+        """Test selecting the first root dir with enough free space."""
+        smallDir, bigDir = tempfile.mkdtemp(), tempfile.mkdtemp()
+        free = {smallDir: 10, bigDir: 1000}
+        freeBytes = tempfileutil.freeBytes
+        # The default root dir and smallDir are too small, bigDir fits.
+        tempfileutil.freeBytes = lambda d: free.get(d, 10)
+        try:
+            t = TempFileManager()
+            candidates = ",".join([path.join(smallDir, "nonexistent"),
+                                   smallDir, bigDir])
+            rootDir = t.SelectRootDir(candidates, 100)
+            self.assertEqual(path.dirname(rootDir), bigDir)
+            self.assertEqual(t.defaultRootDir, rootDir)
+            self.assertTrue(t.isRootDirPinned)
+            # The selected root dir is pinned.
+            t.SetRootDir(smallDir)
+            self.assertEqual(t.defaultRootDir, rootDir)
+            t.CleanUp()
+
+            t = TempFileManager()
+            with self.assertRaises(IOError):
+                t.SelectRootDir(candidates, 10000)
+            t.CleanUp()
+        finally:
+            tempfileutil.freeBytes = freeBytes
+            os.rmdir(smallDir)
+            os.rmdir(bigDir)
 
 if __name__ == "__main__":
     unittest.main()
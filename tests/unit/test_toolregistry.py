@@ -0,0 +1,70 @@
+"""Test pbalign/utils/toolregistry.py"""
+
+import os
+import tempfile
+import shutil
+import unittest
+from os import path
+
+from pbalign.utils.toolregistry import ToolRegistry, _parseVersion
+from fakes import FakeProgram
+
+
+class Test_ToolRegistry(unittest.TestCase):
+    """Test pbalign/utils/toolregistry.py"""
+    def setUp(self):
+        self.outDir = tempfile.mkdtemp()
+        # A fake samtools which counts how many times it is called.
+        self.fakeSamtools = FakeProgram(self.outDir, "samtools",
+                                        "echo 'samtools 1.2'")
+        self.samtools = self.fakeSamtools.fileName
+        self.manifest = path.join(self.outDir, "tools.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.outDir)
+
+    def test_parseVersion(self):
+        """Test _parseVersion()."""
+        self.assertEqual(_parseVersion("samtools 1.3.1\nUsing htslib 1.3"),
+                         ["1", "3", "1"])
+        self.assertEqual(_parseVersion("\nProgram: samtools\n" +
+                                       "Version: 0.1.19-44428cd\n"),
+                         ["0", "1", "19"])
+        self.assertIsNone(_parseVersion("unknown"))
+
+    def test_registry(self):
+        """Test that a tool is resolved once and reused via manifest."""
+        registry = ToolRegistry(self.manifest)
+        self.assertTrue(registry.isAvailable(self.samtools))
+        self.assertFalse(registry.isAvailable("no_such_program_pbalign"))
+        # Only versions of known programs are asked for.
+        self.assertEqual(self.fakeSamtools.numCalls(), 0)
+
+    def test_capabilities(self):
+        """Test capability flags and the manifest."""
+        oldPath = os.environ["PATH"]
+        os.environ["PATH"] = self.outDir + os.pathsep + oldPath
+        try:
+            registry = ToolRegistry(self.manifest)
+            self.assertEqual(registry.version("samtools"), ["1", "2"])
+            self.assertTrue(registry.capability("samtools",
+                                                "sortOutputOption"))
+            self.assertFalse(registry.capability("samtools",
+                                                 "indexOutputArgument"))
+            self.assertTrue(registry.capability("samtools",
+                                                "sortCompressionLevel"))
+            self.assertFalse(registry.capability("samtools",
+                                                 "mergeCompressionLevel"))
+            registry.version("samtools")
+            self.assertEqual(self.fakeSamtools.numCalls(), 1)
+
+            # A new registry reuses the version in the manifest.
+            registry = ToolRegistry(self.manifest)
+            self.assertEqual(registry.version("samtools"), ["1", "2"])
+            self.assertEqual(self.fakeSamtools.numCalls(), 1)
+        finally:
+            os.environ["PATH"] = oldPath
+
+
+if __name__ == "__main__":
+    unittest.main()